@@ -7,12 +7,14 @@ from typing import Annotated
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr, Field
-from sqlalchemy.orm import Session
-from passlib.hash import argon2
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from app.models.auth_model import User
-from app.database.db_connect import config, get_db
+from app.database.db_connect import config, get_async_db
+from app.services.password_service import password_hasher, PasswordHasherBusy
+from app.services.token_cache import token_cache
 from fastapi import APIRouter
 
 
@@ -31,11 +33,18 @@ SENDER_PASSWORD = config["SENDER_PASSWORD"]
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/token") # only for Swagger
 
 def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
+    user = token_cache.get(token)
+    if user:
+        return user
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return {"username": payload["sub"], "role": payload["role"]}
+        user = {"username": payload["sub"], "role": payload["role"]}
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if token_cache.is_revoked(token):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    token_cache.put(token, user, payload.get("exp"))
+    return user
 
 def require_roles(*allowed_roles: list[int]):
     def role_checker(user: dict = Depends(get_current_user)):
@@ -62,8 +71,29 @@ class UserRoleInput(BaseModel):
     name: Annotated[str, Field(min_length=1, max_length=50, strip_whitespace=True)]
 
 
-def user_exists(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def user_exists(db: AsyncSession, username: str):
+    return await db.scalar(select(User).where(User.username == username))
+
+
+async def hash_password(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+
+
+async def check_password(db: AsyncSession, user: User, password: str) -> bool:
+    """Verifies password for user, storing a rehash if the configured argon2 cost has changed."""
+    if not user:
+        return False
+    try:
+        ok, new_hash = await password_hasher.verify(password, user.password_hash)
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    if new_hash:
+        user.password_hash = new_hash
+        await db.commit()
+    return ok
 
 
 def generate_password(length=6):
@@ -87,14 +117,14 @@ def send_email(recipient: str, subject: str, body: str):
 
 
 @router.post("/add_user")
-async def add_user(user_data: UserInput, db: Session = Depends(get_db), _: dict = Depends(require_roles(1))):
-    if user_exists(db, user_data.username):
+async def add_user(user_data: UserInput, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1))):
+    if await user_exists(db, user_data.username):
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="User with that username already exists"
         )
 
-    hashed_password = argon2.hash(user_data.password)
+    hashed_password = await hash_password(user_data.password)
     user = User(
         username=user_data.username,
         email_address=user_data.email_address,
@@ -102,14 +132,14 @@ async def add_user(user_data: UserInput, db: Session = Depends(get_db), _: dict
         i_user_role=user_data.i_user_role
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return {"i_user": user.i_user}
 
 
 @router.get("/get_user")
-async def get_user(username: str, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    user = user_exists(db, username)
+async def get_user(username: str, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    user = await user_exists(db, username)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -119,8 +149,8 @@ async def get_user(username: str, db: Session = Depends(get_db), _: dict = Depen
 
 
 @router.put("/update_user")
-async def update_user(user_data: UserInput, db: Session = Depends(get_db), _: dict = Depends(require_roles(1))):
-    user = user_exists(db, user_data.username)
+async def update_user(user_data: UserInput, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1))):
+    user = await user_exists(db, user_data.username)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -128,25 +158,25 @@ async def update_user(user_data: UserInput, db: Session = Depends(get_db), _: di
         )
 
     user.email_address = user_data.email_address
-    user.password_hash = argon2.hash(user_data.password)
+    user.password_hash = await hash_password(user_data.password)
     user.i_user_role = user_data.i_user_role
 
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return {"i_user": user.i_user}
 
 
 @router.delete("/delete_user")
-async def delete_user(username: str, db: Session = Depends(get_db), _: dict = Depends(require_roles(1))):
-    user = user_exists(db, username)
+async def delete_user(username: str, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1))):
+    user = await user_exists(db, username)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    db.delete(user)
-    db.commit()
+    await db.delete(user)
+    await db.commit()
     return {"i_user": user.i_user}
 
 
@@ -158,9 +188,9 @@ def create_token(data: dict, expires_delta: timedelta):
 
 
 @router.post("/login")
-async def login(user_data: LoginInput, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == user_data.username).first()
-    if not user or not argon2.verify(user_data.password, user.password_hash):
+async def login(user_data: LoginInput, db: AsyncSession = Depends(get_async_db)):
+    user = await db.scalar(select(User).where(User.username == user_data.username))
+    if not await check_password(db, user, user_data.password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
 
     token = create_token(
@@ -170,14 +200,31 @@ async def login(user_data: LoginInput, db: Session = Depends(get_db)):
     return {"access_token": token, "token_type": "bearer"}
 
 
+@router.post("/logout")
+async def logout(token: str = Depends(oauth2_scheme), user: dict = Depends(get_current_user)):
+    payload = jwt.get_unverified_claims(token)
+    token_cache.revoke(token, payload.get("exp"))
+    return {"username": user["username"]}
+
+
+@router.get("/token_metrics")
+def token_metrics(_: dict = Depends(require_roles(1))):
+    return token_cache.metrics()
+
+
+@router.get("/hash_metrics")
+def hash_metrics(_: dict = Depends(require_roles(1))):
+    return password_hasher.metrics()
+
+
 @router.get("/me")
 async def users_me(user: dict = Depends(get_current_user)):
     return {"username": user["username"], "role": user["role"]}
 
 
 @router.post("/set_temp_password")
-async def set_temp_password(username: str, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    user = user_exists(db, username)
+async def set_temp_password(username: str, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    user = await user_exists(db, username)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -186,10 +233,10 @@ async def set_temp_password(username: str, db: Session = Depends(get_db), _: dic
 
     new_password = generate_password()
 
-    hashed_password = argon2.hash(new_password)
+    hashed_password = await hash_password(new_password)
     user.password_hash = hashed_password
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
 
     subject = "Password Reset Notification"
     body = f"Hello {user.username},\n\nYour new password is: {new_password}\nPlease change it during login."
@@ -200,14 +247,14 @@ async def set_temp_password(username: str, db: Session = Depends(get_db), _: dic
 
 
 @router.post("/update_password")
-async def update_password(username: str, temp_password: str, new_password: str, db: Session = Depends(get_db),  _: dict = Depends(require_roles(1, 2))):
-    user = user_exists(db, username)
-    if not user or not argon2.verify(temp_password, user.password_hash):
+async def update_password(username: str, temp_password: str, new_password: str, db: AsyncSession = Depends(get_async_db),  _: dict = Depends(require_roles(1, 2))):
+    user = await user_exists(db, username)
+    if not await check_password(db, user, temp_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
-    user.password_hash = argon2.hash(new_password)
+    user.password_hash = await hash_password(new_password)
 
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return {"i_user": user.i_user}
 
 
@@ -215,10 +262,10 @@ async def update_password(username: str, temp_password: str, new_password: str,
 @router.post("/token")  # only for Swagger
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not argon2.verify(form_data.password, user.password_hash):
+    user = await db.scalar(select(User).where(User.username == form_data.username))
+    if not await check_password(db, user, form_data.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     token = create_token(
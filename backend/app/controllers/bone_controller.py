@@ -1,11 +1,18 @@
-from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File, Form, Request, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel, Field
-from typing import Annotated
-from app.database.db_connect import get_db, config
+from typing import Annotated, Optional
+from app.database.db_connect import get_async_db, config
 from app.models.bone_model import BoneModel
 from app.controllers.auth_controller import require_roles
+from app.services.bone_mesh_cache import invalidate_bone_mesh, get_bone_mesh, file_content_hash
+from app.services.mesh_export import mesh_response, LOD_REDUCTIONS
+from app.services.mesh_jobs import submit_mesh_job, cancel_mesh_job, get_mesh_job_status
+from app.services.blob_store import store_upload, abandon_upload, release_blob, blob_content_hash, commit_release, remove_blob_file
+from app.services.pagination import keyset_page, InvalidPageRequest
 import os
 
 
@@ -13,6 +20,8 @@ CURRENT_DIR = os.path.dirname(__file__)
 APP_ROOT = os.path.dirname(CURRENT_DIR)
 BONE_STORAGE_DIR = os.path.join(APP_ROOT, config["BONE_STORAGE_DIR"])
 ALLOWED_EXTENSIONS = {".nrrd"}
+BONE_MODEL_FIELDS = ["i_3d_bone_model", "i_patient", "i_dicom", "i_file_type", "path_to_model", "file_name"]
+BONE_MODEL_SORTS = {"i_3d_bone_model", "file_name"}
 os.makedirs(BONE_STORAGE_DIR, exist_ok=True)
 
 router = APIRouter(prefix="/3d_bone_models", tags=["3D Bone models"])
@@ -24,15 +33,15 @@ class BoneModelInputForm(BaseModel):
     file_name: Annotated[str, Field(min_length=1, max_length=50, strip_whitespace=True)]
 
 
-def bone_model_exists_by_filename(db: Session, file_name: str):
-    return db.query(BoneModel).filter(BoneModel.file_name == file_name).first()
+async def bone_model_exists_by_filename(db: AsyncSession, file_name: str):
+    return await db.scalar(select(BoneModel).where(BoneModel.file_name == file_name))
 
 def is_allowed_file(filename: str) -> bool:
     return any(filename.endswith(ext) for ext in ALLOWED_EXTENSIONS)
 
 @router.get("/get_model")
-async def get_bone_model(i_3d_bone_model: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    model = db.query(BoneModel).filter(BoneModel.i_3d_bone_model == i_3d_bone_model).first()
+async def get_bone_model(i_3d_bone_model: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    model = await db.scalar(select(BoneModel).where(BoneModel.i_3d_bone_model == i_3d_bone_model))
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Bone Model not found")
     return {
@@ -42,9 +51,32 @@ async def get_bone_model(i_3d_bone_model: int, db: Session = Depends(get_db), _:
     }
 
 @router.get("/list_by_patient")
-async def list_bone_models_by_patient(i_patient: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    models = db.query(BoneModel).filter(BoneModel.i_patient == i_patient).all()
-    return models
+async def list_bone_models_by_patient(
+    response: Response,
+    i_patient: int,
+    i_dicom: Optional[int] = None,
+    fields: list[str] = Query(None),
+    sort: str = "i_3d_bone_model",
+    descending: bool = False,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    _: dict = Depends(require_roles(1, 2))
+):
+    filters = [BoneModel.i_patient == i_patient]
+    if i_dicom is not None:
+        filters.append(BoneModel.i_dicom == i_dicom)
+
+    try:
+        rows, next_cursor = await keyset_page(
+            db, BoneModel, "i_3d_bone_model", BONE_MODEL_FIELDS, BONE_MODEL_SORTS,
+            fields, sort, descending, filters, limit, cursor
+        )
+    except InvalidPageRequest as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
 
 @router.post("/add_model")
 async def add_bone_model(
@@ -53,75 +85,88 @@ async def add_bone_model(
     i_file_type: int = Form(...),
     file_name: str = Form(...),
     model_file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
     if not is_allowed_file(file_name):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Only .nrrd files are allowed")
 
-    if bone_model_exists_by_filename(db, file_name):
+    if await bone_model_exists_by_filename(db, file_name):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Bone model with that file name already exists")
 
-    file_path = os.path.join(BONE_STORAGE_DIR, file_name)
-
-    with open(file_path, "wb") as f:
-        while content := await model_file.read(1024 * 1024):
-            f.write(content)
+    blob = await store_upload(db, model_file, file_name)
 
     new_model = BoneModel(
         i_patient=i_patient,
         i_dicom=i_dicom,
         i_file_type=i_file_type,
         file_name=file_name,
-        path_to_model=file_path
+        path_to_model=blob.path
     )
     db.add(new_model)
-    db.commit()
-    db.refresh(new_model)
+    try:
+        await db.commit()
+    except Exception:
+        await abandon_upload(db, blob)
+        raise
+    await db.refresh(new_model)
+    # A duplicate of an already meshed volume finds its mesh in the store straight away.
+    submit_mesh_job(new_model.i_3d_bone_model, new_model.path_to_model)
     return {"i_3d_bone_model": new_model.i_3d_bone_model}
 
 @router.put("/update_model")
-async def update_bone_model(i_3d_bone_model: int, file_name: str = Form(...), db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
+async def update_bone_model(i_3d_bone_model: int, file_name: str = Form(...), db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
     if not is_allowed_file(file_name):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Only .nrrd files are allowed")
 
-    model = db.query(BoneModel).filter(BoneModel.i_3d_bone_model == i_3d_bone_model).first()
+    model = await db.scalar(select(BoneModel).where(BoneModel.i_3d_bone_model == i_3d_bone_model))
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Bone Model not found")
 
-    existing = bone_model_exists_by_filename(db, file_name)
+    existing = await bone_model_exists_by_filename(db, file_name)
     if existing and existing.i_3d_bone_model != i_3d_bone_model:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="File name already in use")
 
-    old_file_path = model.path_to_model
-    new_file_path = os.path.join(BONE_STORAGE_DIR, file_name)
-    if os.path.exists(old_file_path):
-        os.rename(old_file_path, new_file_path)
-
     model.file_name = file_name
-    model.path_to_model = new_file_path
-    db.commit()
-    db.refresh(model)
+    await db.commit()
+    await db.refresh(model)
     return {"i_3d_bone_model": model.i_3d_bone_model}
 
 @router.delete("/delete_model")
-async def delete_bone_model(i_3d_bone_model: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    model = db.query(BoneModel).filter(BoneModel.i_3d_bone_model == i_3d_bone_model).first()
+async def delete_bone_model(i_3d_bone_model: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    model = await db.scalar(select(BoneModel).where(BoneModel.i_3d_bone_model == i_3d_bone_model))
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Bone Model not found")
 
-    if os.path.exists(model.path_to_model):
-        os.remove(model.path_to_model)
-    else:
+    if not os.path.exists(model.path_to_model):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model file not found in storage")
 
-    db.delete(model)
-    db.commit()
+    cancel_mesh_job(i_3d_bone_model)
+    file_path = model.path_to_model
+    # The meshes are keyed by content hash, which has to be known before the file is tombstoned.
+    content_hash = await blob_content_hash(db, file_path) or await run_in_threadpool(file_content_hash, file_path)
+    tombstone = await release_blob(db, file_path)
+    await db.delete(model)
+    await commit_release(db, file_path, tombstone)
+    if tombstone:
+        invalidate_bone_mesh(file_path, content_hash)
+        remove_blob_file(file_path, tombstone)
     return {"i_3d_bone_model": i_3d_bone_model}
 
+@router.get("/mesh_status")
+async def get_mesh_status(i_3d_bone_model: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    model = await db.scalar(select(BoneModel).where(BoneModel.i_3d_bone_model == i_3d_bone_model))
+    if not model:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Bone Model not found")
+
+    if not os.path.exists(model.path_to_model):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model file not found in storage")
+
+    return {"i_3d_bone_model": i_3d_bone_model, **get_mesh_job_status(i_3d_bone_model, model.path_to_model)}
+
 @router.get("/download_model")
-async def download_bone_model(i_3d_bone_model: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    model = db.query(BoneModel).filter(BoneModel.i_3d_bone_model == i_3d_bone_model).first()
+async def download_bone_model(i_3d_bone_model: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    model = await db.scalar(select(BoneModel).where(BoneModel.i_3d_bone_model == i_3d_bone_model))
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Bone Model not found")
 
@@ -129,3 +174,18 @@ async def download_bone_model(i_3d_bone_model: int, db: Session = Depends(get_db
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model file not found in storage")
 
     return FileResponse(model.path_to_model, filename=model.file_name)
+
+@router.get("/download_mesh")
+async def download_bone_mesh(request: Request, i_3d_bone_model: int, lod: int = 0, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    if lod not in LOD_REDUCTIONS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"lod must be one of: {list(LOD_REDUCTIONS)}")
+
+    model = await db.scalar(select(BoneModel).where(BoneModel.i_3d_bone_model == i_3d_bone_model))
+    if not model:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Bone Model not found")
+
+    if not os.path.exists(model.path_to_model):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model file not found in storage")
+
+    content_hash = await run_in_threadpool(file_content_hash, model.path_to_model)
+    return await mesh_response(request, f"bone-{content_hash}", lambda: get_bone_mesh(model.path_to_model), lod)
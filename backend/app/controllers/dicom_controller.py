@@ -1,18 +1,26 @@
-from fastapi import HTTPException, status, Depends, UploadFile, File, Form
+from fastapi import HTTPException, status, Depends, UploadFile, File, Form, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from fastapi.responses import FileResponse
-from typing import Annotated
-from app.database.db_connect import config, get_db
+from typing import Annotated, Optional
+from app.database.db_connect import config, get_async_db
 from app.models.dicom_model import DICOM
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import APIRouter
 from app.controllers.auth_controller import require_roles
+from app.services.analysis_jobs import submit_analysis, get_analysis_status, result_paths
+from app.services.dicom_analysis_service import read_result_mask
+from app.services.mask_store import load_mask_index, select_masks, mask_store_paths, read_mask_stack
+from app.services.upload_service import UploadTooLarge
+from app.services.blob_store import store_upload, abandon_upload, release_blob, commit_release, remove_blob_file
 import os
 
 CURRENT_DIR = os.path.dirname(__file__)
 APP_ROOT = os.path.dirname(CURRENT_DIR)
 DICOM_STORAGE_DIR = os.path.join(APP_ROOT, config["DICOM_STORAGE_DIR"])
 ALLOWED_EXTENSIONS = {".zip", ".rar", ".tar", ".dcm"}
+DICOM_MAX_UPLOAD_BYTES = int(config.get("DICOM_MAX_UPLOAD_MB", 2048)) * 1024 * 1024
 os.makedirs(DICOM_STORAGE_DIR, exist_ok=True)
 
 router = APIRouter(prefix="/dicoms", tags=["DICOM files"])
@@ -22,21 +30,27 @@ class DICOMInputForm(BaseModel):
     file_name: Annotated[str, Field(min_length=1, max_length=50, strip_whitespace=True)]
     i_file_type: int
 
-def dicom_exists_by_filename(db: Session, file_name: str):
-    return db.query(DICOM).filter(DICOM.file_name == file_name).first()
+async def dicom_exists_by_filename(db: AsyncSession, file_name: str):
+    return await db.scalar(select(DICOM).where(DICOM.file_name == file_name))
 
 def is_allowed_file(filename: str) -> bool:
     return any(filename.endswith(ext) for ext in ALLOWED_EXTENSIONS)
 
 @router.get("/get_dicom")
-async def get_dicom(i_dicom: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    dicom = db.query(DICOM).filter(DICOM.i_dicom == i_dicom).first()
+async def get_dicom(i_dicom: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    dicom = await db.scalar(select(DICOM).where(DICOM.i_dicom == i_dicom))
     if not dicom:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="DICOM not found"
         )
-    return {"i_dicom": dicom.i_dicom, "i_patient": dicom.i_patient, "file_name": dicom.file_name}
+    return {
+        "i_dicom": dicom.i_dicom,
+        "i_patient": dicom.i_patient,
+        "file_name": dicom.file_name,
+        "content_hash": dicom.content_hash,
+        "file_size": dicom.file_size
+    }
 
 @router.post("/add_dicom")
 async def add_dicom(
@@ -44,7 +58,7 @@ async def add_dicom(
     file_name: str = Form(...),
     i_file_type: int = Form(...),
     dicom_file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
     if not is_allowed_file(file_name):
@@ -53,27 +67,39 @@ async def add_dicom(
             detail="Only .zip, .tar, or .dcm files are allowed"
         )
 
-    if dicom_exists_by_filename(db, file_name):
+    if await dicom_exists_by_filename(db, file_name):
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="DICOM with that file name already exists"
         )
 
-    file_path = os.path.join(APP_ROOT, DICOM_STORAGE_DIR, file_name)
-    with open(file_path, "wb") as f:
-        f.write(await dicom_file.read())
+    try:
+        blob = await store_upload(db, dicom_file, file_name, DICOM_MAX_UPLOAD_BYTES)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
-    new_dicom = DICOM(i_patient=i_patient, path_to_dicom=file_path, i_file_type=i_file_type, file_name=file_name)
+    new_dicom = DICOM(
+        i_patient=i_patient,
+        path_to_dicom=blob.path,
+        i_file_type=i_file_type,
+        file_name=file_name,
+        content_hash=blob.content_hash,
+        file_size=blob.size
+    )
     db.add(new_dicom)
-    db.commit()
-    db.refresh(new_dicom)
+    try:
+        await db.commit()
+    except Exception:
+        await abandon_upload(db, blob)
+        raise
+    await db.refresh(new_dicom)
     return {"i_dicom": new_dicom.i_dicom}
 
 @router.put("/update_dicom")
 async def update_dicom(
     i_dicom: int,
     file_name: str = Form(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
     if not is_allowed_file(file_name):
@@ -82,55 +108,50 @@ async def update_dicom(
             detail="Only .zip, .tar, or .dcm files are allowed"
         )
 
-    db_dicom = db.query(DICOM).filter(DICOM.i_dicom == i_dicom).first()
+    db_dicom = await db.scalar(select(DICOM).where(DICOM.i_dicom == i_dicom))
     if not db_dicom:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="DICOM not found"
         )
 
-    existing_dicom = dicom_exists_by_filename(db, file_name)
+    existing_dicom = await dicom_exists_by_filename(db, file_name)
     if existing_dicom and existing_dicom.i_dicom != i_dicom:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="File name already in use"
         )
 
-    old_file_path = db_dicom.path_to_dicom
-    new_file_path = os.path.join(APP_ROOT, DICOM_STORAGE_DIR, file_name)
-    if os.path.exists(old_file_path):
-        os.rename(old_file_path, new_file_path)
-
     db_dicom.file_name = file_name
-    db_dicom.path_to_dicom = new_file_path
-
-    db.commit()
-    db.refresh(db_dicom)
+    await db.commit()
+    await db.refresh(db_dicom)
     return {"i_dicom": db_dicom.i_dicom}
 
 @router.delete("/delete_dicom")
-async def delete_dicom(i_dicom: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    dicom = db.query(DICOM).filter(DICOM.i_dicom == i_dicom).first()
+async def delete_dicom(i_dicom: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    dicom = await db.scalar(select(DICOM).where(DICOM.i_dicom == i_dicom))
     if not dicom:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="DICOM not found"
         )
 
-    if os.path.exists(dicom.path_to_dicom):
-        os.remove(dicom.path_to_dicom)
-    else:
+    if not os.path.exists(dicom.path_to_dicom):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="DICOM not found in storage"
         )
-    db.delete(dicom)
-    db.commit()
+    file_path = dicom.path_to_dicom
+    tombstone = await release_blob(db, file_path)
+    await db.delete(dicom)
+    await commit_release(db, file_path, tombstone)
+    if tombstone:
+        remove_blob_file(file_path, tombstone)
     return {"i_dicom": i_dicom}
 
 @router.get("/download_dicom")
-async def download_dicom(i_dicom: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    dicom = db.query(DICOM).filter(DICOM.i_dicom == i_dicom).first()
+async def download_dicom(i_dicom: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    dicom = await db.scalar(select(DICOM).where(DICOM.i_dicom == i_dicom))
     if not dicom:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -143,3 +164,112 @@ async def download_dicom(i_dicom: int, db: Session = Depends(get_db), _: dict =
         )
 
     return FileResponse(dicom.path_to_dicom, filename=dicom.file_name)
+
+async def get_stored_dicom(db: AsyncSession, i_dicom: int) -> DICOM:
+    dicom = await db.scalar(select(DICOM).where(DICOM.i_dicom == i_dicom))
+    if not dicom:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="DICOM not found"
+        )
+    if not os.path.exists(dicom.path_to_dicom):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="DICOM file not found in storage"
+        )
+    return dicom
+
+@router.post("/analyze")
+async def analyze_dicom(i_dicom: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    dicom = await get_stored_dicom(db, i_dicom)
+    return await submit_analysis(i_dicom, dicom.path_to_dicom, dicom.content_hash)
+
+@router.get("/analysis_status")
+async def analysis_status(i_dicom: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    dicom = await get_stored_dicom(db, i_dicom)
+    return await get_analysis_status(i_dicom, dicom.path_to_dicom, dicom.content_hash)
+
+async def get_finished_analysis(db: AsyncSession, i_dicom: int) -> tuple[DICOM, str]:
+    dicom = await get_stored_dicom(db, i_dicom)
+    job_status = await get_analysis_status(i_dicom, dicom.path_to_dicom, dicom.content_hash)
+    if job_status["status"] == "not_started":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="DICOM has not been analysed")
+    if job_status["status"] != "done":
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Analysis is {job_status['status']}")
+    return dicom, job_status["content_hash"]
+
+@router.get("/analysis_result")
+async def analysis_result(
+    i_dicom: int,
+    result_format: str = Query("json"),
+    db: AsyncSession = Depends(get_async_db),
+    _: dict = Depends(require_roles(1, 2))
+):
+    if result_format not in ("json", "pb"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="result_format must be 'json' or 'pb'")
+
+    dicom, content_hash = await get_finished_analysis(db, i_dicom)
+    pb_path, json_path = result_paths(content_hash)
+    base_name = os.path.splitext(dicom.file_name)[0]
+    if result_format == "pb":
+        return FileResponse(pb_path, media_type="application/octet-stream", filename=f"{base_name}.pb")
+    return FileResponse(json_path, media_type="application/json", filename=f"{base_name}.json")
+
+@router.get("/analysis_mask")
+async def analysis_mask(i_dicom: int, instance_id: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    _dicom, content_hash = await get_finished_analysis(db, i_dicom)
+    pb_path, json_path = result_paths(content_hash)
+    try:
+        mask_png = await run_in_threadpool(read_result_mask, pb_path, json_path, instance_id)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    return Response(content=mask_png, media_type="image/png", headers={"Cache-Control": "private, max-age=3600"})
+
+@router.get("/analysis_mask_index")
+async def analysis_mask_index(
+    i_dicom: int,
+    instance_id: list[int] = Query(None),
+    class_name: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    _: dict = Depends(require_roles(1, 2))
+):
+    """
+    Bounding boxes and byte ranges of the decoded mask crops, optionally filtered by instance
+    id(s) and class. Fetch the crops from /analysis_mask_store with a Range header per entry,
+    or all selected crops at once from /analysis_mask_stack.
+    """
+    _dicom, content_hash = await get_finished_analysis(db, i_dicom)
+    pb_path, _json_path = result_paths(content_hash)
+    index = await run_in_threadpool(load_mask_index, pb_path, content_hash)
+    index["instances"] = select_masks(index, instance_id, class_name)
+    return index
+
+@router.get("/analysis_mask_store")
+async def analysis_mask_store(i_dicom: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    _dicom, content_hash = await get_finished_analysis(db, i_dicom)
+    store_path, index_path = mask_store_paths(content_hash)
+    if not (os.path.exists(store_path) and os.path.exists(index_path)):
+        await run_in_threadpool(load_mask_index, result_paths(content_hash)[0], content_hash)
+    # FileResponse answers single and multi-range requests, so any subset of masks is one request.
+    return FileResponse(store_path, media_type="application/octet-stream", headers={"Cache-Control": "private, max-age=3600"})
+
+@router.get("/analysis_mask_stack")
+async def analysis_mask_stack(
+    i_dicom: int,
+    instance_id: list[int] = Query(None),
+    class_name: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    _: dict = Depends(require_roles(1, 2))
+):
+    """
+    The decoded mask crops selected by instance id(s) and class in one response: a 4-byte
+    big-endian header length, a JSON header with each crop's bbox and byte range, then the crops.
+    """
+    _dicom, content_hash = await get_finished_analysis(db, i_dicom)
+    pb_path, _json_path = result_paths(content_hash)
+    index = await run_in_threadpool(load_mask_index, pb_path, content_hash)
+    entries = select_masks(index, instance_id, class_name)
+    if not entries:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No masks match the given instance ids and class")
+    stack = await run_in_threadpool(read_mask_stack, content_hash, index, entries)
+    return Response(content=stack, media_type="application/octet-stream", headers={"Cache-Control": "private, max-age=3600"})
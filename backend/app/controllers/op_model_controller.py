@@ -1,19 +1,30 @@
-from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
-from app.database.db_connect import get_db
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, model_validator
+from typing import Annotated, Optional
+from app.database.db_connect import get_db, SessionLocal
 from sqlalchemy.orm import Session
 import os
+import tempfile
 
 from app.database.db_connect import config
 from app.services.op_model_service import create_model_handler, remove_model_handler, restore_positions, scene_handlers, decompose_matrix, compose_matrix
 from app.models.opplan_scene_model import OperationPlanScenes
 from app.models.prosthesis_model import ProsthesisModel
-from app.controllers.auth_controller import require_roles
+from app.controllers.auth_controller import require_roles, get_current_user
+from app.services.render_service import render_pool, render_planning_view
+from app.services.image_encoding import IMAGE_MEDIA_TYPES
+from app.services.etags import etag_matches
+from app.services.state_store import StateConflict
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+import json
+import struct
 
 CURRENT_DIR = os.path.dirname(__file__)
 APP_ROOT = os.path.dirname(CURRENT_DIR)
 VIEW_SNAPSHOTS_STORAGE_DIR = os.path.join(APP_ROOT, config["VIEW_SNAPSHOTS_STORAGE_DIR"])
+os.makedirs(VIEW_SNAPSHOTS_STORAGE_DIR, exist_ok=True)
 
 router = APIRouter(prefix="/operation_plan_models", tags=["Operation Plan Models"])
 
@@ -37,6 +48,46 @@ class RotateRequest(BaseModel):
     axis: str  # "x", "y", or "z"
     angle: float  # in degrees, positive or negative
 
+class PoseInput(BaseModel):
+    # Either a row-major 4x4 matrix or translation / xyz Euler rotation in degrees / scale
+    matrix: Optional[Annotated[list[float], Field(min_length=16, max_length=16)]] = None
+    translation: Optional[Annotated[list[float], Field(min_length=3, max_length=3)]] = None
+    rotation: Optional[Annotated[list[float], Field(min_length=3, max_length=3)]] = None
+    scale: Optional[Annotated[list[float], Field(min_length=3, max_length=3)]] = None
+
+    @model_validator(mode="after")
+    def check_one_form(self):
+        has_trs = any(v is not None for v in (self.translation, self.rotation, self.scale))
+        if self.matrix is not None and has_trs:
+            raise ValueError("Give either matrix or translation/rotation/scale, not both")
+        if self.matrix is None and not has_trs:
+            raise ValueError("Pose needs a matrix or at least one of translation/rotation/scale")
+        return self
+
+    def to_matrix(self) -> list[float]:
+        if self.matrix is not None:
+            return self.matrix
+        return compose_matrix(self.translation or [0.0, 0.0, 0.0], self.rotation or [0.0, 0.0, 0.0], self.scale or [1.0, 1.0, 1.0])
+
+class RenderOptions(BaseModel):
+    view_name: str = "front"
+    width: int = 1200
+    height: int = 800
+    image_format: str = "png"
+    quality: Annotated[int, Field(ge=1, le=100)] = 90
+
+class PoseRequest(BaseModel):
+    i_operation_plan: int
+    prosthesis: Optional[PoseInput] = None
+    bone: Optional[PoseInput] = None
+    render: Optional[RenderOptions] = None
+
+class SceneCommand(BaseModel):
+    seq: int
+    prosthesis: Optional[PoseInput] = None
+    bone: Optional[PoseInput] = None
+    camera: Optional[RenderOptions] = None
+
 @router.post("/create_handler")
 def create_handler(i_operation_plan: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
     try:
@@ -63,7 +114,10 @@ def assign_prosthesis(request: ProsthesisAssignmentRequest, db: Session = Depend
 
     try:
         handler.add_prosthesis_to_scene(prosthesis_model_db.path_to_model)
+        scene_handlers.persist(request.i_operation_plan)
         return {"status": "success", "message": "Prosthesis added/changed in scene."}
+    except StateConflict:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to add prosthesis to scene: {str(e)}")
 
@@ -75,7 +129,10 @@ def remove_prosthesis(i_operation_plan: int, _: dict = Depends(require_roles(1,
     handler = scene_handlers[i_operation_plan]
     try:
         handler.remove_prosthesis_from_scene()
+        scene_handlers.persist(i_operation_plan)
         return {"status": "success", "message": "Prosthesis removed from scene."}
+    except StateConflict:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to remove prosthesis from scene: {str(e)}")
 
@@ -101,6 +158,7 @@ def slide(data: SlideRequest, db: Session = Depends(get_db), _: dict = Depends(r
         raise HTTPException(status_code=400, detail="Invalid direction")
 
     directions[data.direction](data.value)
+    scene_handlers.persist(data.i_operation_plan)
     return {"status": "moved"}
 
 @router.post("/scale")
@@ -118,7 +176,10 @@ def scale_prosthesis(data: ScaleRequest, db: Session = Depends(get_db), _: dict
 
     try:
         handler.scale_prosthesis(data.scale_x, data.scale_y, data.scale_z)
+        scene_handlers.persist(data.i_operation_plan)
         return {"status": "scaled", "message": f"Prosthesis scaled to ({data.scale_x}, {data.scale_y}, {data.scale_z})."}
+    except StateConflict:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to scale prosthesis: {str(e)}")
 
@@ -134,22 +195,207 @@ def rotate_prosthesis(data: RotateRequest, db: Session = Depends(get_db), _: dic
 
     try:
         handler.rotate_prosthesis(data.axis.lower(), data.angle)
+        scene_handlers.persist(data.i_operation_plan)
         return {"status": "rotated", "message": f"Prosthesis rotated {data.angle}° around {data.axis}-axis."}
+    except StateConflict:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+def save_view_snapshot(file_name: str, image_bytes: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=VIEW_SNAPSHOTS_STORAGE_DIR)
+    with os.fdopen(fd, "wb") as f:
+        f.write(image_bytes)
+    os.replace(tmp_path, os.path.join(VIEW_SNAPSHOTS_STORAGE_DIR, file_name))
+
+async def render_view(handler, state: dict, etag: str, view_name: str, width: int, height: int, image_format: str, quality: int) -> bytes:
+    """Renders state, the snapshot etag was computed from, so a pose applied meanwhile cannot be cached under it."""
+    image_bytes = handler.get_cached_view(etag)
+    if image_bytes is None:
+        try:
+            image_bytes = await render_pool.run(
+                render_planning_view, state, view_name, width, height, image_format, quality
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Rendering the view timed out")
+        except BrokenProcessPool:
+            raise HTTPException(status_code=503, detail="Render workers are unavailable")
+        handler.cache_view(etag, image_bytes)
+    return image_bytes
+
 @router.get("/get_view")
-def get_view(i_operation_plan: int, view_name: str, db: Session = Depends(get_db), width: int = 1200, height: int = 800, _: dict = Depends(require_roles(1, 2))):
-    if i_operation_plan not in scene_handlers:
-        create_model_handler(i_operation_plan, db)
+async def get_view(
+    request: Request,
+    i_operation_plan: int,
+    view_name: str,
+    db: Session = Depends(get_db),
+    width: int = 1200,
+    height: int = 800,
+    image_format: str = Query("png"),
+    quality: int = Query(90, ge=1, le=100),
+    snapshot: bool = False,
+    _: dict = Depends(require_roles(1, 2))
+):
+    if image_format not in IMAGE_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid image_format: {image_format}")
+
+    # create_model_handler returns the registered handler, rehydrating it off the event loop if it was evicted.
+    handler = await run_in_threadpool(create_model_handler, i_operation_plan, db)
+    state = handler.get_scene_state()
+    etag = handler.view_etag(view_name, width, height, image_format, quality, state)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag) and not snapshot:
+        return Response(status_code=304, headers=headers)
+
+    image_bytes = await render_view(handler, state, etag, view_name, width, height, image_format, quality)
+
+    if snapshot:
+        await run_in_threadpool(save_view_snapshot, f"scene_{i_operation_plan}_{view_name}.{image_format}", image_bytes)
+
+    return Response(content=image_bytes, media_type=IMAGE_MEDIA_TYPES[image_format], headers=headers)
+
+@router.post("/set_pose")
+async def set_pose(data: PoseRequest, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
+    if data.render and data.render.image_format not in IMAGE_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Invalid image_format: {data.render.image_format}")
 
-    handler = scene_handlers[i_operation_plan]
-    handler.set_camera(view_name)
-    handler.render_window.SetSize(width, height)
-    filepath = os.path.join(APP_ROOT, VIEW_SNAPSHOTS_STORAGE_DIR, f"scene_{i_operation_plan}_{view_name}.png")
-    handler.render_to_image(filepath)
+    try:
+        handler = await run_in_threadpool(create_model_handler, data.i_operation_plan, db)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"Model handler not found and could not be created: {str(e)}")
 
-    return FileResponse(filepath, media_type="image/png")
+    try:
+        handler.apply_pose(
+            prosthesis_matrix=data.prosthesis.to_matrix() if data.prosthesis else None,
+            bone_matrix=data.bone.to_matrix() if data.bone else None
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await run_in_threadpool(scene_handlers.persist, data.i_operation_plan)
+
+    if not data.render:
+        state = handler.get_scene_state()
+        return {"status": "pose applied", "prosthesis_matrix": state["prosthesis_matrix"], "bone_matrix": state["bone_matrix"]}
+
+    options = data.render
+    state = handler.get_scene_state()
+    etag = handler.view_etag(options.view_name, options.width, options.height, options.image_format, options.quality, state)
+    image_bytes = await render_view(handler, state, etag, options.view_name, options.width, options.height, options.image_format, options.quality)
+    return Response(
+        content=image_bytes,
+        media_type=IMAGE_MEDIA_TYPES[options.image_format],
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
+
+def load_model_handler(i_operation_plan: int):
+    # Long-lived callers (the WebSocket session) hold a pooled connection only while loading.
+    with SessionLocal() as db:
+        return create_model_handler(i_operation_plan, db)
+
+@router.websocket("/ws/{i_operation_plan}")
+async def interactive_session(websocket: WebSocket, i_operation_plan: int, token: str = Query(...)):
+    """
+    Streams frames for one planning scene. Each text message is a SceneCommand; poses are
+    applied in arrival order, but only the latest state is rendered when commands arrive
+    faster than frames. Frames are binary: a 4-byte big-endian seq of the last applied
+    command followed by the encoded image. Rejected commands get a JSON error with their seq.
+    """
+    # Browsers cannot set headers on a WebSocket handshake, so the JWT comes as a query parameter.
+    try:
+        user = await run_in_threadpool(get_current_user, token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if user["role"] not in (1, 2):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+
+    try:
+        handler = await run_in_threadpool(load_model_handler, i_operation_plan)
+    except Exception as e:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason=str(e)[:120])
+        return
+
+    latest = {"seq": 0, "camera": RenderOptions(), "handler": handler}
+    frame_requested = asyncio.Event()
+    send_lock = asyncio.Lock()
+
+    async def fail(message: str, e: Exception):
+        print(f"Interactive session {i_operation_plan} {message}: {e}")
+        try:
+            async with send_lock:
+                await websocket.send_json({"seq": latest["seq"], "error": f"{message}: {e}"})
+            await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason=str(e)[:120])
+        except Exception:
+            pass  # The socket itself is what failed.
+
+    async def render_frames():
+        while True:
+            await frame_requested.wait()
+            frame_requested.clear()
+            seq, camera, handler = latest["seq"], latest["camera"], latest["handler"]
+            state = handler.get_scene_state()
+            etag = handler.view_etag(camera.view_name, camera.width, camera.height, camera.image_format, camera.quality, state)
+            try:
+                image_bytes = await render_view(handler, state, etag, camera.view_name, camera.width, camera.height, camera.image_format, camera.quality)
+            except HTTPException as e:
+                async with send_lock:
+                    await websocket.send_json({"seq": seq, "error": e.detail})
+                continue
+            async with send_lock:
+                await websocket.send_bytes(struct.pack(">I", seq) + image_bytes)
+
+    async def run_renderer():
+        # Without this the session would keep accepting commands but never send another frame.
+        try:
+            await render_frames()
+        except Exception as e:
+            await fail("Rendering failed", e)
+
+    renderer = asyncio.create_task(run_renderer())
+    try:
+        while True:
+            message = await websocket.receive_text()
+            command = None
+            try:
+                command = SceneCommand.model_validate(json.loads(message))
+                # The session keeps its handler; it is only looked up again once the registry
+                # has dropped it or a persist found it out of date.
+                handler = scene_handlers.peek(i_operation_plan) or await run_in_threadpool(load_model_handler, i_operation_plan)
+                latest["handler"] = handler
+                if command.camera and command.camera.image_format not in IMAGE_MEDIA_TYPES:
+                    raise ValueError(f"Invalid image_format: {command.camera.image_format}")
+                # apply_pose takes the handler lock, which a render in the threadpool may be holding.
+                await run_in_threadpool(
+                    handler.apply_pose,
+                    prosthesis_matrix=command.prosthesis.to_matrix() if command.prosthesis else None,
+                    bone_matrix=command.bone.to_matrix() if command.bone else None
+                )
+                await run_in_threadpool(scene_handlers.persist, i_operation_plan)
+            except StateConflict as e:
+                # Another worker changed the scene: re-import its state and reject this command.
+                latest["handler"] = await run_in_threadpool(load_model_handler, i_operation_plan)
+                async with send_lock:
+                    await websocket.send_json({"seq": command.seq, "error": str(e)})
+                frame_requested.set()
+                continue
+            except ValueError as e:
+                async with send_lock:
+                    await websocket.send_json({"seq": command.seq if command else None, "error": str(e)})
+                continue
+
+            latest["seq"] = command.seq
+            if command.camera:
+                latest["camera"] = command.camera
+            frame_requested.set()
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        await fail("Command failed", e)
+    finally:
+        renderer.cancel()
 
 @router.post("/save_positions")
 def save_positions(i_operation_plan: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
@@ -189,8 +435,13 @@ def restore_positions_api(i_operation_plan: int, db: Session = Depends(get_db),
     try:
         restore_positions(i_operation_plan, db)
         return {"status": "success", "message": f"Positions restored for operation plan {i_operation_plan}"}
+    except StateConflict:
+        raise
     except ValueError as ve:
         raise HTTPException(status_code=404, detail=str(ve))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to restore positions: {str(e)}")
 
+@router.get("/handler_metrics")
+def handler_metrics(_: dict = Depends(require_roles(1))):
+    return scene_handlers.metrics()
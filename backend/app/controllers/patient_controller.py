@@ -1,15 +1,23 @@
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, status, Depends, Query, Response
 from pydantic import BaseModel, Field, EmailStr
-from typing import Annotated
-from app.database.db_connect import get_db
+from typing import Annotated, Optional
+from app.database.db_connect import get_async_db
 from app.models.patient_model import Patient
-from sqlalchemy.orm import Session
+from sqlalchemy import select, or_
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import date
 from fastapi import APIRouter
 from app.controllers.auth_controller import require_roles
+from app.services.pagination import keyset_page, InvalidPageRequest
 
 router = APIRouter(prefix="/patients", tags=["Patients"])
 
+PATIENT_FIELDS = [
+    "i_patient", "first_name", "last_name", "date_of_birth", "i_sex",
+    "contact_number", "email_address", "address", "date_created"
+]
+PATIENT_SORTS = {"i_patient", "last_name", "first_name"}
+
 class PatientInput(BaseModel):
     first_name: Annotated[str, Field(min_length=1, max_length=50, strip_whitespace=True)]
     last_name: Annotated[str, Field(min_length=1, max_length=50, strip_whitespace=True)]
@@ -19,73 +27,100 @@ class PatientInput(BaseModel):
     email_address: Annotated[EmailStr, Field(max_length=50)]
     address: Annotated[str, Field(strip_whitespace=True)]
 
-def patient_exists(db: Session, email: str):
-    return db.query(Patient).filter(Patient.email_address == email).first()
+async def patient_exists(db: AsyncSession, email: str):
+    return await db.scalar(select(Patient).where(Patient.email_address == email))
 
 @router.get("/get_patient")
 async def get_patient(
     i_patient: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
-    patient = db.query(Patient).filter(Patient.i_patient == i_patient).first()
+    patient = await db.scalar(select(Patient).where(Patient.i_patient == i_patient))
     if not patient:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Patient not found")
     return patient
 
 @router.get("/list_patients")
 async def list_patients(
-    db: Session = Depends(get_db),
+    response: Response,
+    name: Optional[str] = None,
+    i_sex: Optional[int] = None,
+    fields: list[str] = Query(None),
+    sort: str = "i_patient",
+    descending: bool = False,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
-    return db.query(Patient).all()
+    """
+    Patients one page at a time; pass the X-Next-Cursor response header back as cursor
+    for the next page. name matches the start of the first or last name.
+    """
+    filters = []
+    if name:
+        filters.append(or_(Patient.first_name.istartswith(name, autoescape=True), Patient.last_name.istartswith(name, autoescape=True)))
+    if i_sex is not None:
+        filters.append(Patient.i_sex == i_sex)
+
+    try:
+        rows, next_cursor = await keyset_page(
+            db, Patient, "i_patient", PATIENT_FIELDS, PATIENT_SORTS,
+            fields, sort, descending, filters, limit, cursor
+        )
+    except InvalidPageRequest as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
 
 @router.post("/add_patient")
 async def add_patient(
     patient: PatientInput,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
-    if patient_exists(db, patient.email_address):
+    if await patient_exists(db, patient.email_address):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Patient with that email already exists")
     new_patient = Patient(**patient.model_dump())
     db.add(new_patient)
-    db.commit()
-    db.refresh(new_patient)
+    await db.commit()
+    await db.refresh(new_patient)
     return {"i_patient": new_patient.i_patient}
 
 @router.put("/update_patient")
 async def update_patient(
     i_patient: int,
     patient: PatientInput,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
-    db_patient = db.query(Patient).filter(Patient.i_patient == i_patient).first()
+    db_patient = await db.scalar(select(Patient).where(Patient.i_patient == i_patient))
     if not db_patient:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Patient not found")
 
-    existing_patient = patient_exists(db, patient.email_address)
+    existing_patient = await patient_exists(db, patient.email_address)
     if existing_patient and existing_patient.i_patient != i_patient:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email address already in use")
 
     for key, value in patient.model_dump().items():
         setattr(db_patient, key, value)
 
-    db.commit()
-    db.refresh(db_patient)
+    await db.commit()
+    await db.refresh(db_patient)
     return {"i_patient": db_patient.i_patient}
 
 @router.delete("/delete_patient")
 async def delete_patient(
     i_patient: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
-    patient = db.query(Patient).filter(Patient.i_patient == i_patient).first()
+    patient = await db.scalar(select(Patient).where(Patient.i_patient == i_patient))
     if not patient:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Patient not found")
 
-    db.delete(patient)
-    db.commit()
+    await db.delete(patient)
+    await db.commit()
     return {"i_patient": i_patient}
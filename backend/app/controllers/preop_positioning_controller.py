@@ -1,4 +1,5 @@
 from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from app.controllers.auth_controller import require_roles
@@ -8,6 +9,10 @@ from app.services.preop_positioning_service import positioning_handlers, Positio
 from app.database.db_connect import get_db
 from app.models.opplan_model import OperationPlanBone
 from app.models.bone_model import BoneModel
+from app.services.render_service import render_pool, render_positioning_view
+from app.services.state_store import StateConflict
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
 
 router = APIRouter(
     prefix="/preop_bone_positioning",
@@ -41,6 +46,7 @@ surface_sorting = {
 def create_handler(
     i_operation_plan: int,
     view_name: str = Query("top"),
+    seed: int = Query(None),
     db: Session = Depends(get_db),
     _: dict = Depends(require_roles(1, 2))
 ):
@@ -64,7 +70,8 @@ def create_handler(
         handler = PositioningHandler(
             nrrd_path=bone_model.path_to_model,
             axis=axis,
-            descending=descending
+            descending=descending,
+            seed=seed
         )
         positioning_handlers[i_operation_plan] = handler
         return {
@@ -101,6 +108,7 @@ def register_point(
             [data.world_coords.x, data.world_coords.y, data.world_coords.z]
         )
         handler.check_and_compute_prediction_errors()
+        positioning_handlers.persist(data.i_operation_plan)
 
         response = {
             "status": "registered",
@@ -117,6 +125,8 @@ def register_point(
 
         return response
 
+    except StateConflict:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -134,6 +144,7 @@ def get_mean_error(
         raise HTTPException(status_code=400, detail="Prediction points not generated")
 
     handler.check_and_compute_prediction_errors()
+    positioning_handlers.persist(i_operation_plan)
 
     if handler.prediction_errors is None:
         raise HTTPException(status_code=400, detail="Not all prediction points are registered")
@@ -146,7 +157,7 @@ def get_mean_error(
 
 
 @router.get("/get_view")
-def get_view(
+async def get_view(
     i_operation_plan: int,
     view_name: str = Query("front"),
     width: int = Query(1200),
@@ -154,7 +165,8 @@ def get_view(
     db: Session = Depends(get_db),
     _: dict = Depends(require_roles(1, 2))
 ):
-    handler = positioning_handlers.get(i_operation_plan)
+    # An evicted handler is rebuilt on lookup, so keep that off the event loop.
+    handler = await run_in_threadpool(positioning_handlers.get, i_operation_plan)
     if not handler:
         if view_name not in surface_sorting:
             raise HTTPException(status_code=400, detail=f"Invalid view_name: {view_name}")
@@ -168,18 +180,22 @@ def get_view(
         if not bone_model:
             raise HTTPException(status_code=404, detail="Bone model not found")
         try:
-            handler = PositioningHandler(
+            handler = await run_in_threadpool(
+                PositioningHandler,
                 nrrd_path=bone_model.path_to_model,
                 axis=axis,
                 descending=descending
             )
-            positioning_handlers[i_operation_plan] = handler
+            await run_in_threadpool(positioning_handlers.__setitem__, i_operation_plan, handler)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Handler creation failed: {str(e)}")
 
-    handler.set_camera(view_name)
-    handler.render_window.SetSize(width, height)
-    image_bytes = handler.render_png_bytes()
+    try:
+        image_bytes = await render_pool.run(render_positioning_view, handler.get_scene_state(), view_name, width, height)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Rendering the view timed out")
+    except BrokenProcessPool:
+        raise HTTPException(status_code=503, detail="Render workers are unavailable")
     return Response(content=image_bytes, media_type="image/png")
 
 
@@ -244,3 +260,7 @@ def remove_registered_points(
         "deleted_count": deleted
     }
 
+
+@router.get("/handler_metrics")
+def handler_metrics(_: dict = Depends(require_roles(1))):
+    return positioning_handlers.metrics()
@@ -1,17 +1,27 @@
-from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File, Form, Request, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel, Field
-from typing import Annotated
-from app.database.db_connect import get_db, config
+from typing import Annotated, Optional
+from app.database.db_connect import get_async_db, config
 from app.models.prosthesis_model import ProsthesisModel, Bone
 from app.controllers.auth_controller import require_roles
+from app.services.bone_mesh_cache import file_content_hash
+from app.services.mesh_export import mesh_response, LOD_REDUCTIONS
+from app.services.prosthesis_mesh_cache import get_prosthesis_mesh, write_sidecar, delete_sidecar, sidecar_path
+from app.services.blob_store import store_upload, abandon_upload, release_blob, commit_release, remove_blob_file
+from app.services.pagination import keyset_page, InvalidPageRequest, LIST_MAX_LIMIT
+from app.services.prosthesis_catalogue import prosthesis_catalogue
 import os
 
 CURRENT_DIR = os.path.dirname(__file__)
 APP_ROOT = os.path.dirname(CURRENT_DIR)
 PROSTHESIS_STORAGE_DIR = os.path.join(APP_ROOT, config["PROSTHESIS_STORAGE_DIR"])
 ALLOWED_EXTENSIONS = {".obj"}
+PROSTHESIS_MODEL_FIELDS = ["i_3d_prosthesis_model", "i_operation_type", "file_name", "i_bone", "size", "poly", "manufacturer"]
+PROSTHESIS_MODEL_SORTS = {"i_3d_prosthesis_model", "file_name", "size", "manufacturer"}
 os.makedirs(PROSTHESIS_STORAGE_DIR, exist_ok=True)
 
 router = APIRouter(prefix="/3d_prosthesis_models", tags=["3D Prosthesis models"])
@@ -25,15 +35,15 @@ class ProsthesisModelInputForm(BaseModel):
     poly: Annotated[str, Field(min_length=1, max_length=10, strip_whitespace=True)]
     manufacturer: Annotated[str, Field(min_length=1, max_length=100, strip_whitespace=True)]
 
-def prosthesis_model_exists_by_filename(db: Session, file_name: str):
-    return db.query(ProsthesisModel).filter(ProsthesisModel.file_name == file_name).first()
+async def prosthesis_model_exists_by_filename(db: AsyncSession, file_name: str):
+    return await db.scalar(select(ProsthesisModel).where(ProsthesisModel.file_name == file_name))
 
 def is_allowed_file(filename: str) -> bool:
     return any(filename.endswith(ext) for ext in ALLOWED_EXTENSIONS)
 
 @router.get("/get_model")
-async def get_prosthesis_model(i_3d_prosthesis_model: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    model = db.query(ProsthesisModel).filter(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model).first()
+async def get_prosthesis_model(i_3d_prosthesis_model: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    model = await db.scalar(select(ProsthesisModel).where(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model))
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Prosthesis Model not found")
     return {
@@ -56,23 +66,28 @@ async def add_prosthesis_model(
     poly: str = Form(...),
     manufacturer: str = Form(...),
     model_file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
     if not is_allowed_file(file_name):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Only .obj files are allowed")
 
-    if prosthesis_model_exists_by_filename(db, file_name):
+    if await prosthesis_model_exists_by_filename(db, file_name):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Prosthesis model with that file name already exists")
 
-    bone = db.query(Bone).filter(Bone.i_bone == i_bone).first()
+    bone = await db.scalar(select(Bone).where(Bone.i_bone == i_bone))
     if not bone:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bone not found")
 
-    file_path = os.path.join(PROSTHESIS_STORAGE_DIR, file_name)
-    with open(file_path, "wb") as f:
-        while content := await model_file.read(1024 * 1024):
-            f.write(content)
+    blob = await store_upload(db, model_file, file_name)
+    file_path = blob.path
+    # The sidecar sits next to the blob, so identical uploads share it too.
+    if not os.path.exists(sidecar_path(file_path)):
+        try:
+            await run_in_threadpool(write_sidecar, file_path)
+        except Exception as e:
+            await abandon_upload(db, blob)
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Could not parse .obj file: {str(e)}")
 
     new_model = ProsthesisModel(
         i_operation_type=i_operation_type,
@@ -85,8 +100,13 @@ async def add_prosthesis_model(
         path_to_model=file_path
     )
     db.add(new_model)
-    db.commit()
-    db.refresh(new_model)
+    try:
+        await db.commit()
+    except Exception:
+        await abandon_upload(db, blob)
+        raise
+    await db.refresh(new_model)
+    await run_in_threadpool(prosthesis_catalogue.upsert, new_model)
     return {"i_3d_prosthesis_model": new_model.i_3d_prosthesis_model}
 
 @router.put("/update_model")
@@ -97,57 +117,56 @@ async def update_prosthesis_model(
     size: int = Form(...),
     poly: str = Form(...),
     manufacturer: str = Form(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
     if not is_allowed_file(file_name):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Only .obj files are allowed")
 
-    model = db.query(ProsthesisModel).filter(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model).first()
+    model = await db.scalar(select(ProsthesisModel).where(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model))
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Prosthesis Model not found")
 
-    bone = db.query(Bone).filter(Bone.i_bone == i_bone).first()
+    bone = await db.scalar(select(Bone).where(Bone.i_bone == i_bone))
     if not bone:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Bone not found")
 
-    existing = prosthesis_model_exists_by_filename(db, file_name)
+    existing = await prosthesis_model_exists_by_filename(db, file_name)
     if existing and existing.i_3d_prosthesis_model != i_3d_prosthesis_model:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="File name already in use")
 
-    old_file_path = model.path_to_model
-    new_file_path = os.path.join(PROSTHESIS_STORAGE_DIR, file_name)
-    if os.path.exists(old_file_path):
-        os.rename(old_file_path, new_file_path)
-
     model.file_name = file_name
     model.i_bone = i_bone
     model.size = size
     model.poly = poly
     model.manufacturer = manufacturer
-    model.path_to_model = new_file_path
-    db.commit()
-    db.refresh(model)
+    await db.commit()
+    await db.refresh(model)
+    await run_in_threadpool(prosthesis_catalogue.upsert, model)
     return {"i_3d_prosthesis_model": model.i_3d_prosthesis_model}
 
 @router.delete("/delete_model")
-async def delete_prosthesis_model(i_3d_prosthesis_model: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    model = db.query(ProsthesisModel).filter(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model).first()
+async def delete_prosthesis_model(i_3d_prosthesis_model: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    model = await db.scalar(select(ProsthesisModel).where(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model))
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Prosthesis Model not found")
 
-    if os.path.exists(model.path_to_model):
-        os.remove(model.path_to_model)
-    else:
+    if not os.path.exists(model.path_to_model):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model file not found in storage")
 
-    db.delete(model)
-    db.commit()
+    file_path = model.path_to_model
+    tombstone = await release_blob(db, file_path)
+    await db.delete(model)
+    await commit_release(db, file_path, tombstone)
+    await run_in_threadpool(prosthesis_catalogue.remove, i_3d_prosthesis_model)
+    if tombstone:
+        remove_blob_file(file_path, tombstone)
+        delete_sidecar(file_path)
     return {"i_3d_prosthesis_model": i_3d_prosthesis_model}
 
 @router.get("/download_model")
-async def download_prosthesis_model(i_3d_prosthesis_model: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    model = db.query(ProsthesisModel).filter(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model).first()
+async def download_prosthesis_model(i_3d_prosthesis_model: int, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    model = await db.scalar(select(ProsthesisModel).where(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model))
     if not model:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Prosthesis Model not found")
 
@@ -156,57 +175,109 @@ async def download_prosthesis_model(i_3d_prosthesis_model: int, db: Session = De
 
     return FileResponse(model.path_to_model, filename=model.file_name)
 
+@router.get("/download_mesh")
+async def download_prosthesis_mesh(request: Request, i_3d_prosthesis_model: int, lod: int = 0, db: AsyncSession = Depends(get_async_db), _: dict = Depends(require_roles(1, 2))):
+    if lod not in LOD_REDUCTIONS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"lod must be one of: {list(LOD_REDUCTIONS)}")
+
+    model = await db.scalar(select(ProsthesisModel).where(ProsthesisModel.i_3d_prosthesis_model == i_3d_prosthesis_model))
+    if not model:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="3D Prosthesis Model not found")
+
+    if not os.path.exists(model.path_to_model):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model file not found in storage")
+
+    content_hash = await run_in_threadpool(file_content_hash, model.path_to_model)
+    return await mesh_response(request, f"prosthesis-{content_hash}", lambda: get_prosthesis_mesh(model.path_to_model), lod)
+
 @router.get("/list_by_operation_type")
-async def list_by_operation_type(i_operation_type: int, db: Session = Depends(get_db), _: dict = Depends(require_roles(1, 2))):
-    models = db.query(ProsthesisModel).filter(ProsthesisModel.i_operation_type == i_operation_type).all()
+async def list_by_operation_type(
+    response: Response,
+    i_operation_type: int,
+    i_bone: Optional[int] = None,
+    manufacturer: Optional[str] = None,
+    fields: list[str] = Query(None),
+    sort: str = "i_3d_prosthesis_model",
+    descending: bool = False,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    _: dict = Depends(require_roles(1, 2))
+):
+    filters = [ProsthesisModel.i_operation_type == i_operation_type]
+    if i_bone is not None:
+        filters.append(ProsthesisModel.i_bone == i_bone)
+    if manufacturer:
+        filters.append(ProsthesisModel.manufacturer == manufacturer)
 
-    if not models:
+    try:
+        rows, next_cursor = await keyset_page(
+            db, ProsthesisModel, "i_3d_prosthesis_model", PROSTHESIS_MODEL_FIELDS, PROSTHESIS_MODEL_SORTS,
+            fields, sort, descending, filters, limit, cursor
+        )
+    except InvalidPageRequest as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    if not rows and not cursor:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No 3D Prosthesis Models found for the given operation type")
 
-    return [
-        {
-            "i_3d_prosthesis_model": model.i_3d_prosthesis_model,
-            "i_operation_type": model.i_operation_type,
-            "file_name": model.file_name,
-            "i_bone": model.i_bone,
-            "size": model.size,
-            "poly": model.poly,
-            "manufacturer": model.manufacturer
-        }
-        for model in models
-    ]
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
 
 @router.get("/get_model_filtered")
 async def get_model_filtered(
     manufacturer: str = None,
     size: int = None,
     poly: str = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     _: dict = Depends(require_roles(1, 2))
 ):
-    query = db.query(ProsthesisModel)
+    await prosthesis_catalogue.ensure_loaded(db)
+    result = prosthesis_catalogue.search(
+        manufacturer=manufacturer or None,
+        poly=poly or None,
+        size_min=size or None,
+        size_max=size or None,
+        limit=None
+    )
 
-    if manufacturer:
-        query = query.filter(ProsthesisModel.manufacturer == manufacturer)
-    if size:
-        query = query.filter(ProsthesisModel.size == size)
-    if poly:
-        query = query.filter(ProsthesisModel.poly == poly)
+    if not result["items"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No 3D Prosthesis Models found with the given details")
 
-    models = query.all()
+    return result["items"]
 
-    if not models:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No 3D Prosthesis Models found with the given details")
+@router.get("/search")
+async def search_prosthesis_models(
+    i_operation_type: Optional[int] = None,
+    i_bone: Optional[int] = None,
+    poly: Optional[str] = None,
+    manufacturer: Optional[str] = None,
+    manufacturer_prefix: Optional[str] = None,
+    size_min: Optional[int] = None,
+    size_max: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=LIST_MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_async_db),
+    _: dict = Depends(require_roles(1, 2))
+):
+    """
+    Catalogue search for implant selection. All given criteria must match; size_min and
+    size_max are inclusive and manufacturer_prefix is case-insensitive. Returns the total
+    match count, per-value counts (manufacturer, poly, size, i_bone) and one page of items.
+    """
+    if size_min is not None and size_max is not None and size_min > size_max:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="size_min must not exceed size_max")
 
-    return [
-        {
-            "i_3d_prosthesis_model": model.i_3d_prosthesis_model,
-            "i_operation_type": model.i_operation_type,
-            "file_name": model.file_name,
-            "i_bone": model.i_bone,
-            "size": model.size,
-            "poly": model.poly,
-            "manufacturer": model.manufacturer
-        }
-        for model in models
-    ]
+    await prosthesis_catalogue.ensure_loaded(db)
+    return prosthesis_catalogue.search(
+        i_operation_type=i_operation_type,
+        i_bone=i_bone,
+        poly=poly,
+        manufacturer=manufacturer,
+        manufacturer_prefix=manufacturer_prefix,
+        size_min=size_min,
+        size_max=size_max,
+        limit=limit,
+        offset=offset
+    )
@@ -1,4 +1,6 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import json
@@ -6,21 +8,69 @@ import os
 
 
 def load_config():
-    config_path = os.path.join(os.path.dirname(__file__), "..", "config.json")
-    with open(os.path.abspath(config_path), "r") as file:        
+    # APP_CONFIG points at another config.json, e.g. a throwaway one for the tests.
+    config_path = os.environ.get("APP_CONFIG") or os.path.join(os.path.dirname(__file__), "..", "config.json")
+    with open(os.path.abspath(config_path), "r") as file:
             return json.load(file)
 
 config = load_config()
 
+def config_flag(name: str, default: bool) -> bool:
+    # Accepts JSON booleans as well as "true"/"false", "1"/"0", "yes"/"no", "on"/"off".
+    value = config.get(name, default)
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("true", "1", "yes", "on"):
+        return True
+    if text in ("false", "0", "no", "off"):
+        return False
+    raise ValueError(f"{name} must be true or false, got {value!r}")
+
 DATABASE_URL = config["DATABASE_URL"]
 
+# Async drivers for the sync URLs this app is deployed with.
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def derive_async_url(url: str) -> str:
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for '{backend}'; set ASYNC_DATABASE_URL in config.json")
+    return parsed.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = config.get("ASYNC_DATABASE_URL") or derive_async_url(DATABASE_URL)
+DB_POOL_SIZE = int(config.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(config.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_PRE_PING = config_flag("DB_POOL_PRE_PING", True)
+DB_POOL_RECYCLE_S = int(config.get("DB_POOL_RECYCLE_S", 1800))
+
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Used by the async controllers so DB round trips don't block the event loop. Objects
+# stay readable after commit, as responses are built from them once the session is done.
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    pool_recycle=DB_POOL_RECYCLE_S,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,92 @@
+import logging
+import os
+
+from sqlalchemy import inspect, select, update
+from sqlalchemy.engine import Connection, Engine
+
+from app.models.bone_model import BoneModel
+from app.models.dicom_model import DICOM
+from app.models.opplan_model import OperationPlan
+from app.models.patient_model import Patient
+from app.models.prosthesis_model import ProsthesisModel
+from app.services.bone_mesh_cache import file_content_hash
+
+logger = logging.getLogger(__name__)
+
+# create_all only creates missing tables, so columns and indexes added to tables that
+# already exist come in through the steps below. Each step checks the live schema first,
+# skips tables create_all has yet to build, and is safe to run on every startup.
+
+
+def add_column(conn: Connection, table, column_name: str):
+    if column_name in {column["name"] for column in inspect(conn).get_columns(table.name)}:
+        return
+    column = table.c[column_name]
+    preparer = conn.dialect.identifier_preparer
+    conn.exec_driver_sql(
+        f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} "
+        f"{column.type.compile(dialect=conn.dialect)}"
+    )
+    logger.info("Added column %s.%s", table.name, column_name)
+
+
+def create_indexes(conn: Connection, table, *index_names: str):
+    existing = {index["name"] for index in inspect(conn).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in index_names and index.name not in existing:
+            index.create(conn)
+            logger.info("Created index %s on %s", index.name, table.name)
+
+
+def dicom_content_hash(conn: Connection):
+    table = DICOM.__table__
+    if not inspect(conn).has_table(table.name):
+        return
+    add_column(conn, table, "content_hash")
+    add_column(conn, table, "file_size")
+    create_indexes(conn, table, "ix_DICOMs_content_hash")
+
+    rows = conn.execute(
+        select(table.c.i_dicom, table.c.path_to_dicom).where(table.c.content_hash.is_(None))
+    ).all()
+    filled = 0
+    for i_dicom, path in rows:
+        if not os.path.exists(path):
+            logger.warning("DICOM %s: %s is missing, content hash left empty", i_dicom, path)
+            continue
+        conn.execute(
+            update(table).where(table.c.i_dicom == i_dicom)
+            .values(content_hash=file_content_hash(path), file_size=os.path.getsize(path))
+        )
+        filled += 1
+    if filled:
+        logger.info("Backfilled content hashes for %d DICOMs", filled)
+
+
+def list_keyset_indexes(conn: Connection):
+    for model, index_name in [
+        (BoneModel, "ix_bone_models_patient_key"),
+        (OperationPlan, "ix_operation_plans_patient_key"),
+        (Patient, "ix_patients_last_name_key"),
+        (ProsthesisModel, "ix_prosthesis_models_operation_type_key"),
+    ]:
+        if inspect(conn).has_table(model.__tablename__):
+            create_indexes(conn, model.__table__, index_name)
+
+
+def prosthesis_catalogue_indexes(conn: Connection):
+    table = ProsthesisModel.__table__
+    if inspect(conn).has_table(table.name):
+        create_indexes(
+            conn, table,
+            "ix_prosthesis_models_manufacturer_size", "ix_prosthesis_models_poly_size", "ix_prosthesis_models_size"
+        )
+
+
+MIGRATIONS = [dicom_content_hash, list_keyset_indexes, prosthesis_catalogue_indexes]
+
+
+def run_migrations(engine: Engine):
+    with engine.begin() as conn:
+        for migration in MIGRATIONS:
+            migration(conn)
@@ -1,5 +1,7 @@
-from fastapi import FastAPI
-from app.database.db_connect import engine, Base
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
+from app.database.db_connect import engine, async_engine, Base
+from app.database.migrations import run_migrations
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from app.controllers.patient_controller import router as patients_router
@@ -10,18 +12,33 @@ from app.controllers.prosthesis_controller import router as prosthesis_model_rou
 from app.controllers.opplan_controller import router as operation_plan_router
 from app.controllers.op_model_controller import router as op_model_router
 from app.controllers.preop_positioning_controller import router as preop_positioning_router
+from app.services.mesh_jobs import shutdown_mesh_jobs
+from app.services.render_service import render_pool
+from app.services.analysis_channel import analyser_channels
+from app.services.analysis_jobs import shutdown_analysis_jobs
+from app.services.password_service import password_hasher
+from app.services.state_store import StateConflict
 
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    run_migrations(engine)
     Base.metadata.create_all(bind=engine)
+    analyser_channels.open_aio()
     yield
+    await shutdown_analysis_jobs()
+    shutdown_mesh_jobs()
+    render_pool.shutdown()
+    password_hasher.shutdown()
+    await analyser_channels.close()
+    await async_engine.dispose()
 
 app = FastAPI(
     title="RobOp API",
     description="API for managing patients, operations, DICOMs, and 3D models",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.include_router(patients_router)
@@ -34,10 +51,20 @@ app.include_router(op_model_router)
 app.include_router(preop_positioning_router)
 
 
+@app.exception_handler(StateConflict)
+async def state_conflict_handler(request: Request, exc: StateConflict):
+    # Raised by HandlerRegistry.persist when another worker changed the same scene first.
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content={"detail": f"{exc} Reload the scene and retry."}
+    )
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"], 
+    expose_headers=["X-Next-Cursor"],
 )
@@ -0,0 +1,11 @@
+from sqlalchemy import Column, Integer, String, Text, BigInteger
+from app.database.db_connect import Base
+
+
+class Blob(Base):
+    __tablename__ = "Blobs"
+    blob_key = Column(String(60), primary_key=True)
+    content_hash = Column(String(40), nullable=False, index=True)
+    size = Column(BigInteger, nullable=False)
+    path = Column(Text, nullable=False, unique=True)
+    ref_count = Column(Integer, nullable=False, default=0)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Index
 from app.database.db_connect import Base
 
 
@@ -17,3 +17,5 @@ class BoneModel(Base):
     i_file_type = Column(Integer, ForeignKey("File_Types.i_file_type"))
     path_to_model = Column(Text, nullable=False)
     file_name = Column(String(50), nullable=False, unique=True)
+    __table_args__ = (
+        Index("ix_bone_models_patient_key", "i_patient", "i_3d_bone_model"),)
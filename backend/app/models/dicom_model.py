@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, Text, ForeignKey, String
+from sqlalchemy import Column, Integer, Text, ForeignKey, String, BigInteger
 from app.database.db_connect import Base
 
 
@@ -8,4 +8,6 @@ class DICOM(Base):
     i_patient = Column(Integer, ForeignKey("Patients.i_patient"), nullable=False)
     path_to_dicom = Column(Text, nullable=False)
     file_name = Column(String(50), nullable=False, unique=True)
-    i_file_type = Column(Integer, ForeignKey("File_Types.i_file_type"), nullable=False)
\ No newline at end of file
+    i_file_type = Column(Integer, ForeignKey("File_Types.i_file_type"), nullable=False)
+    content_hash = Column(String(40), nullable=True, index=True)
+    file_size = Column(BigInteger, nullable=True)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, PrimaryKeyConstraint
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, PrimaryKeyConstraint, Index
 from sqlalchemy.orm import relationship
 from app.database.db_connect import Base
 
@@ -15,6 +15,8 @@ class OperationPlan(Base):
     i_operation_type = Column(Integer, ForeignKey("Operation_Types.i_operation_type"), nullable=False)
     name = Column(String(100), nullable=False)
     i_patient = Column(Integer, ForeignKey("Patients.i_patient"))
+    __table_args__ = (
+        Index("ix_operation_plans_patient_key", "i_patient", "i_operation_plan"),)
 
 #def __repr__(self):
 #    return f"<OperationPlan(i_operation_plan={self.i_operation_plan}, name='{self.name}')>"
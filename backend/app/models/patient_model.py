@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, Text, TIMESTAMP
+from sqlalchemy import Column, Integer, String, Date, Text, TIMESTAMP, Index
 from datetime import datetime
 from app.database.db_connect import Base
 
@@ -20,3 +20,5 @@ class Patient(Base):
     email_address = Column(String(50), unique=True)
     address = Column(Text)
     date_created = Column(TIMESTAMP, default=datetime.now)
+    __table_args__ = (
+        Index("ix_patients_last_name_key", "last_name", "i_patient"),)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Index
 from app.database.db_connect import Base
 
 
@@ -13,6 +13,11 @@ class ProsthesisModel(Base):
     size = Column(Integer, nullable=False)
     poly = Column(String(10), nullable=False)
     manufacturer = Column(String(100), nullable=False, default='Unknown')
+    __table_args__ = (
+        Index("ix_prosthesis_models_operation_type_key", "i_operation_type", "i_3d_prosthesis_model"),
+        Index("ix_prosthesis_models_manufacturer_size", "manufacturer", "size"),
+        Index("ix_prosthesis_models_poly_size", "poly", "size"),
+        Index("ix_prosthesis_models_size", "size"),)
 
 class Bone(Base):
     __tablename__ = "Bones"
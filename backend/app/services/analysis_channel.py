@@ -0,0 +1,91 @@
+import itertools
+import json
+import threading
+
+import grpc
+from app.database.db_connect import config
+from app.services.dicom_analysis_grpc import dicom_analysis_service_pb2_grpc as pb2_grpc
+
+DICOM_ANALYSER_ADDRESS = config.get("DICOM_ANALYSER_ADDRESS", "10.243.50.135:50051")
+ANALYSIS_CHANNELS = int(config.get("ANALYSIS_CHANNELS", 2))
+ANALYSIS_DEADLINE_S = float(config.get("ANALYSIS_DEADLINE_S", 900))
+ANALYSIS_KEEPALIVE_S = int(config.get("ANALYSIS_KEEPALIVE_S", 30))
+
+# Retries cover connection failures before the server has answered; a stream that has
+# already received data is never replayed.
+SERVICE_CONFIG = {
+    "methodConfig": [{
+        "name": [{"service": "dicom.DICOM_Analyser"}],
+        "waitForReady": True,
+        "retryPolicy": {
+            "maxAttempts": 4,
+            "initialBackoff": "0.5s",
+            "maxBackoff": "8s",
+            "backoffMultiplier": 2,
+            "retryableStatusCodes": ["UNAVAILABLE"],
+        },
+    }]
+}
+
+CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", 500 * 1024 * 1024),
+    ("grpc.max_receive_message_length", 500 * 1024 * 1024),
+    ("grpc.keepalive_time_ms", ANALYSIS_KEEPALIVE_S * 1000),
+    ("grpc.keepalive_timeout_ms", 10 * 1000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.enable_retries", 1),
+    ("grpc.service_config", json.dumps(SERVICE_CONFIG)),
+]
+
+
+class AnalyserChannelPool:
+    """
+    Long-lived channels to the DICOM analyser, handed out round-robin. Each HTTP/2
+    channel multiplexes concurrent calls; several spread load over connections.
+    Sync channels open lazily; grpc.aio channels need a running loop, so open_aio()
+    is called from the app lifespan.
+    """
+
+    def __init__(self, address: str, size: int):
+        self.address = address
+        self.size = size
+        self._channels = []
+        self._aio_channels = []
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def stub(self) -> pb2_grpc.DICOM_AnalyserStub:
+        with self._lock:
+            if not self._channels:
+                self._channels = [
+                    grpc.insecure_channel(self.address, options=CHANNEL_OPTIONS) for _ in range(self.size)
+                ]
+            channel = self._channels[next(self._next) % self.size]
+        return pb2_grpc.DICOM_AnalyserStub(channel)
+
+    def open_aio(self):
+        with self._lock:
+            if not self._aio_channels:
+                self._aio_channels = [
+                    grpc.aio.insecure_channel(self.address, options=CHANNEL_OPTIONS) for _ in range(self.size)
+                ]
+
+    def aio_stub(self) -> pb2_grpc.DICOM_AnalyserStub:
+        with self._lock:
+            if not self._aio_channels:
+                raise RuntimeError("Async analyser channels are not open; call open_aio() first")
+            channel = self._aio_channels[next(self._next) % self.size]
+        return pb2_grpc.DICOM_AnalyserStub(channel)
+
+    async def close(self):
+        with self._lock:
+            channels, self._channels = self._channels, []
+            aio_channels, self._aio_channels = self._aio_channels, []
+        for channel in channels:
+            channel.close()
+        for channel in aio_channels:
+            await channel.close()
+
+
+analyser_channels = AnalyserChannelPool(DICOM_ANALYSER_ADDRESS, ANALYSIS_CHANNELS)
@@ -0,0 +1,159 @@
+import asyncio
+import os
+from collections import OrderedDict
+
+import grpc
+
+from app.database.db_connect import config
+from app.services.bone_mesh_cache import file_content_hash
+from app.services.dicom_analysis_service import (
+    get_dicom_analysis, stream_dicom_analysis_async, NP_STORAGE_DIR, JSON_STORAGE_DIR
+)
+from app.services.mask_store import build_mask_store
+
+ANALYSIS_JOB_CONCURRENCY = int(config.get("ANALYSIS_JOB_CONCURRENCY", 2))
+ANALYSIS_FAILED_JOBS_KEPT = int(config.get("ANALYSIS_FAILED_JOBS_KEPT", 256))
+
+# All job bookkeeping happens on the event loop, so no lock is needed. Only queued and
+# running jobs live in _jobs; a finished one is dropped once its result is on disk, and
+# failed or cancelled ones are kept (up to a limit) so their error can still be reported.
+_jobs = {}                  # content hash -> AnalysisJob
+_failed_jobs = OrderedDict()  # content hash -> AnalysisJob
+_semaphore = None
+_stream_supported = True
+
+
+class AnalysisJob:
+    def __init__(self, content_hash: str):
+        self.content_hash = content_hash
+        self.status = "queued"
+        self.stage = None
+        self.fraction = 0.0
+        self.error = None
+        self.task = None
+
+    def on_progress(self, stage: str, fraction: float):
+        self.stage = stage
+        self.fraction = fraction
+
+    def to_dict(self) -> dict:
+        status = {"status": self.status, "content_hash": self.content_hash}
+        if self.status == "running":
+            status.update(stage=self.stage, fraction=round(self.fraction, 4))
+        if self.error:
+            status["detail"] = self.error
+        return status
+
+
+def result_paths(content_hash: str) -> tuple[str, str]:
+    return (
+        os.path.join(NP_STORAGE_DIR, f"{content_hash}.pb"),
+        os.path.join(JSON_STORAGE_DIR, f"{content_hash}.json")
+    )
+
+
+def has_cached_result(content_hash: str) -> bool:
+    # The JSON is written last, so its presence means the .pb is complete too.
+    return all(os.path.exists(path) for path in result_paths(content_hash))
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(ANALYSIS_JOB_CONCURRENCY)
+    return _semaphore
+
+
+async def _analyse(job: AnalysisJob, i_dicom: int, dicom_file_path: str) -> str:
+    global _stream_supported
+    if _stream_supported:
+        try:
+            pb_path, _ = await stream_dicom_analysis_async(
+                i_dicom, job.content_hash, dicom_file_path, on_progress=job.on_progress
+            )
+            return pb_path
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                raise
+            # An analyser from before AnalyzeStream: use the unary call from now on.
+            _stream_supported = False
+
+    job.on_progress("inference", 0.0)
+    pb_path, _ = await asyncio.to_thread(get_dicom_analysis, i_dicom, job.content_hash, dicom_file_path)
+    return pb_path
+
+
+async def _run(job: AnalysisJob, i_dicom: int, dicom_file_path: str):
+    try:
+        async with _get_semaphore():
+            job.status = "running"
+            try:
+                pb_path = await _analyse(job, i_dicom, dicom_file_path)
+                job.on_progress("masks", 0.0)
+                await asyncio.to_thread(build_mask_store, pb_path, job.content_hash)
+            except asyncio.CancelledError:
+                job.status = "cancelled"
+                raise
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                return
+        job.status = "done"
+    finally:
+        _finish(job)
+
+
+def _finish(job: AnalysisJob):
+    if _jobs.get(job.content_hash) is job:
+        del _jobs[job.content_hash]
+    if job.status != "done":
+        _failed_jobs[job.content_hash] = job
+        _failed_jobs.move_to_end(job.content_hash)
+        while len(_failed_jobs) > ANALYSIS_FAILED_JOBS_KEPT:
+            _failed_jobs.popitem(last=False)
+
+
+async def dicom_content_hash(dicom_file_path: str, content_hash: str = None) -> str:
+    # DICOM rows record their hash on upload; only rows the migration could not backfill need hashing here.
+    if content_hash:
+        return content_hash
+    return await asyncio.to_thread(file_content_hash, dicom_file_path)
+
+
+async def submit_analysis(i_dicom: int, dicom_file_path: str, content_hash: str = None) -> dict:
+    """
+    Queues analysis of a DICOM archive. Archives are keyed by content hash, so resubmitting
+    an unchanged study, or the same study under another i_dicom, reuses the running job
+    or the cached result instead of calling the analyser again.
+    """
+    content_hash = await dicom_content_hash(dicom_file_path, content_hash)
+
+    job = _jobs.get(content_hash)
+    if job:
+        return job.to_dict()
+    if await asyncio.to_thread(has_cached_result, content_hash):
+        return {"status": "done", "content_hash": content_hash}
+
+    _failed_jobs.pop(content_hash, None)
+    job = AnalysisJob(content_hash)
+    _jobs[content_hash] = job
+    job.task = asyncio.create_task(_run(job, i_dicom, dicom_file_path))
+    return job.to_dict()
+
+
+async def get_analysis_status(i_dicom: int, dicom_file_path: str, content_hash: str = None) -> dict:
+    content_hash = await dicom_content_hash(dicom_file_path, content_hash)
+
+    job = _jobs.get(content_hash) or _failed_jobs.get(content_hash)
+    if job:
+        return job.to_dict()
+    if await asyncio.to_thread(has_cached_result, content_hash):
+        return {"status": "done", "content_hash": content_hash}
+    return {"status": "not_started", "content_hash": content_hash}
+
+
+async def shutdown_analysis_jobs():
+    tasks = [job.task for job in list(_jobs.values()) if job.task and not job.task.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,133 @@
+import os
+import uuid
+
+from fastapi import UploadFile
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.db_connect import config
+from app.models.blob_model import Blob
+from app.services.bone_mesh_cache import remember_file_hash, forget_file_hash
+from app.services.upload_service import receive_upload
+
+CURRENT_DIR = os.path.dirname(__file__)
+APP_ROOT = os.path.dirname(CURRENT_DIR)
+DICOM_STORAGE_DIR = os.path.join(APP_ROOT, config["DICOM_STORAGE_DIR"])
+BLOB_STORAGE_DIR = os.path.join(
+    APP_ROOT,
+    config.get("BLOB_STORAGE_DIR", os.path.join(os.path.dirname(os.path.normpath(DICOM_STORAGE_DIR)), "blobs"))
+)
+os.makedirs(BLOB_STORAGE_DIR, exist_ok=True)
+
+
+def blob_path(content_hash: str, extension: str) -> str:
+    # Sharded by the first hash byte so no directory grows unbounded.
+    return os.path.join(BLOB_STORAGE_DIR, content_hash[:2], content_hash + extension)
+
+
+async def _add_ref(db: AsyncSession, blob_key: str, content_hash: str, size: int, path: str) -> Blob:
+    blob = await db.scalar(select(Blob).where(Blob.blob_key == blob_key).with_for_update())
+    if blob:
+        blob.ref_count += 1
+        await db.flush()
+        return blob
+
+    blob = Blob(blob_key=blob_key, content_hash=content_hash, size=size, path=path, ref_count=1)
+    try:
+        db.add(blob)
+        await db.flush()
+    except IntegrityError:
+        # Another worker inserted the same blob between our read and write. Callers add
+        # the reference before any other change, so there is nothing else to lose here.
+        await db.rollback()
+        blob = (await db.execute(select(Blob).where(Blob.blob_key == blob_key).with_for_update())).scalar_one()
+        blob.ref_count += 1
+        await db.flush()
+    return blob
+
+
+async def store_upload(db: AsyncSession, upload: UploadFile, file_name: str, max_bytes: int = None) -> Blob:
+    """
+    Streams upload into the blob store and adds a reference to it in db's transaction.
+    Identical content is kept once: a duplicate upload is discarded and the existing
+    blob's count goes up. The caller commits, or calls abandon_upload on failure.
+    """
+    tmp_path, content_hash, size = await receive_upload(upload, BLOB_STORAGE_DIR, max_bytes)
+    extension = os.path.splitext(file_name)[1].lower()
+    path = blob_path(content_hash, extension)
+    try:
+        blob = await _add_ref(db, content_hash + extension, content_hash, size, path)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    remember_file_hash(path, content_hash)
+    return blob
+
+
+async def abandon_upload(db: AsyncSession, blob: Blob):
+    """Rolls back a reference added by store_upload, removing the file if nothing else uses it."""
+    path = blob.path
+    # The row is still locked by this transaction. With no other reference, move the file
+    # aside before the rollback lets a concurrent upload of the same content check for it.
+    tombstone = _tombstone(path) if blob.ref_count == 1 else None
+    await db.rollback()
+    if tombstone:
+        remove_blob_file(path, tombstone)
+
+
+def _tombstone(path: str) -> str:
+    tombstone = f"{path}.{uuid.uuid4().hex}.deleted"
+    if os.path.exists(path):
+        os.replace(path, tombstone)
+    return tombstone
+
+
+async def release_blob(db: AsyncSession, path: str) -> str | None:
+    """
+    Drops one reference to the file at path in db's transaction. When it was the last one,
+    the file is renamed to a tombstone while the row is still locked and the tombstone path
+    is returned: an upload of the same content waits for that lock and then stores a fresh
+    copy, instead of finding the file just before it is deleted. The caller commits with
+    commit_release, then calls remove_blob_file (and drops anything derived from the file).
+    Files stored before the blob store existed have no Blob row and are always their
+    row's only reference.
+    """
+    blob = await db.scalar(select(Blob).where(Blob.path == path).with_for_update())
+    if blob:
+        blob.ref_count -= 1
+        if blob.ref_count > 0:
+            await db.flush()
+            return None
+        await db.delete(blob)
+        await db.flush()
+    return _tombstone(path)
+
+
+async def blob_content_hash(db: AsyncSession, path: str) -> str | None:
+    """The stored digest of the file at path; None for files from before the blob store."""
+    return await db.scalar(select(Blob.content_hash).where(Blob.path == path))
+
+
+async def commit_release(db: AsyncSession, path: str, tombstone: str | None):
+    """Commits db, putting the file back from its tombstone if the commit fails."""
+    try:
+        await db.commit()
+    except BaseException:
+        if tombstone and os.path.exists(tombstone) and not os.path.exists(path):
+            os.replace(tombstone, path)
+        raise
+
+
+def remove_blob_file(path: str, tombstone: str = None):
+    forget_file_hash(path)
+    target = tombstone or path
+    if os.path.exists(target):
+        os.remove(target)
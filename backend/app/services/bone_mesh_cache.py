@@ -0,0 +1,271 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import SimpleITK as sitk
+import vtk
+import numpy as np
+from vtkmodules.util import numpy_support
+from app.database.db_connect import config
+from app.services import bone_mesh_store
+
+MESH_CACHE_MAX_BYTES = int(config.get("MESH_CACHE_MAX_MB", 1024)) * 1024 * 1024
+
+BONE_MESH_PARAMS = {
+    "gaussian_radius": 1.5,
+    "gaussian_std": 1.0,
+    "contour_value": 0.5,
+    "smooth_iterations": 50,
+    "relaxation_factor": 0.1,
+}
+
+# Every (axis, descending) order positioning samples surface points in.
+SURFACE_SORTINGS = [(axis, descending) for axis in "xyz" for descending in (True, False)]
+AXIS_INDEX = {"x": 0, "y": 1, "z": 2}
+
+_hash_lock = threading.Lock()
+_hash_memo = {}
+
+
+def file_content_hash(path: str) -> str:
+    """BLAKE2b digest of a file, memoized on (path, size, mtime) so repeated lookups skip re-reading it."""
+    stat = os.stat(path)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        memo = _hash_memo.get(path)
+        if memo and memo[0] == stamp:
+            return memo[1]
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()
+
+    with _hash_lock:
+        _hash_memo[path] = (stamp, content_hash)
+    return content_hash
+
+
+def remember_file_hash(path: str, content_hash: str):
+    """Seeds the memo for a file whose digest was computed while writing it."""
+    stat = os.stat(path)
+    with _hash_lock:
+        _hash_memo[path] = ((stat.st_size, stat.st_mtime_ns), content_hash)
+
+
+def forget_file_hash(path: str):
+    with _hash_lock:
+        return _hash_memo.pop(path, (None, None))[1]
+
+
+def params_key(params: dict) -> str:
+    return ",".join(f"{name}={params[name]}" for name in sorted(params))
+
+
+def build_bone_mesh(nrrd_path: str, params: dict = BONE_MESH_PARAMS) -> vtk.vtkPolyData:
+    image = sitk.ReadImage(nrrd_path)
+    np_array = sitk.GetArrayFromImage(image).astype(np.float32)
+    np_array = np.transpose(np_array, (2, 1, 0))
+
+    vtk_image = vtk.vtkImageData()
+    vtk_image.SetSpacing(image.GetSpacing())
+    vtk_image.SetOrigin(image.GetOrigin())
+    vtk_image.SetExtent(0, np_array.shape[0] - 1,
+                        0, np_array.shape[1] - 1,
+                        0, np_array.shape[2] - 1)
+
+    vtk_array = numpy_support.numpy_to_vtk(
+        num_array=np_array.ravel(order='F'),
+        deep=True,
+        array_type=vtk.VTK_FLOAT
+    )
+    vtk_image.GetPointData().SetScalars(vtk_array)
+
+    radius = params["gaussian_radius"]
+    std = params["gaussian_std"]
+    gaussian = vtk.vtkImageGaussianSmooth()
+    gaussian.SetInputData(vtk_image)
+    gaussian.SetRadiusFactors(radius, radius, radius)
+    gaussian.SetStandardDeviations(std, std, std)
+    gaussian.Update()
+
+    contour_filter = vtk.vtkContourFilter()
+    contour_filter.SetInputConnection(gaussian.GetOutputPort())
+    contour_filter.SetValue(0, params["contour_value"])
+    contour_filter.Update()
+
+    smoother = vtk.vtkSmoothPolyDataFilter()
+    smoother.SetInputConnection(contour_filter.GetOutputPort())
+    smoother.SetNumberOfIterations(params["smooth_iterations"])
+    smoother.SetRelaxationFactor(params["relaxation_factor"])
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.BoundarySmoothingOn()
+    smoother.Update()
+
+    center_transform = vtk.vtkTransform()
+    bounds = smoother.GetOutput().GetBounds()
+    center_transform.Translate(
+        -0.5 * (bounds[0] + bounds[1]),
+        -0.5 * (bounds[2] + bounds[3]),
+        -0.5 * (bounds[4] + bounds[5])
+    )
+
+    transform_filter = vtk.vtkTransformPolyDataFilter()
+    transform_filter.SetInputConnection(smoother.GetOutputPort())
+    transform_filter.SetTransform(center_transform)
+    transform_filter.Update()
+
+    return transform_filter.GetOutput()
+
+
+class BoneMeshCache:
+    """
+    Process-wide LRU of centred bone surfaces, keyed by the .nrrd content hash
+    and the meshing parameters, evicted once the resident meshes exceed max_bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.resident_bytes = 0
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def get(self, nrrd_path: str, params: dict = BONE_MESH_PARAMS) -> vtk.vtkPolyData:
+        key = (file_content_hash(nrrd_path), params_key(params))
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        # Only one thread meshes a given volume; the others wait and reuse its result.
+        try:
+            with build_lock:
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                        return self._entries[key][0]
+
+                mesh = bone_mesh_store.load_mesh(*key)
+                if mesh is None:
+                    mesh = build_bone_mesh(nrrd_path, params)
+                    bone_mesh_store.save_mesh(*key, mesh)
+                self._put(key, mesh)
+                return mesh
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+
+    def _put(self, key, mesh: vtk.vtkPolyData):
+        size = mesh.GetActualMemorySize() * 1024
+        with self._lock:
+            self._entries[key] = (mesh, size)
+            self.resident_bytes += size
+            while self.resident_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.resident_bytes -= evicted_size
+
+    def invalidate(self, content_hash: str):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == content_hash]:
+                _, size = self._entries.pop(key)
+                self.resident_bytes -= size
+
+
+bone_mesh_cache = BoneMeshCache(MESH_CACHE_MAX_BYTES)
+
+
+def get_bone_mesh(nrrd_path: str, params: dict = BONE_MESH_PARAMS) -> vtk.vtkPolyData:
+    """
+    Returns the smoothed, centred bone surface for nrrd_path. The result shares
+    its point and cell arrays with the cached mesh, so callers must treat it as read-only.
+    """
+    mesh = vtk.vtkPolyData()
+    mesh.ShallowCopy(bone_mesh_cache.get(nrrd_path, params))
+    return mesh
+
+
+def invalidate_bone_mesh(nrrd_path: str, content_hash: str = None):
+    """
+    Drops every cached and persisted mesh derived from nrrd_path. Pass content_hash once the
+    file has been moved or removed; without it the hash comes from the file itself.
+    """
+    if content_hash is None and os.path.exists(nrrd_path):
+        content_hash = file_content_hash(nrrd_path)
+    memo_hash = forget_file_hash(nrrd_path)
+    content_hash = content_hash or memo_hash
+    if content_hash is None:
+        return
+
+    bone_mesh_cache.invalidate(content_hash)
+    bone_mesh_store.delete_meshes(content_hash)
+
+
+def sorting_name(axis: str, descending: bool) -> str:
+    return f"{axis}_{'desc' if descending else 'asc'}"
+
+
+def surface_candidates(mesh: vtk.vtkPolyData, axis: str, descending: bool) -> np.ndarray:
+    """
+    The points positioning samples from: sorted along axis, one per 1-unit cell of the
+    plane across it, and cut to the first quarter (the top when descending).
+    """
+    axis_index = AXIS_INDEX[axis]
+    grid_axes = [i for i in range(3) if i != axis_index]
+
+    all_points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float64)
+
+    # Stable sort so points sharing a height keep their mesh order, as before.
+    sort_key = -all_points[:, axis_index] if descending else all_points[:, axis_index]
+    sorted_points = all_points[np.argsort(sort_key, kind="stable")]
+
+    # Keep the first (highest) point in each 1-unit cell of the plane across the sort axis.
+    grid_keys = np.rint(sorted_points[:, grid_axes]).astype(np.int64)
+    _, first_indices = np.unique(grid_keys, axis=0, return_index=True)
+    deduped = sorted_points[np.sort(first_indices)]
+
+    cutoff = int(len(deduped) * 0.25)
+    return deduped[:cutoff]
+
+
+def _save_surface_candidates(key: tuple, mesh: vtk.vtkPolyData) -> dict:
+    candidates = {
+        sorting_name(axis, descending): surface_candidates(mesh, axis, descending)
+        for axis, descending in SURFACE_SORTINGS
+    }
+    bone_mesh_store.save_candidates(*key, candidates)
+    return candidates
+
+
+def get_surface_candidates(nrrd_path: str, axis: str, descending: bool, params: dict = BONE_MESH_PARAMS) -> np.ndarray:
+    """surface_candidates of the bone mesh, from the store when a mesh job already computed them."""
+    key = (file_content_hash(nrrd_path), params_key(params))
+    candidates = bone_mesh_store.load_candidates(*key)
+    if candidates is None:
+        candidates = _save_surface_candidates(key, get_bone_mesh(nrrd_path, params))
+    return candidates[sorting_name(axis, descending)]
+
+
+def precompute_bone_mesh(nrrd_path: str, params: dict = BONE_MESH_PARAMS) -> str:
+    """
+    Meshes nrrd_path and prepares its surface candidates in the on-disk store without
+    keeping either resident. Safe to run in a worker process.
+    """
+    key = (file_content_hash(nrrd_path), params_key(params))
+    mesh = None
+    if not bone_mesh_store.has_mesh(*key):
+        mesh = build_bone_mesh(nrrd_path, params)
+        bone_mesh_store.save_mesh(*key, mesh)
+    if not bone_mesh_store.has_candidates(*key):
+        # Read back from the store so the candidates match what handlers will load.
+        _save_surface_candidates(key, bone_mesh_store.load_mesh(*key))
+    return key[0]
+
+
+def has_precomputed_bone_mesh(nrrd_path: str, params: dict = BONE_MESH_PARAMS) -> bool:
+    key = (file_content_hash(nrrd_path), params_key(params))
+    return bone_mesh_store.has_mesh(*key) and bone_mesh_store.has_candidates(*key)
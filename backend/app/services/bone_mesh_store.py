@@ -0,0 +1,107 @@
+import glob
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import vtk
+from app.database.db_connect import config
+
+CURRENT_DIR = os.path.dirname(__file__)
+APP_ROOT = os.path.dirname(CURRENT_DIR)
+BONE_STORAGE_DIR = os.path.join(APP_ROOT, config["BONE_STORAGE_DIR"])
+MESH_STORAGE_DIR = os.path.join(
+    APP_ROOT,
+    config.get("MESH_STORAGE_DIR", os.path.join(os.path.dirname(os.path.normpath(BONE_STORAGE_DIR)), "bone_meshes"))
+)
+os.makedirs(MESH_STORAGE_DIR, exist_ok=True)
+
+
+def mesh_path(content_hash: str, params_key: str) -> str:
+    params_digest = hashlib.blake2b(params_key.encode(), digest_size=6).hexdigest()
+    return os.path.join(MESH_STORAGE_DIR, f"{content_hash}_{params_digest}.vtp")
+
+
+def load_mesh(content_hash: str, params_key: str):
+    path = mesh_path(content_hash, params_key)
+    if not os.path.exists(path):
+        return None
+
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(path)
+    reader.Update()
+    mesh = reader.GetOutput()
+    if mesh.GetNumberOfPoints() == 0:
+        print(f"Warning: discarding unreadable derived mesh {path}")
+        os.remove(path)
+        return None
+    return mesh
+
+
+def save_mesh(content_hash: str, params_key: str, mesh: vtk.vtkPolyData) -> str:
+    path = mesh_path(content_hash, params_key)
+    fd, tmp_path = tempfile.mkstemp(suffix=".vtp", dir=MESH_STORAGE_DIR)
+    os.close(fd)
+
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetFileName(tmp_path)
+    writer.SetInputData(mesh)
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.SetCompressorTypeToZLib()
+    if not writer.Write():
+        os.remove(tmp_path)
+        raise IOError(f"Failed to write derived mesh {path}")
+
+    # Rename last so concurrent readers never see a partially written file.
+    os.replace(tmp_path, path)
+    return path
+
+
+def has_mesh(content_hash: str, params_key: str) -> bool:
+    return os.path.exists(mesh_path(content_hash, params_key))
+
+
+def candidates_path(content_hash: str, params_key: str) -> str:
+    return mesh_path(content_hash, params_key)[:-len(".vtp")] + "_candidates.npz"
+
+
+def load_candidates(content_hash: str, params_key: str) -> dict | None:
+    path = candidates_path(content_hash, params_key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as stored:
+            return {name: stored[name] for name in stored.files}
+    except (OSError, ValueError) as e:
+        print(f"Warning: discarding unreadable surface candidates {path}: {e}")
+        os.remove(path)
+        return None
+
+
+def save_candidates(content_hash: str, params_key: str, candidates: dict) -> str:
+    path = candidates_path(content_hash, params_key)
+    fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=MESH_STORAGE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **candidates)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def has_candidates(content_hash: str, params_key: str) -> bool:
+    return os.path.exists(candidates_path(content_hash, params_key))
+
+
+def delete_meshes(content_hash: str) -> int:
+    """Removes every mesh and surface candidate file derived from content_hash."""
+    removed = 0
+    for pattern in (f"{content_hash}_*.vtp", f"{content_hash}_*_candidates.npz"):
+        for path in glob.glob(os.path.join(MESH_STORAGE_DIR, pattern)):
+            os.remove(path)
+            removed += 1
+    return removed
@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x1c\x64icom_analysis_service.proto\x12\x05\x64icom\"4\n\x0f\x41nalysisRequest\x12\x0f\n\x07i_dicom\x18\x01 \x01(\x05\x12\x10\n\x08zip_data\x18\x02 \x01(\x0c\"4\n\x10\x41nalysisResponse\x12\x0f\n\x07i_dicom\x18\x01 \x01(\x05\x12\x0f\n\x07np_data\x18\x02 \x01(\x0c\x32L\n\x0e\x44ICOM_Analyser\x12:\n\x07\x41nalyze\x12\x16.dicom.AnalysisRequest\x1a\x17.dicom.AnalysisResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x1c\x64icom_analysis_service.proto\x12\x05\x64icom\"4\n\x0f\x41nalysisRequest\x12\x0f\n\x07i_dicom\x18\x01 \x01(\x05\x12\x10\n\x08zip_data\x18\x02 \x01(\x0c\"4\n\x10\x41nalysisResponse\x12\x0f\n\x07i_dicom\x18\x01 \x01(\x05\x12\x0f\n\x07np_data\x18\x02 \x01(\x0c\"W\n\rAnalysisChunk\x12\x0f\n\x07i_dicom\x18\x01 \x01(\x05\x12\x11\n\tzip_chunk\x18\x02 \x01(\x0c\x12\x0e\n\x06offset\x18\x03 \x01(\x04\x12\x12\n\ntotal_size\x18\x04 \x01(\x04\"3\n\x10\x41nalysisProgress\x12\r\n\x05stage\x18\x01 \x01(\t\x12\x10\n\x08\x66raction\x18\x02 \x01(\x02\"r\n\x13\x41nalysisResultChunk\x12\x0f\n\x07i_dicom\x18\x01 \x01(\x05\x12+\n\x08progress\x18\x02 \x01(\x0b\x32\x17.dicom.AnalysisProgressH\x00\x12\x12\n\x08np_chunk\x18\x03 \x01(\x0cH\x00\x42\t\n\x07payload2\x93\x01\n\x0e\x44ICOM_Analyser\x12:\n\x07\x41nalyze\x12\x16.dicom.AnalysisRequest\x1a\x17.dicom.AnalysisResponse\x12\x45\n\rAnalyzeStream\x12\x14.dicom.AnalysisChunk\x1a\x1a.dicom.AnalysisResultChunk(\x01\x30\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -35,6 +35,12 @@ if not _descriptor._USE_C_DESCRIPTORS:
   _globals['_ANALYSISREQUEST']._serialized_end=91
   _globals['_ANALYSISRESPONSE']._serialized_start=93
   _globals['_ANALYSISRESPONSE']._serialized_end=145
-  _globals['_DICOM_ANALYSER']._serialized_start=147
-  _globals['_DICOM_ANALYSER']._serialized_end=223
+  _globals['_ANALYSISCHUNK']._serialized_start=147
+  _globals['_ANALYSISCHUNK']._serialized_end=234
+  _globals['_ANALYSISPROGRESS']._serialized_start=236
+  _globals['_ANALYSISPROGRESS']._serialized_end=287
+  _globals['_ANALYSISRESULTCHUNK']._serialized_start=289
+  _globals['_ANALYSISRESULTCHUNK']._serialized_end=403
+  _globals['_DICOM_ANALYSER']._serialized_start=406
+  _globals['_DICOM_ANALYSER']._serialized_end=553
 # @@protoc_insertion_point(module_scope)
@@ -3,7 +3,7 @@
 import grpc
 import warnings
 
-import dicom_analysis_service_pb2 as dicom__analysis__service__pb2
+from . import dicom_analysis_service_pb2 as dicom__analysis__service__pb2
 
 GRPC_GENERATED_VERSION = '1.71.0'
 GRPC_VERSION = grpc.__version__
@@ -39,6 +39,11 @@ class DICOM_AnalyserStub(object):
                 request_serializer=dicom__analysis__service__pb2.AnalysisRequest.SerializeToString,
                 response_deserializer=dicom__analysis__service__pb2.AnalysisResponse.FromString,
                 _registered_method=True)
+        self.AnalyzeStream = channel.stream_stream(
+                '/dicom.DICOM_Analyser/AnalyzeStream',
+                request_serializer=dicom__analysis__service__pb2.AnalysisChunk.SerializeToString,
+                response_deserializer=dicom__analysis__service__pb2.AnalysisResultChunk.FromString,
+                _registered_method=True)
 
 
 class DICOM_AnalyserServicer(object):
@@ -50,6 +55,12 @@ class DICOM_AnalyserServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def AnalyzeStream(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_DICOM_AnalyserServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -58,6 +69,11 @@ def add_DICOM_AnalyserServicer_to_server(servicer, server):
                     request_deserializer=dicom__analysis__service__pb2.AnalysisRequest.FromString,
                     response_serializer=dicom__analysis__service__pb2.AnalysisResponse.SerializeToString,
             ),
+            'AnalyzeStream': grpc.stream_stream_rpc_method_handler(
+                    servicer.AnalyzeStream,
+                    request_deserializer=dicom__analysis__service__pb2.AnalysisChunk.FromString,
+                    response_serializer=dicom__analysis__service__pb2.AnalysisResultChunk.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'dicom.DICOM_Analyser', rpc_method_handlers)
@@ -95,3 +111,30 @@ class DICOM_Analyser(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def AnalyzeStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/dicom.DICOM_Analyser/AnalyzeStream',
+            dicom__analysis__service__pb2.AnalysisChunk.SerializeToString,
+            dicom__analysis__service__pb2.AnalysisResultChunk.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -0,0 +1,96 @@
+import argparse
+import hashlib
+from concurrent import futures
+
+import grpc
+import numpy as np
+
+from app.services.dicom_analysis_grpc import dicom_analysis_service_pb2 as pb2
+from app.services.dicom_analysis_grpc import dicom_analysis_service_pb2_grpc as pb2_grpc
+from app.services.dicom_analysis_grpc.visualising_scripts import analysis_result_pb2 as result_pb2
+
+RESULT_CHUNK_SIZE = 64 * 1024
+
+
+def build_result(i_dicom: int, digest: bytes, size: int = 256) -> result_pb2.AnalysisResult:
+    """A small but well-formed AnalysisResult whose masks depend on the uploaded bytes."""
+    import cv2
+
+    rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+    result = result_pb2.AnalysisResult(
+        image_path=f"dicom_{i_dicom}", width=size, height=size, total_inference_time=0.01
+    )
+    for instance_id, class_name in enumerate(["femur", "tibia"], start=1):
+        x, y = rng.integers(0, size // 2, size=2)
+        w, h = rng.integers(8, size // 2, size=2)
+        mask = np.zeros((size, size), dtype=np.uint8)
+        mask[y:y + h, x:x + w] = 255
+        ok, png = cv2.imencode(".png", mask)
+        result.instances.add(
+            id=instance_id,
+            class_name=class_name,
+            score=float(rng.uniform(0.5, 1.0)),
+            bbox=result_pb2.AnalysisResult.Rect(x=float(x), y=float(y), width=float(w), height=float(h)),
+            mask_png=png.tobytes()
+        )
+    return result
+
+
+class StubAnalyser(pb2_grpc.DICOM_AnalyserServicer):
+    """Stands in for the analysis server in tests: hashes the upload instead of running inference."""
+
+    def Analyze(self, request, context):
+        result = build_result(request.i_dicom, hashlib.blake2b(request.zip_data).digest())
+        return pb2.AnalysisResponse(i_dicom=request.i_dicom, np_data=result.SerializeToString())
+
+    def AnalyzeStream(self, request_iterator, context):
+        digest = hashlib.blake2b()
+        i_dicom, received = 0, 0
+        for chunk in request_iterator:
+            if chunk.offset != received:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Expected offset {received}, got {chunk.offset}")
+            i_dicom = chunk.i_dicom
+            digest.update(chunk.zip_chunk)
+            received += len(chunk.zip_chunk)
+            yield pb2.AnalysisResultChunk(
+                i_dicom=i_dicom,
+                progress=pb2.AnalysisProgress(stage="receiving", fraction=received / max(chunk.total_size, 1))
+            )
+
+        yield pb2.AnalysisResultChunk(i_dicom=i_dicom, progress=pb2.AnalysisProgress(stage="inference", fraction=1.0))
+
+        data = build_result(i_dicom, digest.digest()).SerializeToString()
+        for start in range(0, len(data), RESULT_CHUNK_SIZE):
+            yield pb2.AnalysisResultChunk(i_dicom=i_dicom, np_chunk=data[start:start + RESULT_CHUNK_SIZE])
+
+
+class UnaryStubAnalyser(StubAnalyser):
+    """Like analysers deployed before AnalyzeStream existed: only the unary Analyze is served."""
+
+    def AnalyzeStream(self, request_iterator, context):
+        context.abort(grpc.StatusCode.UNIMPLEMENTED, "Method not implemented!")
+
+
+def serve(address: str = "127.0.0.1:0", max_workers: int = 4, unary_only: bool = False):
+    """Starts a stub server; returns it with the bound port (address may use port 0)."""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    servicer = UnaryStubAnalyser() if unary_only else StubAnalyser()
+    pb2_grpc.add_DICOM_AnalyserServicer_to_server(servicer, server)
+    port = server.add_insecure_port(address)
+    server.start()
+    return server, port
+
+
+def main():
+    p = argparse.ArgumentParser(description="Run a local stub DICOM analysis server.")
+    p.add_argument("--address", default="127.0.0.1:50051", help="host:port to listen on")
+    p.add_argument("--unary-only", action="store_true", help="reject AnalyzeStream, like older analysers")
+    args = p.parse_args()
+
+    server, port = serve(args.address, unary_only=args.unary_only)
+    print(f"Stub DICOM analyser listening on port {port}")
+    server.wait_for_termination()
+
+
+if __name__ == "__main__":
+    main()
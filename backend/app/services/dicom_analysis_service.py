@@ -1,11 +1,13 @@
-import grpc
+import asyncio
+import json
+import mmap
 import os
-from google.protobuf.json_format import MessageToJson
+import tempfile
 
 from app.services.dicom_analysis_grpc import dicom_analysis_service_pb2 as pb2
-from app.services.dicom_analysis_grpc import dicom_analysis_service_pb2_grpc as pb2_grpc
 from app.services.dicom_analysis_grpc.visualising_scripts import analysis_result_pb2 as result_pb2
 from app.database.db_connect import config
+from app.services.analysis_channel import analyser_channels, ANALYSIS_DEADLINE_S
 
 CURRENT_DIR = os.path.dirname(__file__)
 APP_ROOT = os.path.dirname(CURRENT_DIR)
@@ -14,41 +16,235 @@ JSON_STORAGE_DIR = os.path.join(APP_ROOT, config["JSON_STORAGE_DIR"])
 os.makedirs(NP_STORAGE_DIR, exist_ok=True)
 os.makedirs(JSON_STORAGE_DIR, exist_ok=True)
 
+ANALYSIS_CHUNK_SIZE = int(config.get("ANALYSIS_CHUNK_KB", 1024)) * 1024
+
+def _read_varint(data: bytes, pos: int, end: int) -> tuple[int, int]:
+    value = shift = 0
+    while shift < 64:
+        if pos >= end:
+            raise ValueError("Truncated varint in analysis result")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+    raise ValueError("Varint longer than 64 bits in analysis result")
+
+def _iter_fields(data: bytes, start: int, end: int):
+    """
+    Yields (field number, wire type, value start, value end) for each field in data[start:end].
+    Raises ValueError if a field runs past end, so a truncated or corrupt result is rejected.
+    """
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(data, pos, end)
+        field_number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            _, value_end = _read_varint(data, pos, end)
+        elif wire_type == 1:
+            value_end = pos + 8
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos, end)
+            value_end = pos + length
+        elif wire_type == 5:
+            value_end = pos + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        if field_number == 0 or value_end > end:
+            raise ValueError(f"Malformed field {field_number} at byte {pos} of analysis result")
+        yield field_number, wire_type, pos, value_end
+        pos = value_end
+
+def split_result(data) -> tuple[bytes, list[tuple[bytes, int, int]]]:
+    """
+    Splits a serialized AnalysisResult into its top-level fields without the instances,
+    and for each instance its fields without mask_png plus the mask's (offset, length)
+    in data. Only the small metadata is copied, so data can be an mmap of the .pb.
+    """
+    header = bytearray()
+    instances = []
+    field_start = 0
+    for field_number, wire_type, start, end in _iter_fields(data, 0, len(data)):
+        if field_number != 5 or wire_type != 2:  # AnalysisResult.instances
+            header += data[field_start:end]
+            field_start = end
+            continue
+        metadata = bytearray()
+        span = (0, 0)
+        sub_field_start = start
+        for sub_number, sub_type, sub_start, sub_end in _iter_fields(data, start, end):
+            if sub_number == 5 and sub_type == 2:  # Instance.mask_png
+                span = (sub_start, sub_end - sub_start)
+            else:
+                metadata += data[sub_field_start:sub_end]
+            sub_field_start = sub_end
+        instances.append((bytes(metadata), *span))
+        field_start = end
+    return bytes(header), instances
+
+def write_result_index(pb_path: str, base_name: str) -> str:
+    """
+    Writes base_name.json for the result in pb_path. The .pb is memory-mapped, so the
+    masks are never read into memory.
+    """
+    with open(pb_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return write_index(b"", [], base_name)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header, parts = split_result(data)
+    return write_index(header, parts, base_name)
+
+def write_index(header: bytes, parts: list[tuple[bytes, int, int]], base_name: str) -> str:
+    """
+    Writes base_name.json from split_result output: result and instance metadata plus
+    the byte span of each PNG mask in the .pb, instead of the masks themselves as base64.
+    """
+    result = result_pb2.AnalysisResult.FromString(header)
+    index = {
+        "image_path": result.image_path,
+        "width": result.width,
+        "height": result.height,
+        "total_inference_time": result.total_inference_time,
+        "instances": []
+    }
+    for metadata, offset, length in parts:
+        instance = result_pb2.AnalysisResult.Instance.FromString(metadata)
+        index["instances"].append({
+            "id": instance.id,
+            "class_name": instance.class_name,
+            "score": instance.score,
+            "bbox": {
+                "x": instance.bbox.x,
+                "y": instance.bbox.y,
+                "width": instance.bbox.width,
+                "height": instance.bbox.height
+            },
+            "mask_offset": offset,
+            "mask_length": length
+        })
+
+    json_path = os.path.join(JSON_STORAGE_DIR, f"{base_name}.json")
+    fd, tmp_path = tempfile.mkstemp(dir=JSON_STORAGE_DIR)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as jf:
+            json.dump(index, jf)
+        os.replace(tmp_path, json_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return json_path
+
+def read_result_mask(pb_path: str, json_path: str, instance_id: int) -> bytes:
+    with open(json_path, "r", encoding="utf-8") as jf:
+        index = json.load(jf)
+    instance = next((i for i in index["instances"] if i["id"] == instance_id), None)
+    if instance is None:
+        raise ValueError(f"No instance {instance_id} in analysis result")
+
+    with open(pb_path, "rb") as f:
+        f.seek(instance["mask_offset"])
+        return f.read(instance["mask_length"])
+
 def get_dicom_analysis(i_dicom: int, file_name: str, dicom_file_path: str):
-    with grpc.insecure_channel(
-        '10.243.50.135:50051',
-        options=[
-            ('grpc.max_send_message_length', 500 * 1024 * 1024),
-            ('grpc.max_receive_message_length', 500 * 1024 * 1024)
-        ]
-    ) as channel:
-        stub = pb2_grpc.DICOM_AnalyserStub(channel)
-
-        with open(dicom_file_path, "rb") as f:
-            zip_bytes = f.read()
-
-        request = pb2.AnalysisRequest(
-            i_dicom=i_dicom,
-            zip_data=zip_bytes
-        )
-        response = stub.Analyze(request)
-
-
-        base_name = file_name.removesuffix(".zip")
-        
-
-        pb_path = os.path.join(NP_STORAGE_DIR, f"{base_name}.pb")
-        with open(pb_path, "wb") as np_file:
+    """
+    Unary Analyze, for analysers without AnalyzeStream. The request message has to carry
+    the whole archive, but the result is indexed straight from the response buffer.
+    """
+    stub = analyser_channels.stub()
+
+    with open(dicom_file_path, "rb") as f:
+        zip_bytes = f.read()
+
+    response = stub.Analyze(pb2.AnalysisRequest(i_dicom=i_dicom, zip_data=zip_bytes), timeout=ANALYSIS_DEADLINE_S)
+    del zip_bytes
+    header, parts = split_result(response.np_data)
+
+    base_name = file_name.removesuffix(".zip")
+    pb_path = os.path.join(NP_STORAGE_DIR, f"{base_name}.pb")
+    fd, tmp_path = tempfile.mkstemp(dir=NP_STORAGE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as np_file:
             np_file.write(response.np_data)
+        os.replace(tmp_path, pb_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    json_path = write_index(header, parts, base_name)
+    return pb_path, json_path
+
+def read_zip_chunks(i_dicom: int, dicom_file_path: str, chunk_size: int = ANALYSIS_CHUNK_SIZE):
+    total_size = os.path.getsize(dicom_file_path)
+    offset = 0
+    with open(dicom_file_path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield pb2.AnalysisChunk(i_dicom=i_dicom, zip_chunk=data, offset=offset, total_size=total_size)
+            offset += len(data)
+
+def stream_dicom_analysis(i_dicom: int, base_name: str, dicom_file_path: str, on_progress=None,
+                          chunk_size: int = ANALYSIS_CHUNK_SIZE, stub=None):
+    """
+    Streaming variant of get_dicom_analysis: the zip goes up in chunk_size pieces and the
+    result is written to disk as it arrives, so neither side holds the whole archive or
+    result in one message. Outputs are named base_name.pb / base_name.json, and
+    on_progress(stage, fraction) is called for progress updates.
+    """
+    stub = stub or analyser_channels.stub()
+    pb_path = os.path.join(NP_STORAGE_DIR, f"{base_name}.pb")
+
+    fd, tmp_path = tempfile.mkstemp(dir=NP_STORAGE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as np_file:
+            responses = stub.AnalyzeStream(read_zip_chunks(i_dicom, dicom_file_path, chunk_size), timeout=ANALYSIS_DEADLINE_S)
+            for message in responses:
+                if message.HasField("progress"):
+                    if on_progress:
+                        on_progress(message.progress.stage, message.progress.fraction)
+                else:
+                    np_file.write(message.np_chunk)
+        os.replace(tmp_path, pb_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    json_path = write_result_index(pb_path, base_name)
+    return pb_path, json_path
 
+async def read_zip_chunks_async(i_dicom: int, dicom_file_path: str, chunk_size: int = ANALYSIS_CHUNK_SIZE):
+    total_size = os.path.getsize(dicom_file_path)
+    offset = 0
+    with open(dicom_file_path, "rb") as f:
+        while True:
+            data = await asyncio.to_thread(f.read, chunk_size)
+            if not data:
+                break
+            yield pb2.AnalysisChunk(i_dicom=i_dicom, zip_chunk=data, offset=offset, total_size=total_size)
+            offset += len(data)
 
-        result = result_pb2.AnalysisResult()
-        with open(pb_path, "rb") as f:
-            result.ParseFromString(f.read())
+async def stream_dicom_analysis_async(i_dicom: int, base_name: str, dicom_file_path: str, on_progress=None,
+                                      chunk_size: int = ANALYSIS_CHUNK_SIZE, stub=None):
+    """stream_dicom_analysis on a grpc.aio channel; file I/O runs in worker threads."""
+    stub = stub or analyser_channels.aio_stub()
+    pb_path = os.path.join(NP_STORAGE_DIR, f"{base_name}.pb")
 
-        json_str = MessageToJson(result)
-        json_path = os.path.join(JSON_STORAGE_DIR, f"{base_name}.json")
-        with open(json_path, "w", encoding="utf-8") as jf:
-            jf.write(json_str)
+    fd, tmp_path = tempfile.mkstemp(dir=NP_STORAGE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as np_file:
+            call = stub.AnalyzeStream(read_zip_chunks_async(i_dicom, dicom_file_path, chunk_size), timeout=ANALYSIS_DEADLINE_S)
+            async for message in call:
+                if message.HasField("progress"):
+                    if on_progress:
+                        on_progress(message.progress.stage, message.progress.fraction)
+                else:
+                    await asyncio.to_thread(np_file.write, message.np_chunk)
+        os.replace(tmp_path, pb_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
-        return pb_path, json_path
+    json_path = await asyncio.to_thread(write_result_index, pb_path, base_name)
+    return pb_path, json_path
@@ -0,0 +1,13 @@
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Whether an If-None-Match header value matches etag: "*" or any listed tag, compared
+    weakly (a W/ prefix on either side is ignored), as RFC 9110 asks for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+    etag = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
@@ -0,0 +1,231 @@
+import threading
+import time
+from collections import OrderedDict
+
+from app.services.state_store import StateConflict
+
+
+class HandlerRegistry:
+    """
+    LRU registry of per-operation-plan scene handlers with a memory budget and an idle TTL.
+
+    Handlers report their size through memory_footprint(). When one is evicted, its
+    export_state() is kept as a small tombstone, and the next lookup rebuilds the
+    handler with restore(state), so callers see the handler as if it never left.
+
+    With a StateStore, state written by persist() is shared between workers: a lookup
+    rebuilds handlers another worker created and re-imports state another worker changed.
+    Every path that mutates a handler must call persist(key) once the mutation is done;
+    in this app that is the planning endpoints assign_prosthesis, remove_prosthesis,
+    slide, scale, rotate, set_pose, the interactive WebSocket and restore_positions,
+    and the positioning endpoints register_point and get_mean_error. A change that is
+    never persisted stays on this worker only, and is replaced by the next import of
+    a newer stored version.
+
+    persist() is a compare-and-set on the version this copy was last synced to. When
+    another worker persisted in between, it raises StateConflict and this copy re-imports
+    the stored state on its next lookup, instead of silently overwriting the other change.
+    """
+
+    def __init__(self, name: str, max_bytes: int, idle_ttl: float, restore=None, store=None,
+                 max_tombstones: int = 1024):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.restore = restore
+        self.store = store
+        self.max_tombstones = max_tombstones
+
+        self._entries = OrderedDict()  # key -> [handler, size, last_used, store version]
+        self._tombstones = OrderedDict()
+        self._lock = threading.RLock()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rehydrations = 0
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            self._expire_idle()
+            if key in self._entries or (self.restore is not None and key in self._tombstones):
+                return True
+        return self.store is not None and self.restore is not None and self.store.version(self.name, key) > 0
+
+    def __getitem__(self, key):
+        handler = self.get(key)
+        if handler is None:
+            raise KeyError(key)
+        return handler
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._expire_idle()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._touch(key, entry)
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            return self._refresh(key, entry, default)
+
+        if self.restore is None:
+            return default
+        stored = self.store.get(self.name, key) if self.store is not None else None
+        with self._lock:
+            tombstone = self._tombstones.get(key)
+        # The tombstone wins unless another worker has persisted since it was evicted:
+        # it may hold changes this worker made on top of the stored version.
+        if tombstone is not None and (stored is None or tombstone[0] >= stored[0]):
+            version, state = tombstone
+        elif stored is not None:
+            version, state = stored
+        else:
+            return default
+
+        handler = self.restore(state)
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key][0]
+            self.rehydrations += 1
+            self._insert(key, handler, version)
+        return handler
+
+    def peek(self, key):
+        """
+        Returns the resident handler without asking the store for a newer version, for a
+        caller that persists every change and so learns about other workers' writes from
+        StateConflict. None when the key is not resident or a persist found it out of date.
+        """
+        with self._lock:
+            self._expire_idle()
+            entry = self._entries.get(key)
+            if entry is None or entry[3] == -1:
+                return None
+            self.hits += 1
+            self._touch(key, entry)
+            return entry[0]
+
+    def _refresh(self, key, entry, default):
+        """Re-imports state another worker persisted since this copy was last synced."""
+        handler = entry[0]
+        if self.store is None:
+            return handler
+        if self.store.version(self.name, key) == entry[3]:
+            return handler
+
+        stored = self.store.get(self.name, key)
+        if stored is None:
+            # Removed by another worker.
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._drop(key)
+            return default
+        entry[3], state = stored
+        handler.import_state(state)
+        return handler
+
+    def __setitem__(self, key, handler):
+        version = self.store.put(self.name, key, handler.export_state()) if self.store is not None else 0
+        with self._lock:
+            self._insert(key, handler, version)
+
+    def persist(self, key):
+        """
+        Publishes the handler's current state to the shared store after a mutation.
+        Raises StateConflict if another worker persisted this key since it was last synced.
+        """
+        if self.store is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return
+        try:
+            entry[3] = self.store.put(self.name, key, entry[0].export_state(), expected_version=entry[3])
+        except StateConflict:
+            # Out of date: the next lookup re-imports the stored state.
+            entry[3] = -1
+            raise
+
+    def _insert(self, key, handler, version: int):
+        size = handler.memory_footprint()
+        self._drop(key)
+        self._entries[key] = [handler, size, time.monotonic(), version]
+        self._tombstones.pop(key, None)
+        self.resident_bytes += size
+        self._evict_over_budget()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.resident_bytes -= entry[1]
+        return entry
+
+    def __delitem__(self, key):
+        if not self.pop(key):
+            raise KeyError(key)
+
+    def pop(self, key) -> bool:
+        """Explicit removal: drops the handler and any tombstone, nothing is rehydrated afterwards."""
+        stored = False
+        if self.store is not None:
+            stored = self.store.version(self.name, key) > 0
+            self.store.delete(self.name, key)
+        with self._lock:
+            entry = self._drop(key)
+            tombstone = self._tombstones.pop(key, None)
+            return entry is not None or tombstone is not None or stored
+
+    def take_evicted_state(self, key):
+        with self._lock:
+            tombstone = self._tombstones.pop(key, None)
+        return tombstone[1] if tombstone is not None else None
+
+    def metrics(self) -> dict:
+        with self._lock:
+            self._expire_idle()
+            return {
+                "registry": self.name,
+                "entries": len(self._entries),
+                "tombstones": len(self._tombstones),
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "rehydrations": self.rehydrations,
+            }
+
+    def _touch(self, key, entry):
+        # Re-measure on access: view caches and prosthesis meshes grow and shrink over a session.
+        size = entry[0].memory_footprint()
+        self.resident_bytes += size - entry[1]
+        entry[1] = size
+        entry[2] = time.monotonic()
+        self._entries.move_to_end(key)
+        self._evict_over_budget()
+
+    def _evict(self, key):
+        handler, _size, _last_used, version = self._drop(key)
+        self._tombstones[key] = (version, handler.export_state())
+        while len(self._tombstones) > self.max_tombstones:
+            self._tombstones.popitem(last=False)
+
+    def _evict_over_budget(self):
+        while self.resident_bytes > self.max_bytes and len(self._entries) > 1:
+            self._evict(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _expire_idle(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry[2] > cutoff:
+                break
+            self._evict(key)
+            self.expirations += 1
@@ -0,0 +1,51 @@
+import vtk
+import numpy as np
+from vtkmodules.util import numpy_support
+
+IMAGE_MEDIA_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+def encode_render_window(render_window: vtk.vtkRenderWindow, image_format: str = "png", quality: int = 90) -> bytes:
+    """Grabs the last rendered frame of render_window and encodes it in memory."""
+    if image_format not in IMAGE_MEDIA_TYPES:
+        raise ValueError(f"Unsupported image format '{image_format}'. Use one of: {', '.join(IMAGE_MEDIA_TYPES)}")
+
+    win2img = vtk.vtkWindowToImageFilter()
+    win2img.SetInput(render_window)
+    win2img.ReadFrontBufferOff()
+    win2img.Update()
+
+    if image_format == "webp":
+        return _encode_webp(win2img.GetOutput(), quality)
+
+    if image_format == "jpeg":
+        writer = vtk.vtkJPEGWriter()
+        writer.SetQuality(quality)
+        writer.ProgressiveOff()
+    else:
+        writer = vtk.vtkPNGWriter()
+    writer.SetInputConnection(win2img.GetOutputPort())
+    writer.WriteToMemoryOn()
+    writer.Write()
+    return bytes(memoryview(writer.GetResult()))
+
+
+def _encode_webp(image: vtk.vtkImageData, quality: int) -> bytes:
+    # VTK has no WebP writer; OpenCV is already used for the analysis masks.
+    import cv2
+
+    width, height, _ = image.GetDimensions()
+    components = image.GetPointData().GetScalars().GetNumberOfComponents()
+    pixels = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    pixels = pixels.reshape(height, width, components)[::-1]
+    code = cv2.COLOR_RGBA2BGRA if components == 4 else cv2.COLOR_RGB2BGR
+
+    ok, encoded = cv2.imencode(".webp", cv2.cvtColor(np.ascontiguousarray(pixels), code),
+                               [cv2.IMWRITE_WEBP_QUALITY, quality])
+    if not ok:
+        raise ValueError("WebP encoding failed")
+    return encoded.tobytes()
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+from app.services.dicom_analysis_grpc.visualising_scripts import analysis_result_pb2 as result_pb2
+from app.services.dicom_analysis_service import NP_STORAGE_DIR, JSON_STORAGE_DIR
+
+MASK_ENCODING = "packbits+zlib"
+
+logger = logging.getLogger(__name__)
+
+
+def mask_store_paths(content_hash: str) -> tuple[str, str]:
+    return (
+        os.path.join(NP_STORAGE_DIR, f"{content_hash}.masks"),
+        os.path.join(JSON_STORAGE_DIR, f"{content_hash}.masks.json")
+    )
+
+
+def encode_mask_chunk(crop: np.ndarray) -> bytes:
+    return zlib.compress(np.packbits(crop > 0).tobytes(), 6)
+
+
+def decode_mask_chunk(chunk: bytes, width: int, height: int) -> np.ndarray:
+    bits = np.unpackbits(np.frombuffer(zlib.decompress(chunk), dtype=np.uint8), count=width * height)
+    return bits.reshape(height, width)
+
+
+def build_mask_store(pb_path: str, content_hash: str) -> str:
+    """
+    Decodes every instance's PNG mask once and stores its tight bounding-box crop as
+    one bit per pixel, zlib-compressed. Chunks are concatenated in {hash}.masks; the
+    {hash}.masks.json index gives each chunk's bbox and byte range, so a viewer can
+    fetch any subset of masks with HTTP Range requests.
+    """
+    import cv2
+
+    with open(pb_path, "rb") as f:
+        result = result_pb2.AnalysisResult.FromString(f.read())
+
+    store_path, index_path = mask_store_paths(content_hash)
+    entries = []
+    offset = 0
+    fd, tmp_path = tempfile.mkstemp(dir=NP_STORAGE_DIR)
+    try:
+        with os.fdopen(fd, "wb") as store:
+            for instance in result.instances:
+                mask = cv2.imdecode(np.frombuffer(instance.mask_png, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+                if mask is None:
+                    logger.warning("Failed to decode mask of instance %s in %s", instance.id, pb_path)
+                    continue
+
+                rows = np.flatnonzero(mask.any(axis=1))
+                cols = np.flatnonzero(mask.any(axis=0))
+                if len(rows) == 0:
+                    x = y = width = height = 0
+                    chunk = b""
+                else:
+                    y, x = int(rows[0]), int(cols[0])
+                    height, width = int(rows[-1]) - y + 1, int(cols[-1]) - x + 1
+                    chunk = encode_mask_chunk(mask[y:y + height, x:x + width])
+
+                store.write(chunk)
+                entries.append({
+                    "id": instance.id,
+                    "class_name": instance.class_name,
+                    "score": instance.score,
+                    "x": x, "y": y, "width": width, "height": height,
+                    "offset": offset,
+                    "length": len(chunk)
+                })
+                offset += len(chunk)
+        os.replace(tmp_path, store_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    index = {
+        "width": result.width,
+        "height": result.height,
+        "encoding": MASK_ENCODING,
+        "instances": entries
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=JSON_STORAGE_DIR)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as jf:
+            json.dump(index, jf)
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return index_path
+
+
+def load_mask_index(pb_path: str, content_hash: str) -> dict:
+    """
+    Mask index for a finished analysis. The store is (re)built first if either file is
+    missing, as for results cached before it existed.
+    """
+    store_path, index_path = mask_store_paths(content_hash)
+    if not (os.path.exists(store_path) and os.path.exists(index_path)):
+        build_mask_store(pb_path, content_hash)
+    with open(index_path, "r", encoding="utf-8") as jf:
+        return json.load(jf)
+
+
+def select_masks(index: dict, instance_ids: list[int] = None, class_name: str = None) -> list[dict]:
+    return [
+        entry for entry in index["instances"]
+        if (not instance_ids or entry["id"] in instance_ids)
+        and (class_name is None or entry["class_name"] == class_name)
+    ]
+
+
+def read_mask_stack(content_hash: str, index: dict, entries: list[dict]) -> bytes:
+    """
+    Selected masks in one payload: a 4-byte big-endian length, a JSON header like the
+    index but listing only entries, with offsets relative to the chunk data, then the
+    chunks back to back in that order, each still encoded.
+    """
+    store_path, _ = mask_store_paths(content_hash)
+    parts = []
+    stacked = []
+    offset = 0
+    with open(store_path, "rb") as f:
+        for entry in entries:
+            f.seek(entry["offset"])
+            parts.append(f.read(entry["length"]))
+            stacked.append({**entry, "offset": offset})
+            offset += entry["length"]
+    header = json.dumps({
+        "width": index["width"],
+        "height": index["height"],
+        "encoding": index["encoding"],
+        "instances": stacked
+    }).encode()
+    return struct.pack(">I", len(header)) + header + b"".join(parts)
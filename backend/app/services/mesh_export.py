@@ -0,0 +1,129 @@
+import gzip
+import struct
+import threading
+from collections import OrderedDict
+
+import vtk
+import numpy as np
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+from vtkmodules.util import numpy_support
+
+from app.services.etags import etag_matches
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Fraction of triangles removed by vtkQuadricDecimation at each level of detail.
+LOD_REDUCTIONS = {0: 0.0, 1: 0.5, 2: 0.8, 3: 0.95}
+
+MESH_MAGIC = b"RMSH"
+MESH_FORMAT_VERSION = 1
+FLAG_UINT32_INDICES = 1
+EXPORT_CACHE_ENTRIES = 64
+
+_export_cache = OrderedDict()
+_export_lock = threading.Lock()
+
+
+def decimate_mesh(mesh: vtk.vtkPolyData, lod: int) -> vtk.vtkPolyData:
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputData(mesh)
+    triangles.PassVertsOff()
+    triangles.PassLinesOff()
+    triangles.Update()
+
+    reduction = LOD_REDUCTIONS[lod]
+    if reduction == 0.0:
+        return triangles.GetOutput()
+
+    decimation = vtk.vtkQuadricDecimation()
+    decimation.SetInputConnection(triangles.GetOutputPort())
+    decimation.SetTargetReduction(reduction)
+    decimation.VolumePreservationOn()
+    decimation.Update()
+    return decimation.GetOutput()
+
+
+def encode_mesh(mesh: vtk.vtkPolyData) -> bytes:
+    """
+    Packs a triangle mesh as:
+      header  "RMSH", u16 version, u16 flags, u32 vertex count, u32 triangle count,
+              f32[3] bbox min, f32[3] bbox max   (little-endian, 40 bytes)
+      body    u16[3 * vertices] positions quantized over the bbox,
+              u16 or u32 (flags & 1) [3 * triangles] indices, 4-byte aligned
+    """
+    points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData()).astype(np.float32)
+    faces = numpy_support.vtk_to_numpy(mesh.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+
+    bbox_min = points.min(axis=0)
+    bbox_max = points.max(axis=0)
+    extent = np.where(bbox_max > bbox_min, bbox_max - bbox_min, 1.0)
+    quantized = np.rint((points - bbox_min) / extent * 65535.0).astype("<u2")
+
+    flags = 0
+    if len(points) > 65535:
+        flags |= FLAG_UINT32_INDICES
+        indices = faces.astype("<u4")
+    else:
+        indices = faces.astype("<u2")
+
+    header = struct.pack(
+        "<4sHHII3f3f", MESH_MAGIC, MESH_FORMAT_VERSION, flags, len(points), len(faces),
+        *bbox_min.tolist(), *bbox_max.tolist()
+    )
+    positions = quantized.tobytes()
+    padding = b"\0" * (-len(positions) % 4)
+    return header + positions + padding + indices.tobytes()
+
+
+def pick_encoding(accept_encoding: str) -> str:
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=9)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    return data
+
+
+def export_mesh(cache_key: str, load_mesh, lod: int, encoding: str) -> bytes:
+    """Decimated, packed and compressed mesh, memoized on (cache_key, lod, encoding)."""
+    if lod not in LOD_REDUCTIONS:
+        raise ValueError(f"lod must be one of: {', '.join(map(str, LOD_REDUCTIONS))}")
+
+    key = (cache_key, lod, encoding)
+    with _export_lock:
+        if key in _export_cache:
+            _export_cache.move_to_end(key)
+            return _export_cache[key]
+
+    payload = compress(encode_mesh(decimate_mesh(load_mesh(), lod)), encoding)
+
+    with _export_lock:
+        _export_cache[key] = payload
+        while len(_export_cache) > EXPORT_CACHE_ENTRIES:
+            _export_cache.popitem(last=False)
+    return payload
+
+
+async def mesh_response(request: Request, content_hash: str, load_mesh, lod: int) -> Response:
+    encoding = pick_encoding(request.headers.get("accept-encoding", ""))
+    etag = f'"{content_hash}-{lod}-{encoding}"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "private, max-age=3600"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+
+    payload = await run_in_threadpool(export_mesh, content_hash, load_mesh, lod, encoding)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=payload, media_type="application/octet-stream", headers=headers)
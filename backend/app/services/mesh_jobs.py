@@ -0,0 +1,70 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from app.database.db_connect import config
+from app.services.bone_mesh_cache import precompute_bone_mesh, has_precomputed_bone_mesh
+
+MESH_JOB_WORKERS = int(config.get("MESH_JOB_WORKERS", 1))
+
+_executor = None
+_jobs = {}
+_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn keeps the workers free of the API process' threads and VTK state
+        _executor = ProcessPoolExecutor(
+            max_workers=MESH_JOB_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+def submit_mesh_job(i_3d_bone_model: int, nrrd_path: str):
+    with _lock:
+        previous = _jobs.get(i_3d_bone_model)
+        if previous and previous[0] == nrrd_path and not previous[1].done():
+            return previous[1]
+        if previous:
+            previous[1].cancel()
+        future = _get_executor().submit(precompute_bone_mesh, nrrd_path)
+        _jobs[i_3d_bone_model] = (nrrd_path, future)
+        return future
+
+
+def cancel_mesh_job(i_3d_bone_model: int):
+    with _lock:
+        job = _jobs.pop(i_3d_bone_model, None)
+    if job:
+        job[1].cancel()
+
+
+def get_mesh_job_status(i_3d_bone_model: int, nrrd_path: str) -> dict:
+    with _lock:
+        job = _jobs.get(i_3d_bone_model)
+
+    if job and job[0] == nrrd_path:
+        future = job[1]
+        if future.cancelled():
+            return {"status": "cancelled"}
+        if not future.done():
+            return {"status": "running" if future.running() else "queued"}
+        error = future.exception()
+        if error is not None:
+            return {"status": "failed", "detail": str(error)}
+        return {"status": "done"}
+
+    # No job in this process (e.g. after a restart): the persisted mesh is the source of truth.
+    if has_precomputed_bone_mesh(nrrd_path):
+        return {"status": "done"}
+    return {"status": "not_started"}
+
+
+def shutdown_mesh_jobs():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -1,6 +1,8 @@
-import SimpleITK as sitk
+import hashlib
+import json
+import threading
+from collections import OrderedDict
 import vtk
-from vtkmodules.util import numpy_support
 import numpy as np
 from sqlalchemy.orm import Session
 from app.models.bone_model import BoneModel
@@ -9,8 +11,14 @@ from app.models.opplan_model import OperationPlanBone, OperationPlanProsthesis
 from app.models.opplan_scene_model import OperationPlanScenes
 from vtkmodules.vtkCommonTransforms import vtkTransform
 from scipy.spatial.transform import Rotation as R
+from app.services.bone_mesh_cache import get_bone_mesh
+from app.services.prosthesis_mesh_cache import get_prosthesis_mesh
+from app.services.image_encoding import encode_render_window
+from app.services.handler_registry import HandlerRegistry
+from app.services.state_store import state_store
+from app.database.db_connect import config
 
-scene_handlers = {}
+VIEW_CACHE_ENTRIES = 12
 
 class ModelHandler:
     def __init__(self, bone_model_path: str):
@@ -20,6 +28,9 @@ class ModelHandler:
         self.bone_actor = None
         self.prosthesis_model = None
         self.prosthesis_actor = None
+        self.view_cache = OrderedDict()
+        self._view_cache_lock = threading.Lock()
+        self._pose_lock = threading.RLock()
 
         self.renderer = vtk.vtkRenderer()
         self.render_window = vtk.vtkRenderWindow()
@@ -34,57 +45,7 @@ class ModelHandler:
         self.set_camera("front")
 
     def load_bone_model(self):
-        image = sitk.ReadImage(self.bone_model_path)
-        np_array = sitk.GetArrayFromImage(image).astype(np.float32)
-        np_array = np.transpose(np_array, (2, 1, 0))
-
-        vtk_image = vtk.vtkImageData()
-        vtk_image.SetSpacing(image.GetSpacing())
-        vtk_image.SetOrigin(image.GetOrigin())
-        vtk_image.SetExtent(0, np_array.shape[0] - 1,
-                            0, np_array.shape[1] - 1,
-                            0, np_array.shape[2] - 1)
-
-        vtk_array = numpy_support.numpy_to_vtk(
-            num_array=np_array.ravel(order='F'),
-            deep=True,
-            array_type=vtk.VTK_FLOAT
-        )
-        vtk_image.GetPointData().SetScalars(vtk_array)
-
-        gaussian = vtk.vtkImageGaussianSmooth()
-        gaussian.SetInputData(vtk_image)
-        gaussian.SetRadiusFactors(1.5, 1.5, 1.5)
-        gaussian.SetStandardDeviations(1.0, 1.0, 1.0)
-        gaussian.Update()
-
-        contour_filter = vtk.vtkContourFilter()
-        contour_filter.SetInputConnection(gaussian.GetOutputPort())
-        contour_filter.SetValue(0, 0.5)
-        contour_filter.Update()
-
-        smoother = vtk.vtkSmoothPolyDataFilter()
-        smoother.SetInputConnection(contour_filter.GetOutputPort())
-        smoother.SetNumberOfIterations(50)
-        smoother.SetRelaxationFactor(0.1)
-        smoother.FeatureEdgeSmoothingOff()
-        smoother.BoundarySmoothingOn()
-        smoother.Update()
-
-        center_transform = vtk.vtkTransform()
-        bounds = smoother.GetOutput().GetBounds()
-        center_transform.Translate(
-            -0.5 * (bounds[0] + bounds[1]),
-            -0.5 * (bounds[2] + bounds[3]),
-            -0.5 * (bounds[4] + bounds[5])
-        )
-
-        transform_filter = vtk.vtkTransformPolyDataFilter()
-        transform_filter.SetInputConnection(smoother.GetOutputPort())
-        transform_filter.SetTransform(center_transform)
-        transform_filter.Update()
-
-        self.bone_model = transform_filter.GetOutput()
+        self.bone_model = get_bone_mesh(self.bone_model_path)
 
         bone_mapper = vtk.vtkPolyDataMapper()
         bone_mapper.SetInputData(self.bone_model)
@@ -96,10 +57,7 @@ class ModelHandler:
 
     def load_prosthesis_model(self, prosthesis_model_path: str):
         self.prosthesis_model_path = prosthesis_model_path
-        reader = vtk.vtkOBJReader()
-        reader.SetFileName(self.prosthesis_model_path)
-        reader.Update()
-        self.prosthesis_model = reader.GetOutput()
+        self.prosthesis_model = get_prosthesis_mesh(self.prosthesis_model_path)
 
         prosthesis_mapper = vtk.vtkPolyDataMapper()
         prosthesis_mapper.SetInputData(self.prosthesis_model)
@@ -118,6 +76,7 @@ class ModelHandler:
 
         if self.prosthesis_actor and self.prosthesis_actor not in self.renderer.GetActors():
             self.renderer.AddActor(self.prosthesis_actor)
+        self.invalidate_views()
 
     def remove_prosthesis_from_scene(self):
         if self.prosthesis_actor and self.prosthesis_actor in self.renderer.GetActors():
@@ -125,6 +84,7 @@ class ModelHandler:
         self.prosthesis_model = None
         self.prosthesis_actor = None
         self.prosthesis_model_path = None
+        self.invalidate_views()
 
 
     def set_camera(self, view="front"):
@@ -144,19 +104,14 @@ class ModelHandler:
         self.renderer.SetActiveCamera(camera)
         self.renderer.ResetCamera()
 
-    def render_to_image(self, filepath: str):
+    def render_image_bytes(self, image_format: str = "png", quality: int = 90) -> bytes:
         self.render_window.SetOffScreenRendering(1)
         self.render_window.Render()
+        return encode_render_window(self.render_window, image_format, quality)
 
-        window_to_image_filter = vtk.vtkWindowToImageFilter()
-        window_to_image_filter.SetInput(self.render_window)
-        window_to_image_filter.ReadFrontBufferOff()
-        window_to_image_filter.Update()
-
-        writer = vtk.vtkPNGWriter()
-        writer.SetFileName(filepath)
-        writer.SetInputConnection(window_to_image_filter.GetOutputPort())
-        writer.Write()
+    def render_to_image(self, filepath: str):
+        with open(filepath, "wb") as f:
+            f.write(self.render_image_bytes("png"))
 
     def slide_prosthesis_up(self, value): self._translate_prosthesis(0, 0, value)
     def slide_prosthesis_down(self, value): self._translate_prosthesis(0, 0, -value)
@@ -176,6 +131,7 @@ class ModelHandler:
         transform.Translate(x, y, z)
 
         self.prosthesis_actor.SetUserTransform(transform)
+        self.invalidate_views()
 
     def scale_prosthesis(self, scale_x: float, scale_y: float, scale_z: float):
         """
@@ -199,6 +155,7 @@ class ModelHandler:
         new_transform.Scale(scale_x, scale_y, scale_z) 
 
         self.prosthesis_actor.SetUserTransform(new_transform)
+        self.invalidate_views()
 
     def rotate_prosthesis(self, axis: str, angle: float):
         if not self.prosthesis_actor:
@@ -223,6 +180,7 @@ class ModelHandler:
             new_transform.RotateZ(angle)
 
         self.prosthesis_actor.SetUserTransform(new_transform)
+        self.invalidate_views()
 
     def get_actor_matrix(self, actor: vtk.vtkActor) -> list[float]:
         transform = actor.GetUserTransform()
@@ -241,6 +199,7 @@ class ModelHandler:
         transform = vtk.vtkTransform()
         transform.SetMatrix(vtk_matrix)
         actor.SetUserTransform(transform)
+        self.invalidate_views()
 
     def get_prosthesis_matrix(self) -> list[float]:
         if not self.prosthesis_actor:
@@ -260,6 +219,98 @@ class ModelHandler:
     def set_bone_matrix(self, matrix: list[float]):
         self.set_actor_matrix(self.bone_actor, matrix)
 
+    def scene_state_hash(self, state: dict = None) -> str:
+        state = json.dumps(state or self.get_scene_state(), sort_keys=True)
+        return hashlib.blake2b(state.encode(), digest_size=16).hexdigest()
+
+    def view_etag(self, view_name: str, width: int, height: int, image_format: str, quality: int,
+                  state: dict = None) -> str:
+        """ETag of a view of state, a get_scene_state() snapshot; the current state when omitted."""
+        view_key = f"{self.scene_state_hash(state)}:{view_name}:{width}x{height}:{image_format}:{quality}"
+        return '"' + hashlib.blake2b(view_key.encode(), digest_size=16).hexdigest() + '"'
+
+    def get_cached_view(self, etag: str):
+        with self._view_cache_lock:
+            if etag not in self.view_cache:
+                return None
+            self.view_cache.move_to_end(etag)
+            return self.view_cache[etag]
+
+    def cache_view(self, etag: str, image_bytes: bytes):
+        with self._view_cache_lock:
+            self.view_cache[etag] = image_bytes
+            while len(self.view_cache) > VIEW_CACHE_ENTRIES:
+                self.view_cache.popitem(last=False)
+
+    def invalidate_views(self):
+        with self._view_cache_lock:
+            self.view_cache.clear()
+
+    def apply_pose(self, prosthesis_matrix: list[float] = None, bone_matrix: list[float] = None):
+        """
+        Sets absolute prosthesis and/or bone matrices together, so readers of the
+        scene state never observe one applied without the other.
+        """
+        if prosthesis_matrix is not None and not self.prosthesis_actor:
+            raise ValueError("No prosthesis model is currently loaded in the scene to position.")
+
+        with self._pose_lock:
+            if bone_matrix is not None:
+                self.set_bone_matrix(bone_matrix)
+            if prosthesis_matrix is not None:
+                self.set_prosthesis_matrix(prosthesis_matrix)
+
+    def get_scene_state(self) -> dict:
+        with self._pose_lock:
+            return {
+                "bone_model_path": self.bone_model_path,
+                "bone_matrix": self.get_bone_matrix(),
+                "prosthesis_model_path": self.prosthesis_model_path if self.prosthesis_actor else None,
+                "prosthesis_matrix": self.get_prosthesis_matrix(),
+            }
+
+    def apply_scene_state(self, state: dict):
+        self.set_bone_matrix(state["bone_matrix"])
+        if state["prosthesis_model_path"]:
+            self.add_prosthesis_to_scene(state["prosthesis_model_path"])
+            self.set_prosthesis_matrix(state["prosthesis_matrix"])
+        else:
+            self.remove_prosthesis_from_scene()
+
+    def export_state(self) -> dict:
+        return self.get_scene_state()
+
+    def import_state(self, state: dict):
+        with self._pose_lock:
+            self.apply_scene_state(state)
+
+    def memory_footprint(self) -> int:
+        """Approximate bytes held by this handler: meshes, framebuffer and cached views."""
+        size = self.bone_model.GetActualMemorySize() * 1024
+        if self.prosthesis_model is not None:
+            size += self.prosthesis_model.GetActualMemorySize() * 1024
+        width, height = self.render_window.GetSize()
+        size += width * height * 4 * 2
+        with self._view_cache_lock:
+            size += sum(len(image) for image in self.view_cache.values())
+        return size
+
+
+def restore_model_handler(state: dict) -> ModelHandler:
+    handler = ModelHandler(state["bone_model_path"])
+    handler.apply_scene_state(state)
+    return handler
+
+
+# Evicted scenes keep their unsaved pose and come back through restore_model_handler on next use.
+scene_handlers = HandlerRegistry(
+    "planning",
+    max_bytes=int(config.get("SCENE_HANDLERS_MAX_MB", 2048)) * 1024 * 1024,
+    idle_ttl=float(config.get("HANDLER_IDLE_TTL_S", 3600)),
+    restore=restore_model_handler,
+    store=state_store
+)
+
 
 def create_model_handler(i_operation_plan: int, db: Session):
     if i_operation_plan in scene_handlers:
@@ -304,8 +355,7 @@ def create_model_handler(i_operation_plan: int, db: Session):
     return handler
 
 def remove_model_handler(i_operation_plan: int):
-    if i_operation_plan in scene_handlers:
-        del scene_handlers[i_operation_plan]
+    scene_handlers.pop(i_operation_plan)
 
 
 def restore_positions(i_operation_plan: int, db: Session):
@@ -349,6 +399,7 @@ def restore_positions(i_operation_plan: int, db: Session):
     else:
         handler.remove_prosthesis_from_scene()
 
+    scene_handlers.persist(i_operation_plan)
     return {"status": "positions restored"}
 
 def decompose_matrix(matrix: list[float]):
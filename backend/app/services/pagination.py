@@ -0,0 +1,91 @@
+import base64
+import json
+
+from sqlalchemy import select, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.db_connect import config
+
+LIST_DEFAULT_LIMIT = int(config.get("LIST_DEFAULT_LIMIT", 500))
+LIST_MAX_LIMIT = int(config.get("LIST_MAX_LIMIT", 1000))
+
+
+class InvalidPageRequest(ValueError):
+    pass
+
+
+def encode_cursor(sort: str, descending: bool, value, key) -> str:
+    raw = json.dumps([sort, descending, value, key], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort, descending, value, key = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidPageRequest("Malformed cursor")
+    return sort, descending, value, key
+
+
+async def keyset_page(
+    db: AsyncSession,
+    model,
+    key: str,
+    fields: list[str],
+    sortable: set[str],
+    requested_fields: list[str] = None,
+    sort: str = None,
+    descending: bool = False,
+    filters: list = (),
+    limit: int = None,
+    cursor: str = None
+) -> tuple[list[dict], str | None]:
+    """
+    One page of model rows ordered by (sort, key), selecting only the requested columns
+    as plain tuples. The cursor carries the last row's (sort, key) values, so each page
+    is an index range scan no matter how deep it is. Returns (rows, next cursor or None).
+
+    With neither limit nor cursor every row is returned, as the list endpoints did before
+    they were paged; a cursor without a limit continues in pages of LIST_DEFAULT_LIMIT.
+    """
+    sort = sort or key
+    if sort not in sortable:
+        raise InvalidPageRequest(f"sort must be one of: {sorted(sortable)}")
+    requested_fields = requested_fields or fields
+    unknown = [name for name in requested_fields if name not in fields]
+    if unknown:
+        raise InvalidPageRequest(f"Unknown fields {unknown}; choose from: {fields}")
+    if limit is None and cursor:
+        limit = LIST_DEFAULT_LIMIT
+    if limit is not None and not 1 <= limit <= LIST_MAX_LIMIT:
+        raise InvalidPageRequest(f"limit must be between 1 and {LIST_MAX_LIMIT}")
+
+    columns = model.__table__.c
+    sort_column, key_column = columns[sort], columns[key]
+    selected = list(dict.fromkeys([*requested_fields, sort, key]))
+    query = select(*(columns[name] for name in selected)).where(*filters)
+
+    if cursor:
+        cursor_sort, cursor_descending, value, last_key = decode_cursor(cursor)
+        if cursor_sort != sort or cursor_descending != descending:
+            raise InvalidPageRequest("Cursor was issued for a different sort order")
+        if descending:
+            query = query.where(or_(sort_column < value, and_(sort_column == value, key_column < last_key)))
+        else:
+            query = query.where(or_(sort_column > value, and_(sort_column == value, key_column > last_key)))
+
+    if descending:
+        query = query.order_by(sort_column.desc(), key_column.desc())
+    else:
+        query = query.order_by(sort_column, key_column)
+
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = (await db.execute(query)).all()
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]._mapping
+        next_cursor = encode_cursor(sort, descending, last[sort], last[key])
+    return [{name: row._mapping[name] for name in requested_fields} for row in rows], next_cursor
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.hash import argon2 as argon2_default
+
+from app.database.db_connect import config
+
+# Unset costs fall back to passlib's own defaults, which existing hashes were made with,
+# so verify() only rehashes after an operator changes one of these.
+ARGON2_TIME_COST = int(config.get("ARGON2_TIME_COST", argon2_default.default_rounds))
+ARGON2_MEMORY_COST_KB = int(config.get("ARGON2_MEMORY_COST_KB", argon2_default.memory_cost))
+ARGON2_PARALLELISM = int(config.get("ARGON2_PARALLELISM", argon2_default.parallelism))
+PASSWORD_HASH_WORKERS = int(config.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_MAX_WAITING = int(config.get("PASSWORD_HASH_MAX_WAITING", 64))
+PASSWORD_HASH_WAIT_S = float(config.get("PASSWORD_HASH_WAIT_S", 10))
+
+argon2 = argon2_default.using(
+    time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST_KB, parallelism=ARGON2_PARALLELISM
+)
+
+
+class PasswordHasherBusy(ValueError):
+    pass
+
+
+class PasswordHasher:
+    """
+    Runs argon2 on a small dedicated thread pool (argon2-cffi releases the GIL), so a
+    burst of logins can't occupy the event loop or the default threadpool. At most
+    `workers` hashes run at once; up to `max_waiting` more queue for at most `max_wait_s`,
+    and anything beyond that is refused with PasswordHasherBusy instead of piling up.
+    """
+
+    def __init__(self, workers: int, max_waiting: int, max_wait_s: float):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.max_wait_s = max_wait_s
+        self._executor = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.wait_total_s = 0.0
+        self.wait_max_s = 0.0
+        self.run_total_s = 0.0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="argon2")
+            return self._executor
+
+    async def _run(self, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise PasswordHasherBusy("Too many password operations in progress, try again shortly")
+
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait_s)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PasswordHasherBusy("Timed out waiting for a password worker, try again shortly")
+        finally:
+            self.waiting -= 1
+
+        waited = time.perf_counter() - queued
+        self.wait_total_s += waited
+        self.wait_max_s = max(self.wait_max_s, waited)
+        self.running += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool(), fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.run_total_s += time.perf_counter() - started
+            self._semaphore.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(argon2.hash, password)
+
+    async def verify(self, password: str, password_hash: str) -> tuple[bool, str | None]:
+        """
+        Checks password against password_hash. When it matches a hash made with other
+        cost parameters, also returns a fresh hash for the caller to store.
+        """
+        ok, new_hash = await self._run(_verify_and_upgrade, password, password_hash)
+        if new_hash:
+            self.rehashed += 1
+        return ok, new_hash
+
+    def metrics(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "avg_wait_ms": round(1000 * self.wait_total_s / max(self.completed, 1), 2),
+            "max_wait_ms": round(1000 * self.wait_max_s, 2),
+            "avg_run_ms": round(1000 * self.run_total_s / max(self.completed, 1), 2),
+            "cost": {"time_cost": ARGON2_TIME_COST, "memory_cost_kb": ARGON2_MEMORY_COST_KB, "parallelism": ARGON2_PARALLELISM}
+        }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _verify_and_upgrade(password: str, password_hash: str) -> tuple[bool, str | None]:
+    try:
+        if not argon2.verify(password, password_hash):
+            return False, None
+    except ValueError:
+        # Not an argon2 hash at all.
+        return False, None
+    return True, argon2.hash(password) if argon2.needs_update(password_hash) else None
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_WAITING, PASSWORD_HASH_WAIT_S)
@@ -1,16 +1,18 @@
 import vtk
 import numpy as np
-import SimpleITK as sitk
-from vtkmodules.util import numpy_support
-import random
-
-positioning_handlers = {}
+from app.services.bone_mesh_cache import get_bone_mesh, get_surface_candidates, AXIS_INDEX
+from app.services.image_encoding import encode_render_window
+from app.services.handler_registry import HandlerRegistry
+from app.services.state_store import state_store
+from app.database.db_connect import config
 
 class PositioningHandler:
-    def __init__(self, nrrd_path, axis="z", descending=True):
+    def __init__(self, nrrd_path, axis="z", descending=True, seed=None):
         self.bone_model_path = nrrd_path
         self.sort_axis = axis
         self.sort_descending = descending
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
 
         self.bone_model = None
         self.bone_actor = None
@@ -33,57 +35,7 @@ class PositioningHandler:
         self.set_camera("front")
 
     def load_bone_model(self):
-        image = sitk.ReadImage(self.bone_model_path)
-        np_array = sitk.GetArrayFromImage(image).astype(np.float32)
-        np_array = np.transpose(np_array, (2, 1, 0))
-
-        vtk_image = vtk.vtkImageData()
-        vtk_image.SetSpacing(image.GetSpacing())
-        vtk_image.SetOrigin(image.GetOrigin())
-        vtk_image.SetExtent(0, np_array.shape[0] - 1,
-                            0, np_array.shape[1] - 1,
-                            0, np_array.shape[2] - 1)
-
-        vtk_array = numpy_support.numpy_to_vtk(
-            num_array=np_array.ravel(order='F'),
-            deep=True,
-            array_type=vtk.VTK_FLOAT
-        )
-        vtk_image.GetPointData().SetScalars(vtk_array)
-
-        gaussian = vtk.vtkImageGaussianSmooth()
-        gaussian.SetInputData(vtk_image)
-        gaussian.SetRadiusFactors(1.5, 1.5, 1.5)
-        gaussian.SetStandardDeviations(1.0, 1.0, 1.0)
-        gaussian.Update()
-
-        contour_filter = vtk.vtkContourFilter()
-        contour_filter.SetInputConnection(gaussian.GetOutputPort())
-        contour_filter.SetValue(0, 0.5)
-        contour_filter.Update()
-
-        smoother = vtk.vtkSmoothPolyDataFilter()
-        smoother.SetInputConnection(contour_filter.GetOutputPort())
-        smoother.SetNumberOfIterations(50)
-        smoother.SetRelaxationFactor(0.1)
-        smoother.FeatureEdgeSmoothingOff()
-        smoother.BoundarySmoothingOn()
-        smoother.Update()
-
-        center_transform = vtk.vtkTransform()
-        bounds = smoother.GetOutput().GetBounds()
-        center_transform.Translate(
-            -0.5 * (bounds[0] + bounds[1]),
-            -0.5 * (bounds[2] + bounds[3]),
-            -0.5 * (bounds[4] + bounds[5])
-        )
-
-        transform_filter = vtk.vtkTransformPolyDataFilter()
-        transform_filter.SetInputConnection(smoother.GetOutputPort())
-        transform_filter.SetTransform(center_transform)
-        transform_filter.Update()
-
-        self.bone_model = transform_filter.GetOutput()
+        self.bone_model = get_bone_mesh(self.bone_model_path)
         self.surface_points = self._sample_surface_points(
             10, axis=self.sort_axis, descending=self.sort_descending
         )
@@ -99,45 +51,19 @@ class PositioningHandler:
         self.bone_actor.GetProperty().SetSpecular(0.4)
         self.bone_actor.GetProperty().SetSpecularPower(20)
 
-    def _sample_surface_points(self, num, axis="z", descending=True):
-        axis_map = {"x": 0, "y": 1, "z": 2}
-        if axis not in axis_map:
+    def _sample_surface_points(self, num, axis="z", descending=True, seed=None):
+        if axis not in AXIS_INDEX:
             raise ValueError("axis must be one of: 'x', 'y', 'z'")
-        axis_index = axis_map[axis]
-
-        all_points = [
-            np.array(self.bone_model.GetPoint(i))
-            for i in range(self.bone_model.GetNumberOfPoints())
-        ]
-
-        sorted_points = sorted(
-            all_points,
-            key=lambda pt: pt[axis_index],
-            reverse=descending
-        )
-
-        seen_keys = set()
-        deduped = []
-        for pt in sorted_points:
-            if axis == "z":
-                key = (int(round(pt[0])), int(round(pt[1])))
-            elif axis == "y":
-                key = (int(round(pt[0])), int(round(pt[2])))
-            else:
-                key = (int(round(pt[1])), int(round(pt[2])))
-            if key not in seen_keys:
-                seen_keys.add(key)
-                deduped.append(pt)
 
-        cutoff = int(len(deduped) * 0.25)
-        upper_quartile = deduped[:cutoff]
+        upper_quartile = get_surface_candidates(self.bone_model_path, axis, descending)
         if len(upper_quartile) < num:
             raise ValueError(
                 f"Only {len(upper_quartile)} unique points; can't select {num}."
             )
 
-        selected = random.sample(upper_quartile, num)
-        return selected
+        rng = self.rng if seed is None else np.random.default_rng(seed)
+        selected = rng.choice(len(upper_quartile), size=num, replace=False)
+        return list(upper_quartile[selected])
 
     def _generate_predictions(self):
         self.prediction_points = [(10 + i, pt) for i, pt in enumerate(
@@ -242,15 +168,7 @@ class PositioningHandler:
             self._add_sphere(pt, (0.0, 0.0, 1.0), label=idx)
 
         self.render_window.Render()
-        win2img = vtk.vtkWindowToImageFilter()
-        win2img.SetInput(self.render_window)
-        win2img.Update()
-
-        writer = vtk.vtkPNGWriter()
-        writer.SetInputConnection(win2img.GetOutputPort())
-        writer.WriteToMemoryOn()
-        writer.Write()
-        return bytes(memoryview(writer.GetResult()))
+        return encode_render_window(self.render_window, "png")
 
     def _add_sphere(self, pt, color, label=None):
         sphere = vtk.vtkSphereSource()
@@ -314,6 +232,51 @@ class PositioningHandler:
 
         return points_status
 
+    def get_scene_state(self) -> dict:
+        return {
+            "bone_model_path": self.bone_model_path,
+            "axis": self.sort_axis,
+            "descending": self.sort_descending,
+            "surface_points": [pt.tolist() for pt in self.surface_points],
+            "registered_indices": list(self.registered_points.keys()),
+            "prediction_points": [(idx, pt.tolist()) for idx, pt in self.prediction_points],
+        }
+
+    def apply_scene_state(self, state: dict):
+        # Only what render_png_bytes draws; the registered world coordinates stay with the owning handler.
+        self.surface_points = [np.array(pt) for pt in state["surface_points"]]
+        self.registered_points = dict.fromkeys(state["registered_indices"])
+        self.prediction_points = [(idx, np.array(pt)) for idx, pt in state["prediction_points"]]
+
+    def export_state(self) -> dict:
+        """Everything needed to rebuild this handler, including the registered world coordinates."""
+        return {
+            "bone_model_path": self.bone_model_path,
+            "axis": self.sort_axis,
+            "descending": self.sort_descending,
+            "seed": self.seed,
+            "rng_state": self.rng.bit_generator.state,
+            "surface_points": [pt.tolist() for pt in self.surface_points],
+            "registered_points": [(idx, pt.tolist()) for idx, pt in self.registered_points.items()],
+            "prediction_points": [(idx, pt.tolist()) for idx, pt in self.prediction_points],
+            "predicted_world_coords": [pt.tolist() for pt in self.predicted_world_coords],
+            "prediction_registered": [(idx, pt.tolist()) for idx, pt in self.prediction_registered.items()],
+            "prediction_errors": self.prediction_errors,
+        }
+
+    def import_state(self, state: dict):
+        self.rng.bit_generator.state = state["rng_state"]
+        self.surface_points = [np.array(pt) for pt in state["surface_points"]]
+        self.registered_points = {idx: np.array(pt) for idx, pt in state["registered_points"]}
+        self.prediction_points = [(idx, np.array(pt)) for idx, pt in state["prediction_points"]]
+        self.predicted_world_coords = [np.array(pt) for pt in state["predicted_world_coords"]]
+        self.prediction_registered = {idx: np.array(pt) for idx, pt in state["prediction_registered"]}
+        self.prediction_errors = state["prediction_errors"]
+
+    def memory_footprint(self) -> int:
+        width, height = self.render_window.GetSize()
+        return self.bone_model.GetActualMemorySize() * 1024 + width * height * 4 * 2
+
     def get_registered_main_points(self) -> list[tuple[int, np.ndarray, np.ndarray]]:
         result = []
         for idx, model_pt in enumerate(self.surface_points[:10]):
@@ -323,9 +286,22 @@ class PositioningHandler:
         return result
 
 
+def restore_positioning_handler(state: dict) -> PositioningHandler:
+    handler = PositioningHandler(state["bone_model_path"], axis=state["axis"],
+                                 descending=state["descending"], seed=state["seed"])
+    handler.import_state(state)
+    return handler
+
+
+positioning_handlers = HandlerRegistry(
+    "positioning",
+    max_bytes=int(config.get("POSITIONING_HANDLERS_MAX_MB", 1024)) * 1024 * 1024,
+    idle_ttl=float(config.get("HANDLER_IDLE_TTL_S", 3600)),
+    restore=restore_positioning_handler,
+    store=state_store
+)
+
+
 def remove_positioning_handler(i_operation_plan: int) -> bool:
-    if i_operation_plan in positioning_handlers:
-        del positioning_handlers[i_operation_plan]
-        return True
-    return False
+    return positioning_handlers.pop(i_operation_plan)
 
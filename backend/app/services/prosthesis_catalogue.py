@@ -0,0 +1,154 @@
+import bisect
+import threading
+from collections import Counter, defaultdict
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.prosthesis_model import ProsthesisModel
+from app.services.state_store import state_store
+
+CATALOGUE_FIELDS = ["i_3d_prosthesis_model", "i_operation_type", "file_name", "i_bone", "size", "poly", "manufacturer"]
+EXACT_FIELDS = ("i_operation_type", "i_bone", "poly", "manufacturer")
+FACET_FIELDS = ("manufacturer", "poly", "size", "i_bone")
+
+VERSION_NAMESPACE = "prosthesis_catalogue"
+
+
+class ProsthesisCatalogue:
+    """
+    In-memory index over the prosthesis table for implant selection. Exact fields map
+    value -> ids, size is a sorted list for range queries and lower-cased manufacturer
+    a sorted list for prefix queries, so a search is a few set intersections.
+    The controller keeps it current on add/update/delete; other workers notice through
+    a version counter in the shared state store and reload.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_version = None
+        self._records = {}
+        self._exact = {}
+        self._by_size = []
+        self._by_manufacturer = []
+
+    def _index(self, record: dict):
+        i = record["i_3d_prosthesis_model"]
+        self._records[i] = record
+        for field in EXACT_FIELDS:
+            self._exact[field][record[field]].add(i)
+        bisect.insort(self._by_size, (record["size"], i))
+        bisect.insort(self._by_manufacturer, (record["manufacturer"].lower(), i))
+
+    def _unindex(self, i: int):
+        record = self._records.pop(i, None)
+        if record is None:
+            return
+        for field in EXACT_FIELDS:
+            ids = self._exact[field][record[field]]
+            ids.discard(i)
+            if not ids:
+                del self._exact[field][record[field]]
+        for sorted_list, key in ((self._by_size, record["size"]), (self._by_manufacturer, record["manufacturer"].lower())):
+            pos = bisect.bisect_left(sorted_list, (key, i))
+            if pos < len(sorted_list) and sorted_list[pos] == (key, i):
+                del sorted_list[pos]
+
+    async def ensure_loaded(self, db: AsyncSession):
+        version = await run_in_threadpool(state_store.version, VERSION_NAMESPACE, "all")
+        if self._loaded_version == version:
+            return
+        columns = [getattr(ProsthesisModel, field) for field in CATALOGUE_FIELDS]
+        rows = (await db.execute(select(*columns))).all()
+        with self._lock:
+            self._records = {}
+            self._exact = {field: defaultdict(set) for field in EXACT_FIELDS}
+            self._by_size = []
+            self._by_manufacturer = []
+            for row in rows:
+                self._index(dict(row._mapping))
+            self._loaded_version = version
+
+    # upsert and remove write to the state store; async callers run them in the threadpool.
+    def upsert(self, model: ProsthesisModel):
+        record = {field: getattr(model, field) for field in CATALOGUE_FIELDS}
+        with self._lock:
+            if self._loaded_version is not None:
+                self._unindex(record["i_3d_prosthesis_model"])
+                self._index(record)
+            self._bump()
+
+    def remove(self, i_3d_prosthesis_model: int):
+        with self._lock:
+            if self._loaded_version is not None:
+                self._unindex(i_3d_prosthesis_model)
+            self._bump()
+
+    def _bump(self):
+        # Always bumped, so other workers reload even if this one never loaded a copy.
+        # This worker's copy already has the change, unless another worker also changed
+        # the table since it was loaded.
+        version = state_store.put(VERSION_NAMESPACE, "all", {})
+        if self._loaded_version is not None:
+            self._loaded_version = version if version == self._loaded_version + 1 else -1
+
+    def _range(self, sorted_list: list, low, high) -> set:
+        start = 0 if low is None else bisect.bisect_left(sorted_list, (low,))
+        end = len(sorted_list)
+        if high is not None:
+            end = bisect.bisect_left(sorted_list, (high, float("inf")))
+        return {i for _key, i in sorted_list[start:end]}
+
+    def search(
+        self,
+        i_operation_type: int = None,
+        i_bone: int = None,
+        poly: str = None,
+        manufacturer: str = None,
+        manufacturer_prefix: str = None,
+        size_min: int = None,
+        size_max: int = None,
+        limit: int | None = 100,
+        offset: int = 0
+    ) -> dict:
+        """
+        Models matching every given criterion, ordered by (manufacturer, size, id), with the
+        total match count and per-value counts of manufacturer, poly, size and bone.
+        limit=None returns every match from offset on.
+        """
+        with self._lock:
+            candidates = []
+            for field, value in (("i_operation_type", i_operation_type), ("i_bone", i_bone), ("poly", poly), ("manufacturer", manufacturer)):
+                if value is not None:
+                    candidates.append(self._exact[field].get(value, set()))
+            if size_min is not None or size_max is not None:
+                candidates.append(self._range(self._by_size, size_min, size_max))
+            if manufacturer_prefix:
+                prefix = manufacturer_prefix.lower()
+                start = bisect.bisect_left(self._by_manufacturer, (prefix,))
+                end = bisect.bisect_left(self._by_manufacturer, (prefix + "\U0010ffff",))
+                candidates.append({i for _key, i in self._by_manufacturer[start:end]})
+
+            if candidates:
+                candidates.sort(key=len)
+                ids = set(candidates[0]).intersection(*candidates[1:])
+            else:
+                ids = set(self._records)
+            matches = [self._records[i] for i in ids]
+
+        matches.sort(key=lambda r: (r["manufacturer"], r["size"], r["i_3d_prosthesis_model"]))
+        counts = {field: Counter(r[field] for r in matches) for field in FACET_FIELDS}
+        return {
+            "total": len(matches),
+            "counts": {field: dict(sorted(counter.items(), key=_facet_order)) for field, counter in counts.items()},
+            "items": matches[offset:] if limit is None else matches[offset:offset + limit]
+        }
+
+
+def _facet_order(item: tuple) -> tuple:
+    # Nullable columns (i_bone, legacy rows) put None first instead of failing to compare.
+    return (item[0] is not None, item[0])
+
+
+prosthesis_catalogue = ProsthesisCatalogue()
@@ -0,0 +1,151 @@
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+
+import vtk
+import numpy as np
+from vtkmodules.util import numpy_support
+from app.database.db_connect import config
+
+PROSTHESIS_CACHE_ENTRIES = int(config.get("PROSTHESIS_CACHE_ENTRIES", 32))
+
+SIDECAR_MAGIC = b"RPSC"
+SIDECAR_VERSION = 1
+SIDECAR_HEADER = struct.Struct("<4sHHII")
+FLAG_HAS_NORMALS = 1
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def sidecar_path(obj_path: str) -> str:
+    return os.path.splitext(obj_path)[0] + ".pmesh"
+
+
+def read_obj(obj_path: str) -> vtk.vtkPolyData:
+    reader = vtk.vtkOBJReader()
+    reader.SetFileName(obj_path)
+    reader.Update()
+
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(reader.GetOutputPort())
+    triangles.PassVertsOff()
+    triangles.PassLinesOff()
+    triangles.Update()
+    return triangles.GetOutput()
+
+
+def write_sidecar(obj_path: str) -> str:
+    """
+    Parses obj_path once and writes its triangles next to it as:
+      header  "RPSC", u16 version, u16 flags, u32 point count, u32 triangle count (little-endian)
+      body    f32[3 * points] positions, f32[3 * points] normals if flags & 1, i32[3 * triangles] faces
+    """
+    mesh = read_obj(obj_path)
+    points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData()).astype("<f4")
+    faces = numpy_support.vtk_to_numpy(mesh.GetPolys().GetConnectivityArray()).astype("<i4")
+    normals = mesh.GetPointData().GetNormals()
+
+    flags = FLAG_HAS_NORMALS if normals is not None else 0
+    path = sidecar_path(obj_path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, flags, len(points), len(faces) // 3))
+            f.write(points.tobytes())
+            if normals is not None:
+                f.write(numpy_support.vtk_to_numpy(normals).astype("<f4").tobytes())
+            f.write(faces.tobytes())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+def read_sidecar(path: str) -> vtk.vtkPolyData:
+    with open(path, "rb") as f:
+        magic, version, flags, n_points, n_triangles = SIDECAR_HEADER.unpack(f.read(SIDECAR_HEADER.size))
+    if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION:
+        raise ValueError(f"Not a prosthesis mesh sidecar: {path}")
+
+    # Positions and normals are mapped straight from the file; VTK keeps a reference to the memmap.
+    offset = SIDECAR_HEADER.size
+    positions = np.memmap(path, dtype="<f4", mode="r", offset=offset, shape=(n_points, 3))
+    offset += positions.nbytes
+    normals = None
+    if flags & FLAG_HAS_NORMALS:
+        normals = np.memmap(path, dtype="<f4", mode="r", offset=offset, shape=(n_points, 3))
+        offset += normals.nbytes
+    faces = np.memmap(path, dtype="<i4", mode="r", offset=offset, shape=(n_triangles * 3,))
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(positions, deep=False))
+
+    cell_offsets = np.arange(0, 3 * n_triangles + 1, 3, dtype=np.int64)
+    cells = vtk.vtkCellArray()
+    cells.SetData(
+        numpy_support.numpy_to_vtk(cell_offsets, deep=True, array_type=vtk.VTK_ID_TYPE),
+        numpy_support.numpy_to_vtk(faces.astype(np.int64), deep=True, array_type=vtk.VTK_ID_TYPE)
+    )
+
+    mesh = vtk.vtkPolyData()
+    mesh.SetPoints(points)
+    mesh.SetPolys(cells)
+    if normals is not None:
+        vtk_normals = numpy_support.numpy_to_vtk(normals, deep=False)
+        vtk_normals.SetName("Normals")
+        mesh.GetPointData().SetNormals(vtk_normals)
+    return mesh
+
+
+def load_prosthesis_mesh(obj_path: str) -> vtk.vtkPolyData:
+    path = sidecar_path(obj_path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(obj_path):
+        try:
+            return read_sidecar(path)
+        except (ValueError, OSError) as e:
+            print(f"Warning: ignoring prosthesis sidecar {path}: {e}")
+
+    # No usable sidecar (e.g. uploaded before sidecars existed): parse once and write one for next time.
+    write_sidecar(obj_path)
+    return read_sidecar(path)
+
+
+def get_prosthesis_mesh(obj_path: str) -> vtk.vtkPolyData:
+    """
+    Parsed prosthesis mesh shared by every ModelHandler. Like get_bone_mesh, the result
+    shares its arrays with the cached mesh and must be treated as read-only.
+    """
+    stat = os.stat(obj_path)
+    key = (obj_path, stat.st_size, stat.st_mtime_ns)
+
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+
+    if cached is None:
+        cached = load_prosthesis_mesh(obj_path)
+        with _cache_lock:
+            _cache[key] = cached
+            while len(_cache) > PROSTHESIS_CACHE_ENTRIES:
+                _cache.popitem(last=False)
+
+    mesh = vtk.vtkPolyData()
+    mesh.ShallowCopy(cached)
+    return mesh
+
+
+def forget_prosthesis_mesh(obj_path: str):
+    with _cache_lock:
+        for key in [k for k in _cache if k[0] == obj_path]:
+            del _cache[key]
+
+
+def delete_sidecar(obj_path: str):
+    forget_prosthesis_mesh(obj_path)
+    if os.path.exists(sidecar_path(obj_path)):
+        os.remove(sidecar_path(obj_path))
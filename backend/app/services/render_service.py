@@ -0,0 +1,114 @@
+import asyncio
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from app.database.db_connect import config
+from app.services.op_model_service import ModelHandler
+from app.services.preop_positioning_service import PositioningHandler
+
+RENDER_WORKERS = int(config.get("RENDER_WORKERS", 2))
+RENDER_TIMEOUT_S = float(config.get("RENDER_TIMEOUT_S", 30))
+RENDER_WORKER_SCENES = int(config.get("RENDER_WORKER_SCENES", 4))
+
+# Per worker process: render-only scene replicas keyed by (kind, bone model path).
+# Each replica owns its own off-screen vtkRenderWindow and is only touched by that worker.
+_scenes = OrderedDict()
+
+
+def _get_scene(kind: str, bone_model_path: str, factory):
+    key = (kind, bone_model_path)
+    if key in _scenes:
+        _scenes.move_to_end(key)
+        return _scenes[key]
+
+    scene = factory()
+    _scenes[key] = scene
+    while len(_scenes) > RENDER_WORKER_SCENES:
+        _, evicted = _scenes.popitem(last=False)
+        evicted.render_window.Finalize()
+    return scene
+
+
+def render_planning_view(state: dict, view_name: str, width: int, height: int,
+                         image_format: str = "png", quality: int = 90) -> bytes:
+    scene = _get_scene("planning", state["bone_model_path"], lambda: ModelHandler(state["bone_model_path"]))
+    scene.apply_scene_state(state)
+    scene.set_camera(view_name)
+    scene.render_window.SetSize(width, height)
+    return scene.render_image_bytes(image_format, quality)
+
+
+def render_positioning_view(state: dict, view_name: str, width: int, height: int) -> bytes:
+    scene = _get_scene(
+        "positioning",
+        state["bone_model_path"],
+        lambda: PositioningHandler(state["bone_model_path"], axis=state["axis"], descending=state["descending"])
+    )
+    scene.apply_scene_state(state)
+    scene.set_camera(view_name)
+    scene.render_window.SetSize(width, height)
+    return scene.render_png_bytes()
+
+
+class RenderPool:
+    """
+    Fixed pool of render worker processes. Requests carry the scene state (mesh paths
+    plus actor matrices), so a worker never shares a VTK render window with another thread.
+    """
+
+    def __init__(self, workers: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _discard(self, executor: ProcessPoolExecutor, terminate: bool = False):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        # shutdown() cannot stop a task that is already running, so a worker stuck in a
+        # render has to be terminated; renders in flight on the same pool see BrokenProcessPool.
+        processes = list((executor._processes or {}).values()) if terminate else []
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    async def run(self, fn, *args):
+        """
+        Renders in a worker process. A pool broken by a crashed worker is replaced and the
+        render retried once; a second BrokenProcessPool is raised to the caller. A render that
+        times out takes its pool down with it, so the stuck worker does not hold a slot forever.
+        """
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args)
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+            except BrokenProcessPool:
+                self._discard(executor)
+                if attempt:
+                    raise
+            except asyncio.TimeoutError:
+                self._discard(executor, terminate=True)
+                raise
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+render_pool = RenderPool(RENDER_WORKERS, RENDER_TIMEOUT_S)
@@ -0,0 +1,312 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+from app.database.db_connect import config
+
+CURRENT_DIR = os.path.dirname(__file__)
+APP_ROOT = os.path.dirname(CURRENT_DIR)
+
+
+class StateConflict(ValueError):
+    def __init__(self, namespace: str, key, expected_version: int, version: int):
+        super().__init__(
+            f"{namespace} state {key} is at version {version}, not {expected_version}: it was changed elsewhere."
+        )
+        self.version = version
+
+
+class StateStore(ABC):
+    """
+    Shared store for serialized handler state, so any worker can rebuild a handler.
+    Every put bumps a per-key version; readers compare versions to spot stale copies.
+    A put with expected_version only succeeds if the key is still at that version
+    (0 for a missing key) and raises StateConflict otherwise.
+    """
+
+    @abstractmethod
+    def get(self, namespace: str, key) -> tuple[int, dict] | None:
+        ...
+
+    @abstractmethod
+    def version(self, namespace: str, key) -> int:
+        ...
+
+    @abstractmethod
+    def put(self, namespace: str, key, state: dict, expected_version: int = None) -> int:
+        ...
+
+    @abstractmethod
+    def delete(self, namespace: str, key):
+        ...
+
+
+class MemoryStateStore(StateStore):
+    """Process-local store; the default when only one worker runs."""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        with self._lock:
+            return self._states.get((namespace, key))
+
+    def version(self, namespace, key):
+        with self._lock:
+            return self._version(namespace, key)
+
+    def _version(self, namespace, key):
+        entry = self._states.get((namespace, key))
+        return entry[0] if entry else 0
+
+    def put(self, namespace, key, state, expected_version=None):
+        with self._lock:
+            current = self._version(namespace, key)
+            if expected_version is not None and current != expected_version:
+                raise StateConflict(namespace, key, expected_version, current)
+            # Round-trip through JSON so this store behaves like the shared ones.
+            version = current + 1
+            self._states[(namespace, key)] = (version, json.loads(json.dumps(state)))
+            return version
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._states.pop((namespace, key), None)
+
+
+class SQLiteStateStore(StateStore):
+    """File-backed store shared by every worker on one host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS handler_state ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, version INTEGER NOT NULL, state TEXT NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace, key):
+        row = self._connect().execute(
+            "SELECT version, state FROM handler_state WHERE namespace = ? AND key = ?", (namespace, str(key))
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def version(self, namespace, key):
+        row = self._connect().execute(
+            "SELECT version FROM handler_state WHERE namespace = ? AND key = ?", (namespace, str(key))
+        ).fetchone()
+        return row[0] if row else 0
+
+    def put(self, namespace, key, state, expected_version=None):
+        upsert = (
+            "INSERT INTO handler_state (namespace, key, version, state) VALUES (?, ?, 1, ?)"
+            " ON CONFLICT (namespace, key) DO UPDATE SET version = version + 1, state = excluded.state"
+            " RETURNING version"
+        )
+        conn = self._connect()
+        if expected_version is None:
+            return conn.execute(upsert, (namespace, str(key), json.dumps(state))).fetchone()[0]
+
+        # BEGIN IMMEDIATE takes the write lock up front, so the check and the write are atomic.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT version FROM handler_state WHERE namespace = ? AND key = ?", (namespace, str(key))
+            ).fetchone()
+            current = row[0] if row else 0
+            if current != expected_version:
+                raise StateConflict(namespace, key, expected_version, current)
+            version = conn.execute(upsert, (namespace, str(key), json.dumps(state))).fetchone()[0]
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return version
+
+    def delete(self, namespace, key):
+        self._connect().execute("DELETE FROM handler_state WHERE namespace = ? AND key = ?", (namespace, str(key)))
+
+
+class WatchError(Exception):
+    """LocalRedis counterpart of redis.WatchError: a watched key changed before EXEC."""
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the few Redis commands RedisStateStore uses
+    (GET, SET, INCR, DEL, WATCH and MULTI/EXEC pipelines), for development and tests.
+    """
+
+    WatchError = WatchError
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        return self._data.get(name)
+
+    def _set(self, name, value):
+        self._data[name] = value.encode() if isinstance(value, str) else value
+        return True
+
+    def _incr(self, name, amount: int = 1):
+        value = int(self._data.get(name, b"0")) + amount
+        self._data[name] = str(value).encode()
+        return value
+
+    def _delete(self, *names):
+        return sum(self._data.pop(name, None) is not None for name in names)
+
+    def execute_batch(self, commands: list, watched: dict = None) -> list:
+        with self._lock:
+            if watched and any(self._data.get(name) != value for name, value in watched.items()):
+                raise WatchError("Watched key changed")
+            return [getattr(self, "_" + name)(*args) for name, args in commands]
+
+    def get(self, name):
+        return self.execute_batch([("get", (name,))])[0]
+
+    def set(self, name, value):
+        return self.execute_batch([("set", (name, value))])[0]
+
+    def incr(self, name, amount: int = 1):
+        return self.execute_batch([("incr", (name, amount))])[0]
+
+    def delete(self, *names):
+        return self.execute_batch([("delete", names)])[0]
+
+    def pipeline(self, transaction: bool = True):
+        return LocalPipeline(self)
+
+
+class LocalPipeline:
+    """
+    Queues commands and runs them under the client lock, like MULTI/EXEC. After watch(),
+    commands run immediately until multi(), and execute() raises WatchError if a watched
+    key changed in between, as with redis-py.
+    """
+
+    def __init__(self, client: LocalRedis):
+        self._client = client
+        self._commands = []
+        self._watched = None
+        self._immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def reset(self):
+        self._commands, self._watched, self._immediate = [], None, False
+
+    def watch(self, *names):
+        self._watched = {name: self._client.get(name) for name in names}
+        self._immediate = True
+
+    def multi(self):
+        self._immediate = False
+
+    def _queue(self, name, *args):
+        if self._immediate:
+            return self._client.execute_batch([(name, args)])[0]
+        self._commands.append((name, args))
+        return self
+
+    def get(self, name):
+        return self._queue("get", name)
+
+    def set(self, name, value):
+        return self._queue("set", name, value)
+
+    def incr(self, name, amount: int = 1):
+        return self._queue("incr", name, amount)
+
+    def delete(self, *names):
+        return self._queue("delete", *names)
+
+    def execute(self):
+        commands, watched = self._commands, self._watched
+        self.reset()
+        return self._client.execute_batch(commands, watched)
+
+
+class RedisStateStore(StateStore):
+    """Store on a Redis server (or LocalRedis), shared across hosts."""
+
+    def __init__(self, client, prefix: str = "robop:handler", watch_error=WatchError):
+        self.client = client
+        self.prefix = prefix
+        self.watch_error = watch_error
+
+    def _keys(self, namespace, key):
+        base = f"{self.prefix}:{namespace}:{key}"
+        return base + ":version", base + ":state"
+
+    def get(self, namespace, key):
+        version_key, state_key = self._keys(namespace, key)
+        version, state = self.client.pipeline(transaction=True).get(version_key).get(state_key).execute()
+        if state is None:
+            return None
+        return int(version), json.loads(state)
+
+    def version(self, namespace, key):
+        version = self.client.get(self._keys(namespace, key)[0])
+        return int(version) if version is not None else 0
+
+    def put(self, namespace, key, state, expected_version=None):
+        version_key, state_key = self._keys(namespace, key)
+        if expected_version is None:
+            version, _ = self.client.pipeline(transaction=True).incr(version_key).set(state_key, json.dumps(state)).execute()
+            return int(version)
+
+        with self.client.pipeline(transaction=True) as pipe:
+            pipe.watch(version_key)
+            current = pipe.get(version_key)
+            current = int(current) if current is not None else 0
+            if current != expected_version:
+                raise StateConflict(namespace, key, expected_version, current)
+            pipe.multi()
+            pipe.incr(version_key).set(state_key, json.dumps(state))
+            try:
+                version, _ = pipe.execute()
+            except self.watch_error:
+                raise StateConflict(namespace, key, expected_version, self.version(namespace, key))
+        return int(version)
+
+    def delete(self, namespace, key):
+        self.client.delete(*self._keys(namespace, key))
+
+
+def create_state_store() -> StateStore:
+    backend = config.get("STATE_STORE_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryStateStore()
+    if backend == "sqlite":
+        path = os.path.join(APP_ROOT, config.get("STATE_STORE_PATH", "handler_state.sqlite3"))
+        return SQLiteStateStore(path)
+    if backend == "local_redis":
+        return RedisStateStore(LocalRedis())
+    if backend == "redis":
+        import redis
+        return RedisStateStore(redis.Redis.from_url(config.get("REDIS_URL", "redis://localhost:6379/0")), watch_error=redis.WatchError)
+    raise ValueError(f"Unknown STATE_STORE_BACKEND '{backend}'. Use memory, sqlite, redis or local_redis.")
+
+
+state_store = create_state_store()
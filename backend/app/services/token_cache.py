@@ -0,0 +1,112 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from app.database.db_connect import config
+from app.services.state_store import state_store
+
+TOKEN_CACHE_SIZE = int(config.get("TOKEN_CACHE_SIZE", 4096))
+TOKEN_CACHE_TTL_S = float(config.get("TOKEN_CACHE_TTL_S", 300))
+TOKEN_REVOCATION_RECHECK_S = float(config.get("TOKEN_REVOCATION_RECHECK_S", 30))
+
+REVOKED_NAMESPACE = "revoked_tokens"
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenCache:
+    """
+    LRU of tokens whose signature has already been checked, keyed by SHA-256 so raw
+    tokens are never held. An entry lives until the token's exp or ttl, whichever is
+    sooner. Revocations go to the shared state store; entries re-check it every
+    recheck_s, so a token revoked on another worker stops working within that window.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, recheck_s: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.recheck_s = recheck_s
+        self._entries = OrderedDict()
+        self._revoked = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> dict | None:
+        digest = token_digest(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry[1] <= now:
+                self._entries.pop(digest, None)
+                self.misses += 1
+                return None
+            if now - entry[2] < self.recheck_s:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return entry[0]
+
+        if self._is_revoked(digest, now):
+            with self._lock:
+                self._entries.pop(digest, None)
+            return None
+        with self._lock:
+            entry[2] = now
+            self.hits += 1
+        return entry[0]
+
+    def put(self, token: str, user: dict, exp: float | None):
+        now = time.time()
+        expires = now + self.ttl if exp is None else min(float(exp), now + self.ttl)
+        digest = token_digest(token)
+        with self._lock:
+            self._entries[digest] = [user, expires, now]
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def is_revoked(self, token: str) -> bool:
+        return self._is_revoked(token_digest(token), time.time())
+
+    def _is_revoked(self, digest: str, now: float) -> bool:
+        with self._lock:
+            if digest in self._revoked:
+                return self._revoked[digest] > now
+        stored = state_store.get(REVOKED_NAMESPACE, digest)
+        if stored is None:
+            return False
+        exp = stored[1]["exp"]
+        if exp <= now:
+            state_store.delete(REVOKED_NAMESPACE, digest)
+            return False
+        with self._lock:
+            self._revoked[digest] = exp
+        return True
+
+    def revoke(self, token: str, exp: float | None):
+        """Rejects token until its exp; one without exp stays revoked for good."""
+        digest = token_digest(token)
+        now = time.time()
+        exp = float(exp) if exp is not None else float("inf")
+        state_store.put(REVOKED_NAMESPACE, digest, {"exp": exp})
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._revoked[digest] = exp
+            # Expired tokens fail jwt.decode anyway, so their revocations can go.
+            self._revoked = {d: e for d, e in self._revoked.items() if e > now}
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "revoked": len(self._revoked),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_S, TOKEN_REVOCATION_RECHECK_S)
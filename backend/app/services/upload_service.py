@@ -0,0 +1,35 @@
+import hashlib
+import os
+import tempfile
+
+from fastapi import UploadFile
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+async def receive_upload(upload: UploadFile, directory: str, max_bytes: int = None) -> tuple[str, str, int]:
+    """
+    Streams upload into a temp file in directory in 1 MB chunks, hashing as it writes.
+    Returns (temp path, BLAKE2b hex digest, size); the caller moves the temp file into
+    place. Nothing is left behind if the upload fails or exceeds max_bytes.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while content := await upload.read(UPLOAD_CHUNK_SIZE):
+                size += len(content)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadTooLarge(f"File exceeds the {max_bytes // (1024 * 1024)} MB upload limit")
+                digest.update(content)
+                f.write(content)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# app.database.db_connect reads its config on import, so the throwaway one has to be in
+# place before any test module imports the app: nothing touches a real database or store.
+TEST_ROOT = tempfile.mkdtemp(prefix="robop-tests-")
+TEST_CONFIG = {
+    "DATABASE_URL": f"sqlite:///{os.path.join(TEST_ROOT, 'test.db')}",
+    "JWT_SECRET_KEY": "test-secret",
+    "JWT_ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_HOURS": 1,
+    "SMTP_SERVER": "",
+    "SMTP_PORT": 0,
+    "SENDER_EMAIL": "",
+    "SENDER_PASSWORD": "",
+    "BONE_STORAGE_DIR": os.path.join(TEST_ROOT, "bones"),
+    "DICOM_STORAGE_DIR": os.path.join(TEST_ROOT, "dicoms"),
+    "PROSTHESIS_STORAGE_DIR": os.path.join(TEST_ROOT, "prostheses"),
+    "VIEW_SNAPSHOTS_STORAGE_DIR": os.path.join(TEST_ROOT, "views"),
+    "NP_STORAGE_DIR": os.path.join(TEST_ROOT, "np"),
+    "JSON_STORAGE_DIR": os.path.join(TEST_ROOT, "json"),
+    "DICOM_ANALYSER_ADDRESS": f"127.0.0.1:{_free_port()}",
+    "ANALYSIS_DEADLINE_S": 30,
+}
+with open(os.path.join(TEST_ROOT, "config.json"), "w") as f:
+    json.dump(TEST_CONFIG, f)
+os.environ["APP_CONFIG"] = os.path.join(TEST_ROOT, "config.json")
+
+
+@pytest.fixture
+def run_with_db():
+    """
+    Runs fn(db) on a fresh AsyncSession and returns its result. Each test gets its own
+    event loop, so the async engine is created and disposed around the call.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from app.database.db_connect import ASYNC_DATABASE_URL, Base, engine
+
+    def run(fn):
+        Base.metadata.create_all(engine)
+
+        async def main():
+            async_engine = create_async_engine(ASYNC_DATABASE_URL)
+            try:
+                async with async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)() as db:
+                    return await fn(db)
+            finally:
+                await async_engine.dispose()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,130 @@
+import io
+import os
+
+import pytest
+from fastapi import UploadFile
+from sqlalchemy import select
+
+from app.models.blob_model import Blob
+from app.services.blob_store import (
+    BLOB_STORAGE_DIR, store_upload, abandon_upload, release_blob, commit_release, remove_blob_file
+)
+
+
+def upload(data: bytes) -> UploadFile:
+    return UploadFile(io.BytesIO(data))
+
+
+def temp_files() -> list[str]:
+    # receive_upload stages uploads directly in BLOB_STORAGE_DIR; stored blobs live in shard dirs.
+    return [name for name in os.listdir(BLOB_STORAGE_DIR) if os.path.isfile(os.path.join(BLOB_STORAGE_DIR, name))]
+
+
+async def ref_count(db, path: str):
+    return await db.scalar(select(Blob.ref_count).where(Blob.path == path))
+
+
+def test_identical_uploads_share_one_file(run_with_db):
+    data = os.urandom(4096)
+
+    async def scenario(db):
+        first = await store_upload(db, upload(data), "a.obj")
+        await db.commit()
+        second = await store_upload(db, upload(data), "b.OBJ")
+        await db.commit()
+        return first.path, second.path, await ref_count(db, first.path)
+
+    first_path, second_path, count = run_with_db(scenario)
+    assert first_path == second_path
+    assert first_path.endswith(".obj")
+    assert count == 2
+    with open(first_path, "rb") as f:
+        assert f.read() == data
+    assert temp_files() == []
+
+
+def test_release_tombstones_only_the_last_reference(run_with_db):
+    data = os.urandom(4096)
+
+    async def scenario(db):
+        blob = await store_upload(db, upload(data), "a.nrrd")
+        await store_upload(db, upload(data), "b.nrrd")
+        await db.commit()
+        path = blob.path
+
+        tombstone = await release_blob(db, path)
+        await commit_release(db, path, tombstone)
+        assert tombstone is None
+        assert os.path.exists(path)
+        assert await ref_count(db, path) == 1
+
+        tombstone = await release_blob(db, path)
+        # Moved aside before the commit, so a concurrent upload stores a fresh copy.
+        assert not os.path.exists(path)
+        assert os.path.exists(tombstone)
+        await commit_release(db, path, tombstone)
+        remove_blob_file(path, tombstone)
+        return path, tombstone, await ref_count(db, path)
+
+    path, tombstone, count = run_with_db(scenario)
+    assert count is None
+    assert not os.path.exists(path)
+    assert not os.path.exists(tombstone)
+
+
+def test_failed_release_commit_restores_the_file(run_with_db):
+    data = os.urandom(4096)
+
+    async def scenario(db):
+        blob = await store_upload(db, upload(data), "a.zip")
+        await db.commit()
+        path = blob.path
+
+        tombstone = await release_blob(db, path)
+
+        async def failing_commit():
+            raise RuntimeError("commit failed")
+
+        commit = db.commit
+        db.commit = failing_commit
+        with pytest.raises(RuntimeError):
+            await commit_release(db, path, tombstone)
+        db.commit = commit
+        await db.rollback()
+        return path, tombstone, await ref_count(db, path)
+
+    path, tombstone, count = run_with_db(scenario)
+    assert os.path.exists(path)
+    assert not os.path.exists(tombstone)
+    assert count == 1
+
+
+def test_abandon_upload_removes_an_unshared_file(run_with_db):
+    data = os.urandom(4096)
+
+    async def scenario(db):
+        blob = await store_upload(db, upload(data), "a.obj")
+        path = blob.path
+        assert os.path.exists(path)
+        await abandon_upload(db, blob)
+        return path, await ref_count(db, path)
+
+    path, count = run_with_db(scenario)
+    assert count is None
+    assert not os.path.exists(path)
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith(".deleted")]
+
+
+def test_abandon_upload_keeps_a_shared_file(run_with_db):
+    data = os.urandom(4096)
+
+    async def scenario(db):
+        path = (await store_upload(db, upload(data), "a.obj")).path
+        await db.commit()
+        duplicate = await store_upload(db, upload(data), "b.obj")
+        await abandon_upload(db, duplicate)
+        return path, await ref_count(db, path)
+
+    path, count = run_with_db(scenario)
+    assert count == 1
+    assert os.path.exists(path)
@@ -0,0 +1,33 @@
+import pytest
+
+from app.services.etags import etag_matches
+
+ETAG = '"0fb44f6edf8a883d16c00e45155420d0"'
+
+
+@pytest.mark.parametrize("if_none_match", [
+    ETAG,
+    "W/" + ETAG,
+    "*",
+    f'"other", {ETAG}',
+    f' "other" ,W/{ETAG} ',
+])
+def test_matching_headers(if_none_match):
+    assert etag_matches(if_none_match, ETAG)
+
+
+@pytest.mark.parametrize("if_none_match", [
+    "",
+    None,
+    '"other"',
+    ETAG[:-2] + '"',  # a prefix of the tag
+    '"x' + ETAG[1:],  # the tag inside a longer one
+    ETAG.strip('"'),  # unquoted
+    f'"{ETAG}"',
+])
+def test_non_matching_headers(if_none_match):
+    assert not etag_matches(if_none_match, ETAG)
+
+
+def test_weak_etag_matches_its_strong_form():
+    assert etag_matches(ETAG, "W/" + ETAG)
@@ -0,0 +1,101 @@
+import pytest
+from sqlalchemy import Column, Integer, String, insert
+from sqlalchemy.orm import declarative_base
+
+from app.database.db_connect import engine
+from app.services import pagination
+from app.services.pagination import keyset_page, encode_cursor, decode_cursor, InvalidPageRequest
+
+ItemBase = declarative_base()
+
+
+class Item(ItemBase):
+    __tablename__ = "pagination_items"
+    i_item = Column(Integer, primary_key=True)
+    name = Column(String(20), nullable=False)
+    size = Column(Integer, nullable=False)
+
+
+FIELDS = ["i_item", "name", "size"]
+SORTS = {"i_item", "name"}
+# Repeated names, so pages have to break ties on the key.
+NAMES = ["Novak", "Svoboda", "Dvorak", "Novak", "Cerny", "Novak", "Kucera", "Dvorak", "Horak", "Cerny", "Novak"]
+
+
+@pytest.fixture(autouse=True)
+def items():
+    ItemBase.metadata.drop_all(engine)
+    ItemBase.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Item), [
+            {"i_item": i, "name": name, "size": i % 3} for i, name in enumerate(NAMES, start=1)
+        ])
+    yield
+    ItemBase.metadata.drop_all(engine)
+
+
+def page(run_with_db, **kwargs):
+    return run_with_db(lambda db: keyset_page(db, Item, "i_item", FIELDS, SORTS, **kwargs))
+
+
+def walk(run_with_db, **kwargs) -> tuple[list[dict], int]:
+    rows, cursor, pages = [], None, 0
+    while True:
+        chunk, cursor = page(run_with_db, cursor=cursor, **kwargs)
+        rows += chunk
+        pages += 1
+        if not cursor:
+            return rows, pages
+
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_pages_cover_every_row_once_in_order(run_with_db, descending):
+    rows, pages = walk(run_with_db, sort="name", descending=descending, limit=3)
+    expected = sorted(
+        ({"i_item": i, "name": name, "size": i % 3} for i, name in enumerate(NAMES, start=1)),
+        key=lambda row: (row["name"], row["i_item"]),
+        reverse=descending
+    )
+    assert rows == expected
+    assert pages == 4
+
+
+def test_no_limit_or_cursor_returns_every_row(run_with_db, monkeypatch):
+    monkeypatch.setattr(pagination, "LIST_DEFAULT_LIMIT", 2)
+    rows, cursor = page(run_with_db)
+    assert [row["i_item"] for row in rows] == list(range(1, len(NAMES) + 1))
+    assert cursor is None
+
+
+def test_cursor_without_limit_continues_in_default_pages(run_with_db, monkeypatch):
+    monkeypatch.setattr(pagination, "LIST_DEFAULT_LIMIT", 4)
+    first, cursor = page(run_with_db, limit=2)
+    second, cursor = page(run_with_db, cursor=cursor)
+    assert [row["i_item"] for row in first + second] == [1, 2, 3, 4, 5, 6]
+    assert cursor is not None
+
+
+def test_filters_and_requested_fields(run_with_db):
+    rows, pages = walk(run_with_db, requested_fields=["name"], filters=[Item.size == 0], limit=2)
+    assert rows == [{"name": NAMES[i - 1]} for i in range(1, len(NAMES) + 1) if i % 3 == 0]
+    assert pages == 2
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("name", True, "Novak", 11)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == ("name", True, "Novak", 11)
+
+
+@pytest.mark.parametrize("kwargs, message", [
+    ({"cursor": "not a cursor"}, "Malformed cursor"),
+    ({"cursor": encode_cursor("i_item", False, 3, 3), "sort": "name"}, "different sort order"),
+    ({"cursor": encode_cursor("name", False, "Novak", 3), "sort": "name", "descending": True}, "different sort order"),
+    ({"sort": "size"}, "sort must be one of"),
+    ({"requested_fields": ["password"]}, "Unknown fields"),
+    ({"limit": 0}, "limit must be between"),
+    ({"limit": pagination.LIST_MAX_LIMIT + 1}, "limit must be between"),
+])
+def test_invalid_requests(run_with_db, kwargs, message):
+    with pytest.raises(InvalidPageRequest, match=message):
+        page(run_with_db, **kwargs)
@@ -0,0 +1,119 @@
+import json
+import os
+
+import grpc
+import pytest
+
+from app.services import dicom_analysis_service
+from app.services.dicom_analysis_grpc import dicom_analysis_service_pb2_grpc as pb2_grpc
+from app.services.dicom_analysis_grpc.stub_server import build_result, serve
+from app.services.dicom_analysis_grpc.visualising_scripts import analysis_result_pb2 as result_pb2
+from app.services.dicom_analysis_service import (
+    split_result, write_result_index, read_result_mask, stream_dicom_analysis, get_dicom_analysis, NP_STORAGE_DIR
+)
+
+pytest.importorskip("cv2")
+
+
+def result_bytes(i_dicom: int = 7) -> tuple[result_pb2.AnalysisResult, bytes]:
+    result = build_result(i_dicom, bytes(range(32)))
+    return result, result.SerializeToString()
+
+
+@pytest.fixture(scope="module")
+def stub():
+    server, port = serve("127.0.0.1:0")
+    channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+    yield pb2_grpc.DICOM_AnalyserStub(channel)
+    channel.close()
+    server.stop(None)
+
+
+@pytest.fixture
+def study(tmp_path):
+    path = tmp_path / "study.zip"
+    path.write_bytes(os.urandom(200 * 1024))
+    return str(path)
+
+
+def assert_index_matches(json_path: str, pb_path: str):
+    with open(pb_path, "rb") as f:
+        result = result_pb2.AnalysisResult.FromString(f.read())
+    with open(json_path, encoding="utf-8") as f:
+        index = json.load(f)
+
+    assert (index["image_path"], index["width"], index["height"]) == (result.image_path, result.width, result.height)
+    assert [entry["id"] for entry in index["instances"]] == [instance.id for instance in result.instances]
+    for entry, instance in zip(index["instances"], result.instances):
+        assert entry["class_name"] == instance.class_name
+        assert entry["bbox"]["width"] == instance.bbox.width
+        assert read_result_mask(pb_path, json_path, instance.id) == instance.mask_png
+
+
+def test_split_separates_masks_from_metadata():
+    result, data = result_bytes()
+    header, parts = split_result(data)
+
+    parsed = result_pb2.AnalysisResult.FromString(header)
+    assert parsed.image_path == result.image_path
+    assert (parsed.width, parsed.height) == (result.width, result.height)
+    assert len(parsed.instances) == 0
+
+    assert len(parts) == len(result.instances)
+    for (metadata, offset, length), instance in zip(parts, result.instances):
+        stripped = result_pb2.AnalysisResult.Instance.FromString(metadata)
+        assert (stripped.id, stripped.class_name, stripped.score) == (instance.id, instance.class_name, instance.score)
+        assert stripped.bbox == instance.bbox
+        assert stripped.mask_png == b""
+        assert data[offset:offset + length] == instance.mask_png
+
+
+def test_split_of_an_empty_result():
+    assert split_result(b"") == (b"", [])
+
+
+def test_truncated_result_is_rejected():
+    _, data = result_bytes()
+    _, parts = split_result(data)
+    # A cut on a field boundary is a valid shorter message; these all land inside a field.
+    cuts = [1, len(data) - 1] + [offset + length // 2 for _, offset, length in parts]
+    for cut in cuts:
+        with pytest.raises(ValueError):
+            split_result(data[:cut])
+
+
+@pytest.mark.parametrize("data", [
+    b"\x00\x01",  # field number 0
+    b"\x08" + b"\xff" * 10 + b"\x01",  # varint longer than 64 bits
+    b"\x0b",  # unsupported wire type (start group)
+    b"\x2a\x05abc",  # length past the end
+])
+def test_malformed_result_is_rejected(data):
+    with pytest.raises(ValueError):
+        split_result(data)
+
+
+def test_write_result_index_from_a_pb_file():
+    _, data = result_bytes()
+    pb_path = os.path.join(NP_STORAGE_DIR, "splitter_index.pb")
+    with open(pb_path, "wb") as f:
+        f.write(data)
+    json_path = write_result_index(pb_path, "splitter_index")
+    assert_index_matches(json_path, pb_path)
+
+
+def test_streamed_analysis_from_the_stub_server(stub, study):
+    stages = []
+    pb_path, json_path = stream_dicom_analysis(
+        3, "splitter_stream", study, on_progress=lambda stage, fraction: stages.append(stage), chunk_size=64 * 1024, stub=stub
+    )
+    assert stages[0] == "receiving" and stages[-1] == "inference"
+    assert_index_matches(json_path, pb_path)
+    assert not [name for name in os.listdir(NP_STORAGE_DIR) if name.startswith("tmp")]
+
+
+def test_unary_analysis_from_the_stub_server(stub, study, monkeypatch):
+    monkeypatch.setattr(dicom_analysis_service.analyser_channels, "stub", lambda: stub)
+    pb_path, json_path = get_dicom_analysis(4, "splitter_unary.zip", study)
+    assert os.path.basename(pb_path) == "splitter_unary.pb"
+    assert_index_matches(json_path, pb_path)
@@ -0,0 +1,96 @@
+import pytest
+
+from app.services.state_store import (
+    StateConflict, MemoryStateStore, SQLiteStateStore, RedisStateStore, LocalRedis
+)
+
+
+class RacingRedis(LocalRedis):
+    """LocalRedis that runs race() between a pipeline's WATCH and MULTI, as another worker could."""
+
+    race = None
+
+    def pipeline(self, transaction: bool = True):
+        pipe = super().pipeline(transaction)
+        multi = pipe.multi
+
+        def racing_multi():
+            race, self.race = self.race, None
+            if race:
+                race()
+            multi()
+
+        pipe.multi = racing_multi
+        return pipe
+
+
+@pytest.fixture(params=["memory", "sqlite", "local_redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStateStore()
+    if request.param == "sqlite":
+        return SQLiteStateStore(str(tmp_path / "state.sqlite3"))
+    return RedisStateStore(LocalRedis())
+
+
+def test_unconditional_put_bumps_the_version(store):
+    assert store.version("planning", 1) == 0
+    assert store.get("planning", 1) is None
+    assert store.put("planning", 1, {"a": 1}) == 1
+    assert store.put("planning", 1, {"a": 2}) == 2
+    assert store.get("planning", 1) == (2, {"a": 2})
+
+
+def test_compare_and_set_with_the_current_version(store):
+    assert store.put("planning", 1, {"a": 1}, expected_version=0) == 1
+    assert store.put("planning", 1, {"a": 2}, expected_version=1) == 2
+    assert store.get("planning", 1) == (2, {"a": 2})
+
+
+def test_compare_and_set_with_a_stale_version_conflicts(store):
+    store.put("planning", 1, {"a": 1})
+    store.put("planning", 1, {"a": 2})
+    with pytest.raises(StateConflict) as conflict:
+        store.put("planning", 1, {"a": "lost"}, expected_version=1)
+    assert conflict.value.version == 2
+    assert store.get("planning", 1) == (2, {"a": 2})
+
+
+def test_compare_and_set_on_a_deleted_key(store):
+    store.put("planning", 1, {"a": 1})
+    store.delete("planning", 1)
+    assert store.version("planning", 1) == 0
+    with pytest.raises(StateConflict):
+        store.put("planning", 1, {"a": 2}, expected_version=1)
+    assert store.put("planning", 1, {"a": 2}, expected_version=0) == 1
+
+
+def test_keys_and_namespaces_are_independent(store):
+    store.put("planning", 1, {"a": 1})
+    store.put("planning", 2, {"b": 1})
+    store.put("positioning", 1, {"c": 1})
+    assert store.put("planning", 2, {"b": 2}, expected_version=1) == 2
+    assert store.get("planning", 1) == (1, {"a": 1})
+    assert store.get("positioning", 1) == (1, {"c": 1})
+
+
+def test_sqlite_stores_on_one_file_see_each_other(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    first, second = SQLiteStateStore(path), SQLiteStateStore(path)
+    version = first.put("planning", 1, {"a": 1})
+    second.put("planning", 1, {"a": 2}, expected_version=version)
+    with pytest.raises(StateConflict):
+        first.put("planning", 1, {"a": "lost"}, expected_version=version)
+    assert first.get("planning", 1) == (2, {"a": 2})
+
+
+def test_redis_write_between_watch_and_exec_conflicts():
+    client = RacingRedis()
+    store = RedisStateStore(client)
+    version = store.put("planning", 1, {"a": 1})
+
+    client.race = lambda: RedisStateStore(client).put("planning", 1, {"a": 2})
+    with pytest.raises(StateConflict) as conflict:
+        store.put("planning", 1, {"a": "lost"}, expected_version=version)
+    assert conflict.value.version == 2
+    assert store.get("planning", 1) == (2, {"a": 2})
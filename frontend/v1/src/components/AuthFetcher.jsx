@@ -9,4 +9,19 @@ export const authFetch = (url, options = {}) => {
         'Authorization': `Bearer ${token}`,
       },
     });
-  };
\ No newline at end of file
+  };
+// List endpoints return one page per request; follow X-Next-Cursor until the last page.
+export const authFetchAll = async (url) => {
+    const rows = [];
+    let cursor = null;
+    do {
+      const separator = url.includes('?') ? '&' : '?';
+      const response = await authFetch(cursor ? `${url}${separator}cursor=${encodeURIComponent(cursor)}` : url);
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      rows.push(...(await response.json()));
+      cursor = response.headers.get('X-Next-Cursor');
+    } while (cursor);
+    return rows;
+  };
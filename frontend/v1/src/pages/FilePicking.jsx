@@ -1,6 +1,6 @@
 import React, { useEffect, useState } from 'react';
 import { useNavigate } from 'react-router-dom';
-import { authFetch } from '../components/AuthFetcher.jsx';
+import { authFetch, authFetchAll } from '../components/AuthFetcher.jsx';
 import './FilePicking.css';
 
 
@@ -16,24 +16,24 @@ export default function OpPlanning() {
   const navigate = useNavigate();
 
   useEffect(() => {
-    authFetch('http://127.0.0.1:8000/patients/list_patients')
-      .then((response) => response.json())
-      .then((data) => setPatients(data));
+    authFetchAll('http://127.0.0.1:8000/patients/list_patients')
+      .then((data) => setPatients(data))
+      .catch((error) => console.error("Error fetching patients:", error));
 
     authFetch('http://127.0.0.1:8000/operation_plans/list_operation_types')
       .then((response) => response.json())
       .then((data) => setOperationTypes(data));
 
-    authFetch('http://127.0.0.1:8000/operation_plans/list_operation_plans')
-      .then((response) => response.json())
-      .then((data) => setOperationPlans(data));
+    authFetchAll('http://127.0.0.1:8000/operation_plans/list_operation_plans')
+      .then((data) => setOperationPlans(data))
+      .catch((error) => console.error("Error fetching operation plans:", error));
   }, []);
 
   useEffect(() => {
     if (selectedPatient) {
-      authFetch(`http://127.0.0.1:8000/3d_bone_models/list_by_patient?i_patient=${selectedPatient}`)
-        .then((response) => response.json())
-        .then((data) => setBoneModels(data));
+      authFetchAll(`http://127.0.0.1:8000/3d_bone_models/list_by_patient?i_patient=${selectedPatient}`)
+        .then((data) => setBoneModels(data))
+        .catch((error) => console.error("Error fetching bone models:", error));
     }
   }, [selectedPatient]);
 
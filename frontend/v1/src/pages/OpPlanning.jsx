@@ -2,7 +2,7 @@ import './OpPlanning.css';
 import PNGViewer from '../components/ModelViewer.jsx';
 import React, { useEffect, useState, useCallback } from 'react';
 import { useLocation, useNavigate } from 'react-router-dom';
-import { authFetch } from '../components/AuthFetcher.jsx';
+import { authFetch, authFetchAll } from '../components/AuthFetcher.jsx';
 
 
 export default function OpPlanning() {
@@ -62,8 +62,7 @@ export default function OpPlanning() {
   
   useEffect(() => {
     if (operationType) {
-      authFetch(`http://127.0.0.1:8000/3d_prosthesis_models/list_by_operation_type?i_operation_type=${operationType}`)
-        .then((response) => response.json())
+      authFetchAll(`http://127.0.0.1:8000/3d_prosthesis_models/list_by_operation_type?i_operation_type=${operationType}`)
         .then((data) => {
           setProsthesisModels(data);
   